@@ -93,6 +93,11 @@ def create_app():
     login_manager.init_app(app)
     login_manager.login_view = "auth.login"
 
+    from bonus.tree_queue import tree_update_queue
+    tree_update_queue.init_app(app)
+    from bonus.bonus_queue import bonus_job_queue
+    bonus_job_queue.init_app(app)
+
     # ------------------------------------------------------------------------------------------------------------------------
     # Register blueprints
     # -----------------------------------------------------------------------------------------------------------------------
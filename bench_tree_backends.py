@@ -0,0 +1,198 @@
+# bench_tree_backends.py
+# Usage: python bench_tree_backends.py [--users 20000] [--samples 500] [--seed 7]
+#        python bench_tree_backends.py --existing [--samples 500]
+#        python bench_tree_backends.py --backfill
+#
+# Compares the referral_network closure table with the users.ancestor_path
+# materialized-path backend: per-signup insert cost, ancestor / descendant
+# read latency and disk size. The generated run needs an EMPTY scratch
+# database (point DATABASE_URL at one). --existing only measures reads and
+# size on the current data; --backfill fills ancestor_path from the closure
+# table. The app itself only uses the closure table; the path side is
+# driven through bonus/path_backend.MaterializedPathBackend directly.
+
+import argparse
+import contextlib
+import io
+import json
+import random
+import statistics
+import sys
+import time
+
+from sqlalchemy import text, insert
+
+from app import create_app
+from extensions import db
+from models import User
+from bonus.refferral_tree import ReferralTreeHelper
+from bonus.path_backend import MaterializedPathBackend
+
+
+def percentiles(samples):
+    if not samples:
+        return {'p50_ms': 0.0, 'p95_ms': 0.0}
+    ordered = sorted(samples)
+    return {
+        'p50_ms': round(statistics.median(ordered) * 1000, 3),
+        'p95_ms': round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1000, 3),
+    }
+
+
+def seed_users(count, seed, chunk_size=5000):
+    """Random forest: each user is a root (2%) or referred by a random earlier user"""
+    rng = random.Random(seed)
+    parents = []
+    for i in range(count):
+        parents.append(None if i == 0 or rng.random() < 0.02 else rng.randrange(i))
+
+    ids = []
+    for start in range(0, count, chunk_size):
+        rows = [
+            {
+                'username': f'bench{i}', 'phone': f'bench{i:012d}', 'password_hash': '!bench',
+                'referral_code': f'BN{i:08d}', 'is_active': True, 'is_verified': True,
+            }
+            for i in range(start, min(start + chunk_size, count))
+        ]
+        ids.extend(db.session.execute(insert(User).returning(User.id, sort_by_parameter_order=True), rows).scalars())
+
+    # referred_by is filled in afterwards so sponsors always have a real id
+    db.session.execute(
+        text("UPDATE users SET referred_by = :ref WHERE id = :id"),
+        [{'id': ids[i], 'ref': ids[p]} for i, p in enumerate(parents) if p is not None],
+    )
+    db.session.commit()
+    return [(ids[i], ids[p] if p is not None else None) for i, p in enumerate(parents)]
+
+
+def time_inserts(members, add, init_root, commit_every=500):
+    timings = []
+    for n, (user_id, referrer_id) in enumerate(members, start=1):
+        started = time.perf_counter()
+        if referrer_id is None:
+            init_root(user_id)
+        else:
+            add(user_id, referrer_id)
+        timings.append(time.perf_counter() - started)
+        if n % commit_every == 0:
+            db.session.commit()
+    db.session.commit()
+    return timings
+
+
+def time_reads(user_ids, read):
+    timings = []
+    for user_id in user_ids:
+        started = time.perf_counter()
+        read(user_id)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def closure_add(user_id, referrer_id):
+    with contextlib.redirect_stdout(io.StringIO()):  # add_new_user is chatty
+        ReferralTreeHelper.add_new_user(user_id, referrer_id)
+
+
+def closure_root(user_id):
+    db.session.execute(
+        text("""
+            INSERT INTO referral_network (ancestor_id, descendant_id, depth, path_length)
+            VALUES (:uid, :uid, 0, 0)
+            ON CONFLICT (ancestor_id, descendant_id) DO NOTHING
+        """),
+        {'uid': user_id},
+    )
+
+
+def disk_usage():
+    if db.engine.dialect.name == 'postgresql':
+        closure_bytes = db.session.execute(text("SELECT pg_total_relation_size('referral_network')")).scalar()
+        path_bytes = db.session.execute(
+            text("SELECT COALESCE(SUM(pg_column_size(ancestor_path)), 0) FROM users")
+        ).scalar()
+        index_bytes = db.session.execute(text("SELECT pg_relation_size('idx_user_ancestor_path')")).scalar()
+        return {
+            'closure_total_bytes': int(closure_bytes or 0),
+            'path_column_bytes': int(path_bytes or 0),
+            'path_index_bytes': int(index_bytes or 0),
+            'path_total_bytes': int((path_bytes or 0) + (index_bytes or 0)),
+        }
+    # No per-relation sizes outside Postgres; report row counts instead
+    return {
+        'closure_rows': db.session.execute(text("SELECT COUNT(*) FROM referral_network")).scalar(),
+        'path_rows': db.session.execute(text("SELECT COUNT(*) FROM users WHERE ancestor_path IS NOT NULL")).scalar(),
+    }
+
+
+READERS = {
+    'closure': (
+        ReferralTreeHelper._get_ancestors_closure,
+        ReferralTreeHelper.get_descendants_optimized,
+        ReferralTreeHelper.is_descendant,
+    ),
+    'path': (
+        MaterializedPathBackend.get_ancestors,
+        MaterializedPathBackend.get_descendants,
+        MaterializedPathBackend.is_descendant,
+    ),
+}
+
+
+def measure_reads(sample):
+    report = {}
+    for backend, (ancestors, descendants, is_descendant) in READERS.items():
+        report[f'{backend}_ancestors'] = percentiles(time_reads(sample, ancestors))
+        report[f'{backend}_descendants'] = percentiles(time_reads(sample, descendants))
+        report[f'{backend}_is_descendant'] = percentiles(
+            time_reads(sample, lambda uid: is_descendant(sample[0], uid))
+        )
+        db.session.rollback()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark closure table vs materialized-path referral tree")
+    parser.add_argument("--users", type=int, default=20000, help="users to generate")
+    parser.add_argument("--samples", type=int, default=500, help="users sampled for read latency")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--existing", action="store_true", help="only benchmark reads and size on current data")
+    parser.add_argument("--backfill", action="store_true", help="fill users.ancestor_path from referral_network and exit")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.backfill:
+            print(json.dumps({'backfilled': MaterializedPathBackend.backfill_paths()}))
+            return
+
+        rng = random.Random(args.seed)
+        report = {'dialect': db.engine.dialect.name}
+        if args.existing:
+            user_ids = list(db.session.execute(text("SELECT id FROM users")).scalars())
+        else:
+            if db.session.execute(text("SELECT COUNT(*) FROM users")).scalar():
+                sys.exit("users table is not empty; run against a scratch database or pass --existing")
+
+            members = seed_users(args.users, args.seed)
+            user_ids = [user_id for user_id, _ in members]
+
+            closure = time_inserts(members, closure_add, closure_root)
+            path = time_inserts(
+                members, MaterializedPathBackend.add_user, lambda uid: MaterializedPathBackend.set_path(uid, [])
+            )
+            report['users'] = len(members)
+            report['closure_insert'] = dict(percentiles(closure), total_seconds=round(sum(closure), 3))
+            report['path_insert'] = dict(percentiles(path), total_seconds=round(sum(path), 3))
+
+        sample = rng.sample(user_ids, min(args.samples, len(user_ids)))
+        if sample:
+            report.update(measure_reads(sample))
+        report['disk'] = disk_usage()
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
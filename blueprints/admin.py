@@ -285,3 +285,114 @@ def bonus_to_search_dict(bonus):
 #=======================================================================
 
 
+
+
+#============================================================================================================
+#
+#     ----------------------------REFERRAL TREE CACHE STATS-------------------------------------------
+#
+#============================================================================================================
+
+@admin_bp.route('/admin/cache/ancestors', methods=['GET'])
+@admin_required
+def ancestor_cache_stats():
+    """Hit/miss/eviction counters for this worker's ancestor-chain cache"""
+    from bonus.cache_strategy import ancestor_cache
+    return jsonify(ancestor_cache.stats()), 200
+
+
+#============================================================================================================
+#
+#     ----------------------------REFERRAL TREE UPDATE QUEUE-------------------------------------------
+#
+#============================================================================================================
+
+@admin_bp.route('/admin/queue/tree-updates', methods=['GET'])
+@admin_required
+def tree_update_queue_stats():
+    """Queue depth, lag of the oldest open job, and users missing their closure rows"""
+    from bonus.tree_queue import tree_update_queue
+    stats = tree_update_queue.stats()
+    stats['missing_sample'] = tree_update_queue.find_missing(limit=20)
+    return jsonify(stats), 200
+
+
+@admin_bp.route('/admin/queue/tree-updates/replay', methods=['POST'])
+@admin_required
+def replay_tree_updates():
+    """Re-queue failed jobs and enqueue users that never got a tree update"""
+    from bonus.tree_queue import tree_update_queue
+    result = tree_update_queue.replay_missing(limit=request.args.get('limit', 1000, type=int))
+    tree_update_queue.wake()
+    return jsonify(result), 200
+
+
+#============================================================================================================
+#
+#     ----------------------------REFERRAL BONUS QUEUE-------------------------------------------
+#
+#============================================================================================================
+
+@admin_bp.route('/admin/queue/bonuses', methods=['GET'])
+@admin_required
+def bonus_queue_stats():
+    """Queue depth, lag of the oldest open job, and completed purchases without a bonus job"""
+    from bonus.bonus_queue import bonus_job_queue
+    stats = bonus_job_queue.stats()
+    stats['missing_sample'] = bonus_job_queue.find_missing(limit=20)
+    return jsonify(stats), 200
+
+
+@admin_bp.route('/admin/queue/bonuses/replay', methods=['POST'])
+@admin_required
+def replay_bonus_jobs():
+    """Re-queue failed bonus jobs and enqueue completed purchases that never got one"""
+    from bonus.bonus_queue import bonus_job_queue
+    result = bonus_job_queue.replay_missing(limit=request.args.get('limit', 1000, type=int))
+    bonus_job_queue.wake()
+    return jsonify(result), 200
+
+
+#============================================================================================================
+#
+#     ----------------------------REFERRAL TREE MAINTENANCE-------------------------------------------
+#
+#============================================================================================================
+
+@admin_bp.route('/admin/users/<int:user_id>/move-sponsor', methods=['POST'])
+@admin_required
+def move_user_subtree(user_id):
+    """Move a user and their whole downline under a different sponsor"""
+    from bonus.refferral_tree import ReferralTreeHelper
+
+    data = request.get_json(silent=True) or {}
+    new_sponsor_id = data.get('new_sponsor_id')
+    if not isinstance(new_sponsor_id, int):
+        return jsonify({'success': False, 'error': 'new_sponsor_id (integer) is required'}), 400
+
+    report = ReferralTreeHelper.move_subtree(user_id, new_sponsor_id)
+    if report['success']:
+        logger.info(f"Admin {current_user.id} moved user {user_id} under sponsor {new_sponsor_id}")
+    return jsonify(report), 200 if report['success'] else 400
+
+
+@admin_bp.route('/admin/mega-sponsors', methods=['GET'])
+@admin_required
+def mega_sponsor_stats():
+    """Counter- and sketch-based network figures for every mega sponsor"""
+    from bonus.mega_sponsors import MegaSponsorIndex
+    sponsors = [MegaSponsorIndex.counts(user_id) for user_id in sorted(MegaSponsorIndex.ids())]
+    return jsonify({'mega_sponsors': [s for s in sponsors if s is not None]}), 200
+
+
+@admin_bp.route('/admin/mega-sponsors/<int:user_id>/recount', methods=['POST'])
+@admin_required
+def recount_mega_sponsor(user_id):
+    """Exact active-member recount for one mega sponsor (scans its whole downline)"""
+    from bonus.mega_sponsors import MegaSponsorIndex
+
+    if not MegaSponsorIndex.is_mega(user_id):
+        return jsonify({'success': False, 'error': 'User is not a mega sponsor'}), 404
+    result = MegaSponsorIndex.recount(user_id)
+    logger.info(f"Admin {current_user.id} recounted mega sponsor {user_id}: {result['exact_active_members']}")
+    return jsonify(dict(result, success=True)), 200
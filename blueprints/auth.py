@@ -6,6 +6,7 @@ import re, secrets, string
 from utils import validate_email, validate_phone 
 from flask import Blueprint, jsonify, request, session
 from extensions import db
+from bonus.tree_queue import tree_update_queue
 import logging
 import string
 import secrets
@@ -175,7 +176,10 @@ def signup():
                 referral.referred_id = new_user.id
                 referral.status = "active"
 
-            db.session.commit()  # Commit user + bonus + referral atomically
+                # Referral tree insert is queued durably with the user and run by tree_update_queue workers
+                tree_update_queue.enqueue(new_user.id, referrer.id)
+
+            db.session.commit()  # Commit user + bonus + referral + tree job atomically
 
         except IntegrityError:
             db.session.rollback()
@@ -186,23 +190,8 @@ def signup():
             logger.error(f"Signup transaction failed: {e}")
             raise
 
-        # Non-critical: Update referral tree (async to avoid blocking)
         if referrer:
-            try:
-                # For MVP: simple background thread
-                import threading
-                def _update_tree():
-                    try:
-                        from bonus.refferral_tree import ReferralTreeHelper
-                        ReferralTreeHelper.add_new_user(new_user.id, referrer.id)
-                    except Exception as tree_err:
-                        logger.error(f"Referral tree update failed: {tree_err}")
-                
-                thread = threading.Thread(target=_update_tree, daemon=True)
-                thread.start()
-            except Exception as e:
-                logger.warning(f"Failed to queue referral tree update: {e}")
-                # Don't fail signup for non-critical tree update
+            tree_update_queue.wake()
 
         logger.info(f"Signup successful: user_id={new_user.id}, phone={phone[:7]}***")
 
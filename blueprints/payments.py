@@ -25,6 +25,7 @@ from flask import Blueprint, request, jsonify, session
 from blueprints.payments_helpers import  (validate_payment_input, handle_existing_payment,
     create_payment_record, send_to_marzpay
 )
+from bonus.bonus_queue import bonus_job_queue
 
 
 
@@ -83,25 +84,24 @@ def payment_callback():
             payment.provider_reference = transaction.get("provider_reference")
             print(f"🔍 Checking payment type: {payment.payment_type}")
             db.session.add(payment)
+            if payment.payment_type == "package":
+                # Bonuses are distributed off-request by bonus_job_queue workers;
+                # the job commits with the payment so it can't be lost
+                bonus_job_queue.enqueue(payment.id)
             db.session.commit()  
             print(f"✅ Payment status updated to: {payment.status}") 
-            current_payment = Payment.query.get(payment.id)
-            current_app.logger.info(f"DB payment status: {current_payment.status}")
+            current_app.logger.info(f"DB payment status: {payment.status}")
  
 
         except SQLAlchemyError as e:
             db.session.rollback()
             current_app.logger.error(f"Failed to commit payment update: {e}")
+            return jsonify({"error": "Failed to record payment"}), 500
 
         
         if payment.payment_type == "package":
-            from bonus.payment_processor import process_package_purchase
-            success, message = process_package_purchase(payment)
-            if success:
-                
-                return jsonify({"status": "ok", "bonus_status": "success", "message": message}), 200
-            else:
-                return jsonify({"status": "ok", "bonus_status": "error", "message": message}), 200
+            bonus_job_queue.wake()
+            return jsonify({"status": "ok", "bonus_status": "queued"}), 200
         
         elif payment.payment_type == "deposit":
             user = User.query.get(payment.user_id)
@@ -195,28 +195,11 @@ def initiate_payment():
                 payment.balance_type_used = "actual_balance"
 
                 db.session.add(payment)
+                # Referral bonuses are distributed off-request by bonus_job_queue workers
+                bonus_job_queue.enqueue(payment.id)
                 db.session.commit()
+                bonus_job_queue.wake()
                 logging.info("=== PAYMENT PROCESS COMPLETED SUCCESSFULLY ===")
-        
-                # USE THE HELPER FOR PACKAGE + BONUS PROCESSING
-                try:
-                    from bonus.payment_processor import process_package_purchase
-                    print(f"🔄 Processing package and bonuses for internal purchase: {payment.id}")
-                    success, message = process_package_purchase(payment)
-                    
-                    if success:
-                        
-                        print(f"✅ Internal purchase bonuses processed: {message}")
-                        bonus_status = "success"
-                       
-                    else:
-                        print(f"⚠️ Internal purchase bonuses failed: {message}")
-                        bonus_status = "error"
-                        
-                except Exception as e:
-                    logger.error(f"Bonus processing failed for internal payment: {e}")
-                    bonus_status = "error"
-                    message = str(e)
                 
                 return jsonify({
                     "reference": payment.reference,
@@ -226,8 +209,8 @@ def initiate_payment():
                     "message": "Package purchased using account balance",
                     "new_actual_balance": user.actual_balance,
                     "available_balance": user.available_balance,
-                    "referral_bonus_processed": bonus_status == "success",
-                    "bonus_message": message
+                    "referral_bonus_processed": False,
+                    "bonus_status": "queued"
                 }), 200
             
             else:
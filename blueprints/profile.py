@@ -1,15 +1,36 @@
 
-from flask import Blueprint, jsonify, session, render_template, redirect, url_for,g, current_app
+from flask import Blueprint, jsonify, session, render_template, redirect, url_for,g, current_app, request, Response, stream_with_context
 from models import User, db, Package, Wallet, ReferralBonus
 from decimal import Decimal, ROUND_DOWN
 from flask import session, jsonify, current_app
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from models import Bonus
+import json
+import hashlib
+from functools import wraps
 
 
 
 bp = Blueprint('profile',__name__, url_prefix="")
 
+
+def owner_or_admin_required(f):
+    """
+    For /api/user/<user_id>/... routes: the logged-in user may read their
+    own network; admins may read anyone's. 401 without a session, 403 otherwise.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        viewer_id = session.get("user_id")
+        if not viewer_id:
+            return jsonify({"error": "Unauthorized"}), 401
+        if viewer_id != kwargs.get("user_id"):
+            viewer = User.query.get(viewer_id)
+            if not viewer or viewer.role != "admin":
+                return jsonify({"error": "Forbidden"}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
 # ----------------------------------------------------------------------------------
 # 1️⃣ JAVASCRIPT GETS THIS DATA TO DYNAMICALLY UPDATE/ LOAD USER DATA
 # ----------------------------------------------------------------------------------
@@ -74,6 +95,174 @@ def get_user_network(user_id):
             "success": False,
             "error": str(e)
         }), 500
+
+@bp.route("/api/user/<int:user_id>/network/growth", methods=["GET"])
+@owner_or_admin_required
+def get_user_network_growth(user_id):
+    """
+    New downline members per level per day from the maintained growth buckets.
+
+    Query params: days (default 30, max 366) or from / to (ISO dates).
+    """
+    from bonus.network_counters import GrowthCounterHelper
+
+    args = request.args
+    try:
+        end = date.fromisoformat(args["to"]) if args.get("to") else datetime.utcnow().date()
+        if args.get("from"):
+            start = date.fromisoformat(args["from"])
+        else:
+            start = end - timedelta(days=min(max(int(args.get("days", 30)), 1), 366) - 1)
+        if start > end or (end - start).days > 366:
+            raise ValueError("range must be 1 to 366 days")
+    except ValueError as e:
+        return jsonify({"success": False, "error": f"Invalid query parameter: {e}"}), 400
+
+    return jsonify({
+        "success": True,
+        "user_id": user_id,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "buckets": GrowthCounterHelper.get_growth(user_id, start, end),
+    }), 200
+
+#=======================================================================================
+#      LAZY TREE EXPANSION (network visualizer)
+#=======================================================================================
+
+@bp.route("/api/user/<int:user_id>/tree", methods=["GET"])
+@owner_or_admin_required
+def expand_user_tree(user_id):
+    """
+    Direct children of one or more nodes in a user's tree, with child counts
+    and subtree sizes, for expand-on-demand rendering.
+
+    Query params: nodes=1,2,3 (default: the user), limit (children per node),
+    after (next page of a single node). Responses carry a strong ETag.
+    """
+    from bonus.tree_expansion import TreeExpansion, TREE_CHILDREN_PAGE_SIZE
+
+    args = request.args
+    try:
+        nodes = [int(n) for n in args.get("nodes", str(user_id)).split(",") if n.strip()]
+        limit = int(args.get("limit", TREE_CHILDREN_PAGE_SIZE))
+        after = int(args["after"]) if args.get("after") else None
+        tree = TreeExpansion.expand(user_id, nodes, limit=limit, after=after)
+    except ValueError as e:
+        return jsonify({"success": False, "error": f"Invalid query parameter: {e}"}), 400
+
+    body = json.dumps(dict(tree, success=True), separators=(",", ":"), sort_keys=True)
+    response = Response(body, mimetype="application/json")
+    response.set_etag(hashlib.sha256(body.encode()).hexdigest()[:32])
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
+
+#=======================================================================================
+#      PAGINATED DOWNLINE BROWSER
+#=======================================================================================
+
+@bp.route("/api/user/<int:user_id>/downline", methods=["GET"])
+@owner_or_admin_required
+def get_user_downline(user_id):
+    """
+    Browse a user's downline one keyset page at a time.
+
+    Query params: depth | min_depth & max_depth, active=true|false,
+    joined_from / joined_to (ISO dates), limit, cursor (from next_cursor).
+    The page is streamed row by row so big networks don't get buffered.
+    """
+    from bonus.refferral_tree import (
+        ReferralTreeHelper, MAX_REFERRAL_DEPTH, DOWNLINE_PAGE_SIZE, DOWNLINE_MAX_PAGE_SIZE
+    )
+
+    args = request.args
+    try:
+        limit = min(max(int(args.get("limit", DOWNLINE_PAGE_SIZE)), 1), DOWNLINE_MAX_PAGE_SIZE)
+        after = ReferralTreeHelper.decode_downline_cursor(args.get("cursor"))
+        if "depth" in args:
+            min_depth = max_depth = int(args["depth"])
+        else:
+            min_depth = int(args.get("min_depth", 1))
+            max_depth = int(args.get("max_depth", MAX_REFERRAL_DEPTH))
+        active = None
+        if "active" in args:
+            active = args["active"].lower() in ("1", "true", "yes")
+        joined_from = datetime.fromisoformat(args["joined_from"]) if args.get("joined_from") else None
+        joined_to = datetime.fromisoformat(args["joined_to"]) if args.get("joined_to") else None
+    except ValueError as e:
+        return jsonify({"success": False, "error": f"Invalid query parameter: {e}"}), 400
+
+    def generate():
+        # Ask for one extra row to know whether another page exists
+        rows = ReferralTreeHelper.stream_downline(
+            user_id, limit=limit + 1, after=after, min_depth=min_depth, max_depth=max_depth,
+            active=active, joined_from=joined_from, joined_to=joined_to
+        )
+        yield f'{{"success": true, "user_id": {user_id}, "members": ['
+        count = 0
+        last = None
+        has_more = False
+        failed = False
+        try:
+            for row in rows:
+                if count == limit:
+                    has_more = True
+                    break
+                created_at = row["created_at"]
+                row["created_at"] = created_at.isoformat() if hasattr(created_at, "isoformat") else created_at
+                yield ("," if count else "") + json.dumps(row, default=str)
+                last = row
+                count += 1
+        except Exception as e:
+            current_app.logger.error(f"Error streaming downline for user {user_id}: {str(e)}")
+            failed = True
+        finally:
+            rows.close()
+
+        if failed:
+            # The opening "success": true is already sent; the later key wins when parsed,
+            # and there is no next_cursor so the page can't pass for a complete last page
+            yield f'], "count": {count}, "success": false, "error": "Downline stream interrupted"}}'
+            return
+
+        next_cursor = (
+            ReferralTreeHelper.encode_downline_cursor(last["level"], last["id"]) if has_more else None
+        )
+        yield f'], "count": {count}, "next_cursor": {json.dumps(next_cursor)}}}'
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+@bp.route("/api/user/<int:user_id>/downline/search", methods=["GET"])
+@owner_or_admin_required
+def search_user_downline(user_id):
+    """
+    Find members of a user's downline by name, phone fragment or referral code.
+
+    Query params: q (at least 3 characters), limit (default 20, max 100),
+    max_depth. Phones in the results are masked.
+    """
+    from bonus.refferral_tree import MAX_REFERRAL_DEPTH
+    from bonus.downline_search import DownlineSearch, SEARCH_DEFAULT_LIMIT
+
+    query = request.args.get("q", "")
+    try:
+        limit = int(request.args.get("limit", SEARCH_DEFAULT_LIMIT))
+        max_depth = min(int(request.args.get("max_depth", MAX_REFERRAL_DEPTH)), MAX_REFERRAL_DEPTH)
+        results = DownlineSearch.search(user_id, query, limit=limit, max_depth=max_depth)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Error searching downline for user {user_id}: {str(e)}")
+        return jsonify({"success": False, "error": "Search failed"}), 500
+
+    return jsonify({
+        "success": True,
+        "user_id": user_id,
+        "query": query.strip(),
+        "results": results,
+        "count": len(results),
+    }), 200
 #=================================================================================
 #==========================================================================
 
@@ -8,9 +8,11 @@ from sqlalchemy import text
 import hashlib
 import json
 import secrets
+from types import SimpleNamespace
 
 from models import Payment, User, ReferralBonus
-from bonus.config import BonusConfigHelper
+from bonus.config import BonusConfigHelper, BonusSchedule
+from bonus.bonus_integrity import bonus_security_hash
 
 class BonusCalculationHelper:
     """
@@ -54,10 +56,20 @@ class BonusCalculationHelper:
             # Generate batch processing ID
             processing_id = secrets.token_hex(16)
             
+            # ✅ Resolve the whole upline ONCE, then index it per level
+            upline = BonusCalculationHelper._get_upline(paying_user)
+            audit_info['upline_size'] = len(upline)
+            
+            # ✅ All 20 level amounts from the compiled plan in one step
+            schedule = BonusConfigHelper.get_schedule(payment.package_catalog_id)
+            level_amounts = schedule.level_amounts(payment.amount)
+            audit_info['bonus_plan_version'] = str(schedule.version)
+            
             # Calculate bonuses for each level (1 to 20)
             for level in range(1, BonusConfigHelper.MAX_LEVEL + 1):
                 level_bonuses = BonusCalculationHelper._calculate_bonuses_for_level(
-                    paying_user, payment, level, audit_info, purchaser_referrer_id, processing_id
+                    paying_user, payment, level, audit_info, purchaser_referrer_id, processing_id,
+                    upline=upline, schedule=schedule, level_amounts=level_amounts
                 )
                 bonuses.extend(level_bonuses)
                 
@@ -96,14 +108,17 @@ class BonusCalculationHelper:
     @staticmethod
     def _calculate_bonuses_for_level(user: User, payment: Payment, level: int, 
                                     audit_info: Dict, purchaser_referrer_id: int = None,
-                                    processing_id: str = None) -> List[Dict]:
+                                    processing_id: str = None,
+                                    upline: Optional[Dict[int, Any]] = None,
+                                    schedule: Optional[BonusSchedule] = None,
+                                    level_amounts: Optional[Tuple[Decimal, ...]] = None) -> List[Dict]:
         """
         Calculate bonuses for a specific level safely.
         """
         bonuses = []
 
         try:
-            users_at_level = BonusCalculationHelper._get_users_at_referral_level(user, level)
+            users_at_level = BonusCalculationHelper._get_users_at_referral_level(user, level, upline)
             current_app.logger.info(f"🔍 Level {level}: Found {len(users_at_level)} users")
 
             for target_user in users_at_level:
@@ -115,7 +130,9 @@ class BonusCalculationHelper:
                         level=level,
                         original_payer_id=user.id,           # The purchaser
                         purchaser_referrer_id=purchaser_referrer_id,  # The sponsor
-                        processing_id=processing_id
+                        processing_id=processing_id,
+                        bonus_percentage=schedule.percentage(level) if schedule else None,
+                        bonus_amount=level_amounts[level - 1] if level_amounts else None
                     )
                     
                     if bonus_data:
@@ -139,15 +156,39 @@ class BonusCalculationHelper:
  
 
     @staticmethod
-    def _get_users_at_referral_level(start_user: User, target_level: int) -> List[User]:
+    def _get_upline(start_user: User) -> Dict[int, Any]:
+        """
+        Fetch the purchaser's whole upline in one query and key it by level.
+        Each entry carries the fields _calculate_single_bonus needs
+        (id, referral_bonus_eligible, is_active).
+        """
+        from bonus.refferral_tree import ReferralTreeHelper
+
+        if not start_user or not start_user.referred_by:
+            return {}
+
+        chain = ReferralTreeHelper.get_upline_chain(
+            start_user.id, BonusConfigHelper.MAX_LEVEL, referrer_id=start_user.referred_by
+        )
+        current_app.logger.info(f"🔍 Upline for user {start_user.id}: {len(chain)} levels")
+        return {ancestor['level']: SimpleNamespace(**ancestor) for ancestor in chain}
+
+    @staticmethod
+    def _get_users_at_referral_level(start_user: User, target_level: int,
+                                     upline: Optional[Dict[int, Any]] = None) -> List[User]:
         """
         Clean, accurate referral-level traversal.
         Returns exactly one user at the requested level, or [] if none exists.
+        Reads from a pre-resolved `upline` when given instead of walking hop by hop.
         """
         try:
             if not start_user or target_level < 1:
                 return []
 
+            if upline is not None:
+                target = upline.get(target_level)
+                return [target] if target else []
+
             # LEVEL 1: Direct referrer
             current_referrer_id = start_user.referred_by
             if target_level == 1:
@@ -205,9 +246,11 @@ class BonusCalculationHelper:
     @staticmethod
     def _calculate_single_bonus(target_user: User, payment: Payment, level: int, 
                                 original_payer_id: int, purchaser_referrer_id: int = None,
-                                processing_id: str = None) -> Optional[Dict]:
+                                processing_id: str = None, bonus_percentage: Optional[Decimal] = None,
+                                bonus_amount: Optional[Decimal] = None) -> Optional[Dict]:
         """
         Calculate a single bonus for a target user with ALL required fields.
+        Takes the level's percentage and amount precomputed from the compiled plan when given.
         """
         try:
             # Validate target user
@@ -218,12 +261,11 @@ class BonusCalculationHelper:
                 current_app.logger.info(f"User {target_user.id} not eligible for bonuses")
                 return None
 
-            # Get bonus percentage
-            bonus_percentage = BonusConfigHelper.get_bonus_percentage(level)
-
-            # Calculate bonus amount
             payment_amount = Decimal(str(payment.amount))
-            bonus_amount = payment_amount * bonus_percentage
+            if bonus_amount is None:
+                schedule = BonusConfigHelper.get_schedule(payment.package_catalog_id)
+                bonus_percentage = schedule.percentage(level)
+                bonus_amount = schedule.level_amounts(payment_amount)[level - 1]
 
             if bonus_amount < Decimal('1'):
                 return None
@@ -283,18 +325,8 @@ class BonusCalculationHelper:
     
     @staticmethod
     def _generate_security_hash(user_id: int, payment_id: int, level: int, amount: float) -> str:
-        """Generate unique security hash for bonus record"""
-        import hashlib
-        from flask import current_app
-        
-        # Create deterministic string
-        hash_string = f"{user_id}|{payment_id}|{level}|{amount}|{datetime.now(timezone.utc).timestamp()}"
-        
-        # Add secret salt from app config
-        salt = current_app.config.get('SECRET_KEY', 'finicashi_default_salt')
-        
-        # Generate SHA256 hash
-        return hashlib.sha256(f"{hash_string}|{salt}".encode()).hexdigest()
+        """Deterministic keyed hash of the bonus identity (see bonus_integrity.bonus_security_hash)"""
+        return bonus_security_hash(payment_id, user_id, level, amount)
     
     @staticmethod
     def _calculate_bonus_hash(user_id: int, payment_id: int, amount: Decimal, level: int) -> str:
@@ -323,9 +355,10 @@ class BonusCalculationHelper:
             direct_referrer_id = start_user.referred_by
             total_bonuses = 0
             bonuses_created = 0
+            upline = BonusCalculationHelper._get_upline(start_user)
             
             for level in range(1, 21):  # 20 levels
-                users = BonusCalculationHelper._get_users_at_referral_level(start_user, level)
+                users = BonusCalculationHelper._get_users_at_referral_level(start_user, level, upline)
                 
                 for user in users:
                     # Use practical validation
@@ -345,7 +378,7 @@ class BonusCalculationHelper:
                         'referred_id': payment.user_id,
                         'timestamp': datetime.utcnow().isoformat()
                     }
-                        security_hash = BonusCalculationHelper._calculate_bonus_security_hash(bonus_data)    
+                        security_hash = bonus_security_hash(payment_id, user.id, level, bonus_amount)
                         # Create bonus
                         bonus = ReferralBonus(
                             user_id=user.id,
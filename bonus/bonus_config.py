@@ -177,7 +177,7 @@ class ProductionBonusOrchestrator:
                     suspicious_bonuses.append(bonus)
                 
                 # Verify bonus percentage matches configuration
-                expected_percentage = BonusConfigHelper.get_bonus_percentage(level)
+                expected_percentage = BonusConfigHelper.get_bonus_percentage(level, payment.package_catalog_id)
                 actual_percentage = bonus.get('bonus_percentage')
                 if actual_percentage and abs(Decimal(str(actual_percentage)) - expected_percentage) > Decimal('0.001'):
                     current_app.logger.warning(
@@ -405,53 +405,40 @@ class ProductionBonusOrchestrator:
     # In your ProductionBonusOrchestrator class, update the _secure_bonus_storage method:
 
     def _secure_bonus_storage(self, bonuses: List[Dict], payment: Payment, security_context: Dict) -> Dict[str, Any]:
-        """Secure bonus storage with transaction safety"""
+        """Secure bonus storage: one multi-row insert, duplicates skipped by unique_payment_user_level"""
+        from extensions import db
+        from bonus.bonus_storage import ReferralBonusStore
+
         try:
-            stored_bonuses = []
-            
             current_app.logger.info(f"🔄 Starting storage for {len(bonuses)} validated bonuses")
             
-            # Use database transaction
+            rows = []
             for i, bonus_data in enumerate(bonuses):
                 try:
-
-                    # Create bonus record with additional security fields
-                    bonus = ReferralBonus(
-                        user_id=bonus_data['user_id'],
+                    rows.append(ReferralBonusStore.build_row(
+                        bonus_data,
                         payment_id=payment.id,
-                        bonus_amount=bonus_data['amount'],
-                        level=bonus_data['level'],
                         status='pending',
-                        security_hash=self._calculate_bonus_security_hash(bonus_data),
                         processing_id=security_context['processing_id'],
                         threat_level=security_context['threat_level'],
-                        created_at=datetime.now(timezone.utc)
-                    )
-                    
-                    # Add optional fields if they exist
-                    optional_fields = ['referrer_id', 'referred_id', 'bonus_percentage', 'qualifying_amount']
-                    for field in optional_fields:
-                        if field in bonus_data:
-                            setattr(bonus, field, bonus_data[field])
-                    
-                    current_app.db.session.add(bonus)
-                    stored_bonuses.append(bonus)
-                    current_app.logger.info(f"💾 Stored bonus {i+1}: User {bonus.user_id}, Level {bonus.level}, Amount {bonus.amount}")
-                    
+                    ))
                 except Exception as e:
-                    current_app.logger.error(f"❌ Failed to store bonus {i+1}: {str(e)}")
+                    current_app.logger.error(f"❌ Failed to prepare bonus {i+1}: {str(e)}")
                     continue
             
+            stored_bonuses = ReferralBonusStore.insert_many(rows)
+            
             # Mark payment as processed
             payment.bonuses_calculated = True
             payment.bonuses_calculated_at = datetime.now(timezone.utc)
             payment.bonus_processing_id = security_context['processing_id']
             
             # Commit the transaction
-            current_app.db.session.commit()
+            db.session.commit()
             
             security_context['security_checks_passed'].append('bonus_storage')
             security_context['stored_bonuses_count'] = len(stored_bonuses)
+            security_context['duplicate_bonuses_skipped'] = len(rows) - len(stored_bonuses)
             
             current_app.logger.info(f"✅ Successfully stored {len(stored_bonuses)} bonuses in database")
             
@@ -462,7 +449,7 @@ class ProductionBonusOrchestrator:
             }
             
         except Exception as e:
-            current_app.db.session.rollback()
+            db.session.rollback()
             current_app.logger.error(f"❌ Bonus storage failed: {str(e)}")
             security_context['security_checks_failed'].append(f'storage_error: {str(e)}')
             return {'success': False, 'message': f"Storage error: {str(e)}"}
@@ -489,17 +476,14 @@ class ProductionBonusOrchestrator:
         return f"proc_{uuid.uuid4().hex[:16]}_{int(datetime.now(timezone.utc).timestamp())}"
     
     def _calculate_bonus_security_hash(self, bonus_data: Dict) -> str:
-        """Calculate security hash for bonus integrity"""
-        # Create a stable representation of the data
-        stable_data = {
-            'user_id': bonus_data.get('user_id'),
-            'amount': str(bonus_data.get('amount')),
-            'level': bonus_data.get('level'),
-            'payment_id': bonus_data.get('purchase_id')
-        }
-        data_str = json.dumps(stable_data, sort_keys=True)
-        secret = current_app.config.get('SECRET_KEY', 'fallback-secret-key')
-        return hashlib.sha256(f"{data_str}{secret}".encode()).hexdigest()
+        """Deterministic keyed hash of the bonus identity (see bonus_integrity.bonus_security_hash)"""
+        from bonus.bonus_integrity import bonus_security_hash
+        return bonus_security_hash(
+            bonus_data.get('payment_id') or bonus_data.get('purchase_id'),
+            bonus_data.get('user_id'),
+            bonus_data.get('level'),
+            bonus_data.get('bonus_amount', bonus_data.get('amount')),
+        )
     
     def _handle_processing_error(self, payment_id: int, error: Exception, security_context: Dict):
         """Handle processing errors with security context"""
@@ -0,0 +1,95 @@
+# bonus/bonus_integrity.py
+import hashlib
+import hmac
+import logging
+import time
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, Any, Optional
+
+from flask import current_app
+from sqlalchemy import text
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal('0.01')
+
+
+def canonical_amount(amount) -> Decimal:
+    """Bonus amount as stored in referral_bonuses.bonus_amount (NUMERIC(10, 2))"""
+    return Decimal(str(amount)).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def _hash_key() -> bytes:
+    key = current_app.config.get('BONUS_HASH_KEY') or current_app.config.get('SECRET_KEY')
+    if not key:
+        raise RuntimeError("BONUS_HASH_KEY or SECRET_KEY must be configured to sign bonuses")
+    return key.encode() if isinstance(key, str) else key
+
+
+def bonus_security_hash(payment_id: int, user_id: int, level: int, bonus_amount, key: Optional[bytes] = None) -> str:
+    """
+    Deterministic HMAC-SHA256 over a bonus's identity and amount.
+
+    The same (payment, recipient, level, amount) always signs the same way,
+    so security_hash doubles as an idempotency key (its unique index rejects
+    re-inserts), and any edit to those columns breaks the signature.
+    """
+    message = f"{payment_id}|{user_id}|{level}|{canonical_amount(bonus_amount)}"
+    return hmac.new(key or _hash_key(), message.encode(), hashlib.sha256).hexdigest()
+
+
+class BonusIntegrityScanner:
+    """
+    Offline tamper scan: re-signs stored referral_bonuses rows in id order
+    (keyset chunks, read-only) and reports rows whose security_hash does not
+    match. Rows signed before deterministic hashes were introduced will all
+    mismatch; use `since_id` to start after the cutover.
+    """
+
+    def __init__(self, chunk_size: int = 5000, sample_limit: int = 50):
+        self.chunk_size = chunk_size
+        self.sample_limit = sample_limit
+
+    def run(self, since_id: int = 0) -> Dict[str, Any]:
+        started = time.monotonic()
+        key = _hash_key()
+        report = {'scanned': 0, 'valid': 0, 'mismatched': 0, 'samples': [], 'last_id': since_id}
+
+        last_id = since_id
+        while True:
+            rows = db.session.execute(
+                text("""
+                    SELECT id, payment_id, user_id, level, bonus_amount, security_hash
+                    FROM referral_bonuses
+                    WHERE id > :last_id
+                    ORDER BY id
+                    LIMIT :limit
+                """),
+                {'last_id': last_id, 'limit': self.chunk_size},
+            ).fetchall()
+            if not rows:
+                break
+
+            for row in rows:
+                expected = bonus_security_hash(row.payment_id, row.user_id, row.level, row.bonus_amount, key)
+                if hmac.compare_digest(expected, row.security_hash or ''):
+                    report['valid'] += 1
+                    continue
+                report['mismatched'] += 1
+                if len(report['samples']) < self.sample_limit:
+                    report['samples'].append({
+                        'id': row.id, 'payment_id': row.payment_id, 'user_id': row.user_id,
+                        'level': row.level, 'bonus_amount': str(row.bonus_amount),
+                    })
+
+            report['scanned'] += len(rows)
+            last_id = rows[-1].id
+            db.session.rollback()  # read-only; don't hold a snapshot across chunks
+
+        report['last_id'] = last_id
+        report['seconds'] = round(time.monotonic() - started, 3)
+        if report['mismatched']:
+            logger.warning(f"Bonus integrity scan: {report['mismatched']} of {report['scanned']} rows mismatched")
+        return report
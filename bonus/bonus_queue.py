@@ -0,0 +1,135 @@
+# bonus/bonus_queue.py
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy import text
+
+from extensions import db
+from models import Payment
+from bonus.job_queue import DurableJobQueue
+
+logger = logging.getLogger(__name__)
+
+
+class BonusJobQueue(DurableJobQueue):
+    """
+    Durable queue (see DurableJobQueue) for referral bonus distribution
+    after a package payment completes.
+
+    payment_callback() and the internal-balance purchase only record the
+    payment and enqueue a BonusJob in the same transaction, so the webhook
+    reply no longer waits on the upline walk, crediting and notifications,
+    and a crash can never lose a purchase's bonuses. Workers run
+    PurchasePipeline. Processing is idempotent per payment: there is one
+    job per payment_id (a retried webhook enqueues nothing new), the job is
+    marked done in the purchase's own transaction, and the pipeline locks
+    the payment row and stops at "Already processed" if its bonuses exist.
+    stats() also reports the end-to-end latency of processed jobs.
+    """
+
+    table = 'bonus_jobs'
+    key_column = 'payment_id'
+    job_columns = 'payment_id'
+    job_label = 'Bonus job for payment'
+    worker_name = 'bonus-job'
+
+    def __init__(self, workers: int = 2, batch_size: int = 20, poll_interval: float = 2.0,
+                 max_attempts: int = 8, lease_seconds: int = 120):
+        super().__init__(workers, batch_size, poll_interval, max_attempts, lease_seconds)
+
+    # -------------------------
+    # Producer side
+    # -------------------------
+    @staticmethod
+    def enqueue(payment_id: int) -> bool:
+        """
+        Add a job to the current transaction; the caller commits. Returns
+        False if the payment already has a job (e.g. a retried webhook).
+        """
+        inserted = db.session.execute(
+            text("""
+                INSERT INTO bonus_jobs (payment_id, status, attempt_count, next_attempt, created_at)
+                VALUES (:payment_id, 'pending', 0, :now, :now)
+                ON CONFLICT (payment_id) DO NOTHING
+            """),
+            {'payment_id': payment_id, 'now': datetime.now(timezone.utc)},
+        ).rowcount
+        return bool(inserted)
+
+    # -------------------------
+    # Consumer side
+    # -------------------------
+    def _handle(self, job: Dict[str, Any]) -> Optional[str]:
+        from bonus.purchase_pipeline import PurchasePipeline
+
+        payment = db.session.get(Payment, job['payment_id'])
+        if payment is None:
+            return "payment not found"
+
+        finished = []
+
+        def finish_with_purchase():
+            self._finish(job, 'done')
+            finished.append(True)
+
+        # The job is marked done in the purchase's own commit, so a worker dying
+        # after it can't leave a done purchase with an open job to run again
+        result = PurchasePipeline(payment, before_commit=finish_with_purchase).run()
+        if not result['success']:
+            return result['message']
+        if not finished:  # "Already processed": nothing was written
+            self._finish(job, 'done')
+            db.session.commit()
+        return None
+
+    # -------------------------
+    # Replay
+    # -------------------------
+    @staticmethod
+    def find_missing(limit: int = 1000, since: Optional[datetime] = None) -> List[int]:
+        """Completed package payments with no bonus job and no bonuses written"""
+        since_clause = "AND p.created_at >= :since" if since else ""
+        rows = db.session.execute(
+            text(f"""
+                SELECT p.id
+                FROM payments p
+                LEFT JOIN bonus_jobs j ON j.payment_id = p.id
+                WHERE p.payment_type = 'package' AND p.status = 'completed'
+                  AND j.id IS NULL
+                  AND NOT EXISTS (SELECT 1 FROM referral_bonuses rb WHERE rb.payment_id = p.id)
+                  {since_clause}
+                ORDER BY p.id
+                LIMIT :limit
+            """),
+            {'limit': limit, 'since': since},
+        )
+        return list(rows.scalars())
+
+    @staticmethod
+    def replay_missing(limit: int = 1000, include_failed: bool = True,
+                       since: Optional[datetime] = None) -> Dict[str, int]:
+        """Re-queue failed jobs and enqueue completed package payments that never got one"""
+        now = datetime.now(timezone.utc)
+        requeued = BonusJobQueue._requeue_failed(now) if include_failed else 0
+
+        missing = BonusJobQueue.find_missing(limit, since)
+        if missing:
+            db.session.execute(
+                text("""
+                    INSERT INTO bonus_jobs (payment_id, status, attempt_count, next_attempt, created_at)
+                    VALUES (:payment_id, 'pending', 0, :now, :now)
+                    ON CONFLICT (payment_id) DO NOTHING
+                """),
+                [{'payment_id': payment_id, 'now': now} for payment_id in missing],
+            )
+        db.session.commit()
+        return {'requeued_failed': requeued, 'enqueued_missing': len(missing)}
+
+
+# Create a singleton instance per worker process
+bonus_job_queue = BonusJobQueue(
+    workers=int(os.getenv("BONUS_QUEUE_WORKERS", "2")),
+    batch_size=int(os.getenv("BONUS_QUEUE_BATCH_SIZE", "20")),
+)
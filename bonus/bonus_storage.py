@@ -0,0 +1,96 @@
+# bonus/bonus_storage.py
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Iterable
+
+from extensions import db
+from models import ReferralBonus
+from bonus.bonus_integrity import bonus_security_hash, canonical_amount
+
+logger = logging.getLogger(__name__)
+
+# Values for columns a calculated bonus may leave out. Every row of one
+# multi-row INSERT must carry the same keys.
+ROW_DEFAULTS = {
+    'status': 'pending',
+    'type': 'referral_bonus',
+    'threat_level': 'low',
+    'is_paid_out': False,
+}
+
+
+class ReferralBonusStore:
+    """
+    Writes all of a purchase's referral bonuses with one multi-row
+    INSERT ... ON CONFLICT DO NOTHING RETURNING.
+
+    Every row is signed with the deterministic bonus_security_hash over
+    the values actually stored, so a re-run of the same purchase produces
+    the same hashes. The unique indexes (security_hash and
+    unique_payment_user_level) are the duplicate check: rows that already
+    exist are skipped by the database instead of being looked up one by one
+    beforehand, and only the rows actually written come back. Nothing is
+    committed here; the caller owns the transaction.
+    """
+
+    COLUMNS = tuple(
+        column.name for column in ReferralBonus.__table__.columns
+        if column.name not in ('id', 'created_at', 'updated_at')
+    )
+
+    @staticmethod
+    def build_row(bonus_data: Dict[str, Any], **overrides) -> Dict[str, Any]:
+        """Normalise a calculated bonus dict into a referral_bonuses row"""
+        data = dict(bonus_data, **overrides)
+        if data.get('payment_id') is None:
+            data['payment_id'] = data.get('purchase_id')
+        if data.get('bonus_amount') is None:
+            data['bonus_amount'] = data.get('amount', 0)
+        data['bonus_amount'] = canonical_amount(data['bonus_amount'])
+        data['security_hash'] = bonus_security_hash(
+            data['payment_id'], data['user_id'], data['level'], data['bonus_amount']
+        )
+
+        calculated_on = data.get('calculated_on')
+        if isinstance(calculated_on, str):
+            calculated_on = datetime.fromisoformat(calculated_on)
+        data['calculated_on'] = calculated_on or datetime.now(timezone.utc)
+
+        row = {column: data.get(column) for column in ReferralBonusStore.COLUMNS}
+        for column, default in ROW_DEFAULTS.items():
+            if row[column] is None:
+                row[column] = default
+        return row
+
+    @staticmethod
+    def insert_many(rows: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Insert rows built by build_row in one statement. Returns id, user_id,
+        level and bonus_amount of each inserted row; conflicting rows are
+        skipped and absent from the result.
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+
+        if db.engine.dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+
+        table = ReferralBonus.__table__
+        statement = (
+            insert(table)
+            .values(rows)
+            .on_conflict_do_nothing()
+            .returning(table.c.id, table.c.user_id, table.c.level, table.c.bonus_amount)
+        )
+        inserted = [dict(row._mapping) for row in db.session.execute(statement)]
+
+        skipped = len(rows) - len(inserted)
+        if skipped:
+            logger.warning(
+                f"Skipped {skipped} duplicate referral bonus(es) for payment(s) "
+                f"{sorted({row['payment_id'] for row in rows})}"
+            )
+        return inserted
@@ -0,0 +1,327 @@
+# bonus/bulk_import.py
+import logging
+import secrets
+import string
+import time
+from typing import Dict, Any, List, Optional, Iterable
+
+from sqlalchemy import text, bindparam, insert
+
+from extensions import db
+from utils import validate_email, validate_phone
+from models import User, Referral
+from bonus.refferral_tree import MAX_REFERRAL_DEPTH
+from bonus.network_counters import NetworkCounterHelper
+
+logger = logging.getLogger(__name__)
+
+# Imported accounts without a password hash get an unusable one and must go
+# through password reset (check_password_hash() returns False for it)
+UNUSABLE_PASSWORD = "!imported"
+
+
+class BulkUserImporter:
+    """
+    Imports a batch of (user, sponsor) records and wires them into the
+    referral tree with set-based statements instead of add_new_user per user.
+
+    Each record is a dict with username, phone, optional email, optional
+    password_hash and an optional sponsor. The sponsor is the phone of
+    another record in the batch, or the phone / referral code of an
+    existing user.
+
+    Records are validated and topologically ordered in memory, and sponsor
+    cycles are rejected there. Users are then inserted one tree layer at a
+    time. Each layer's closure rows are one INSERT ... SELECT from the
+    sponsors' rows, and downline counters are applied once at the end. The
+    whole import is a single transaction.
+    """
+
+    def __init__(self, chunk_size: int = 1000):
+        self.chunk_size = chunk_size
+
+    def run(self, records: Iterable[Dict[str, Any]], dry_run: bool = False) -> Dict[str, Any]:
+        started = time.monotonic()
+        records = [dict(r, row=i) for i, r in enumerate(records, start=1)]
+        rejected: List[Dict[str, Any]] = []
+
+        valid = self._validate(records, rejected)
+        sponsors = self._resolve_sponsors(valid, rejected)
+        layers = self._order_layers(valid, sponsors, rejected)
+
+        report = {
+            'received': len(records),
+            'imported': 0,
+            'rejected': rejected,
+            'layers': len(layers),
+            'closure_rows': 0,
+            'ancestors_updated': 0,
+            'dry_run': dry_run,
+            'elapsed_seconds': 0.0,
+            'users_per_sec': 0.0,
+        }
+
+        try:
+            if layers:
+                new_ids = self._insert_layers(layers, sponsors, report)
+                report['ancestors_updated'] = NetworkCounterHelper.record_new_members(new_ids, self.chunk_size)
+                report['imported'] = len(new_ids)
+
+            if dry_run:
+                db.session.rollback()
+            else:
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.exception("Bulk user import failed, rolled back")
+            raise
+
+        elapsed = time.monotonic() - started
+        report['elapsed_seconds'] = round(elapsed, 3)
+        report['users_per_sec'] = round(report['imported'] / elapsed, 1) if elapsed else 0.0
+        logger.info(
+            f"Bulk import: {report['imported']}/{report['received']} users in {report['elapsed_seconds']}s "
+            f"({len(rejected)} rejected, {report['closure_rows']} closure rows, dry_run={dry_run})"
+        )
+        return report
+
+    # -------------------------
+    # In-memory validation and ordering
+    # -------------------------
+    def _validate(self, records: List[Dict[str, Any]], rejected: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        valid: Dict[str, Dict[str, Any]] = {}
+        seen_usernames, seen_emails = set(), set()
+
+        for record in records:
+            username = (record.get('username') or '').strip()
+            email = (record.get('email') or '').strip().lower() or None
+            phone = (record.get('phone') or '').strip()  # stored as entered, like signup
+
+            reason = None
+            if not username:
+                reason = "missing username"
+            elif not validate_phone(phone):
+                reason = "invalid phone"
+            elif email and not validate_email(email):
+                reason = "invalid email"
+            elif phone in valid or username in seen_usernames or (email and email in seen_emails):
+                reason = "duplicate in batch"
+
+            if reason:
+                rejected.append({'row': record['row'], 'phone': record.get('phone'), 'reason': reason})
+                continue
+
+            record.update(username=username, email=email, phone=phone)
+            valid[phone] = record
+            seen_usernames.add(username)
+            if email:
+                seen_emails.add(email)
+
+        # One IN query per chunk for clashes with existing accounts
+        taken_phones, taken_usernames, taken_emails = set(), set(), set()
+        for chunk in self._chunks(list(valid.values())):
+            rows = db.session.execute(
+                text(
+                    """
+                    SELECT phone, username, email FROM users
+                    WHERE phone IN :phones OR username IN :usernames OR email IN :emails
+                    """
+                ).bindparams(
+                    bindparam('phones', expanding=True),
+                    bindparam('usernames', expanding=True),
+                    bindparam('emails', expanding=True),
+                ),
+                {
+                    'phones': [r['phone'] for r in chunk],
+                    'usernames': [r['username'] for r in chunk],
+                    'emails': [r['email'] for r in chunk if r['email']] or [''],
+                },
+            )
+            for row in rows:
+                taken_phones.add(row.phone)
+                taken_usernames.add(row.username)
+                if row.email:
+                    taken_emails.add(row.email)
+
+        for phone, record in list(valid.items()):
+            if phone in taken_phones or record['username'] in taken_usernames or record['email'] in taken_emails:
+                rejected.append({'row': record['row'], 'phone': phone, 'reason': "user already exists"})
+                del valid[phone]
+
+        return valid
+
+    def _resolve_sponsors(self, valid: Dict[str, Dict[str, Any]],
+                          rejected: List[Dict[str, Any]]) -> Dict[str, int]:
+        """Map each external sponsor key (phone or referral code) to an existing user id"""
+        external = set()
+        for record in valid.values():
+            record['sponsor'] = (record.get('sponsor') or '').strip() or None
+            if record['sponsor'] and record['sponsor'] not in valid:
+                external.add(record['sponsor'])
+
+        sponsors: Dict[str, int] = {}
+        for chunk in self._chunks(sorted(external)):
+            keys_by_code = {key.upper(): key for key in chunk}
+            rows = db.session.execute(
+                text("SELECT id, phone, referral_code FROM users WHERE phone IN :phones OR referral_code IN :codes")
+                .bindparams(bindparam('phones', expanding=True), bindparam('codes', expanding=True)),
+                {'phones': chunk, 'codes': list(keys_by_code)},
+            )
+            for row in rows:
+                if row.phone in external:
+                    sponsors[row.phone] = row.id
+                if row.referral_code in keys_by_code:
+                    sponsors[keys_by_code[row.referral_code]] = row.id
+
+        for phone, record in list(valid.items()):
+            if record['sponsor'] in external and record['sponsor'] not in sponsors:
+                rejected.append({'row': record['row'], 'phone': phone, 'reason': "unknown sponsor"})
+                del valid[phone]
+
+        return sponsors
+
+    def _order_layers(self, valid: Dict[str, Dict[str, Any]], sponsors: Dict[str, int],
+                      rejected: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """Kahn-style layering: layer 0 hangs off existing users, layer n off layer n-1"""
+        roots: List[str] = []
+        children: Dict[str, List[str]] = {}
+        orphans = set()  # sponsor is a batch record that was rejected
+        for phone, record in valid.items():
+            sponsor = record['sponsor']
+            if sponsor is None or sponsor in sponsors:
+                roots.append(phone)
+            elif sponsor in valid:
+                children.setdefault(sponsor, []).append(phone)
+            else:
+                orphans.add(phone)
+
+        layers: List[List[Dict[str, Any]]] = []
+        placed = set()
+        current = roots
+        while current:
+            layers.append([valid[phone] for phone in current])
+            placed.update(current)
+            current = [child for phone in current for child in children.get(phone, [])]
+
+        # Anything unplaced hangs under a rejected record or sits on a sponsor cycle
+        for phone, record in valid.items():
+            if phone in placed:
+                continue
+            reason, seen, cursor = "sponsor cycle", set(), phone
+            while cursor in valid and cursor not in seen:
+                if cursor in orphans:
+                    reason = "sponsor rejected"
+                    break
+                seen.add(cursor)
+                cursor = valid[cursor]['sponsor']
+            rejected.append({'row': record['row'], 'phone': phone, 'reason': reason})
+
+        return layers
+
+    # -------------------------
+    # Set-based inserts
+    # -------------------------
+    def _insert_layers(self, layers: List[List[Dict[str, Any]]], sponsors: Dict[str, int],
+                       report: Dict[str, Any]) -> List[int]:
+        ids_param = bindparam('ids', expanding=True)
+        ids_by_phone: Dict[str, int] = {}
+        codes = self._generate_referral_codes(sum(len(layer) for layer in layers))
+
+        # Existing sponsors need their self row for the depth-1 join below
+        self._insert_self_rows(sorted(set(sponsors.values())))
+
+        for layer in layers:
+            layer_ids: List[int] = []
+            for chunk in self._chunks(layer):
+                rows = [
+                    {
+                        'username': record['username'],
+                        'email': record['email'],
+                        'phone': record['phone'],
+                        'password_hash': record.get('password_hash') or UNUSABLE_PASSWORD,
+                        'referral_code': codes.pop(),
+                        'referred_by': self._sponsor_id(record['sponsor'], sponsors, ids_by_phone),
+                        'network_depth': 0,
+                        'direct_referrals_count': 0,
+                        'total_network_size': 0,
+                    }
+                    for record in chunk
+                ]
+                result = db.session.execute(
+                    insert(User).returning(User.id, User.phone, sort_by_parameter_order=True), rows
+                )
+                for row in result:
+                    ids_by_phone[row.phone] = row.id
+                    layer_ids.append(row.id)
+
+            for chunk in self._chunks(layer_ids):
+                self._insert_self_rows(chunk)
+                report['closure_rows'] += db.session.execute(
+                    text(
+                        """
+                        INSERT INTO referral_network (ancestor_id, descendant_id, depth, path_length)
+                        SELECT rn.ancestor_id, u.id, rn.depth + 1, rn.depth + 1
+                        FROM users u
+                        JOIN referral_network rn ON rn.descendant_id = u.referred_by
+                        WHERE u.id IN :ids AND rn.depth < :max_depth
+                        ON CONFLICT (ancestor_id, descendant_id) DO NOTHING
+                        """
+                    ).bindparams(ids_param),
+                    {'ids': chunk, 'max_depth': MAX_REFERRAL_DEPTH},
+                ).rowcount or 0
+
+        new_ids = list(ids_by_phone.values())
+        referrals = [
+            {
+                'referrer_id': self._sponsor_id(record['sponsor'], sponsors, ids_by_phone),
+                'referred_email': record['email'],
+                'referred_id': ids_by_phone[record['phone']],
+                'status': 'active',
+            }
+            for layer in layers for record in layer if record['sponsor']
+        ]
+        for chunk in self._chunks(referrals):
+            db.session.execute(insert(Referral), chunk)
+
+        return new_ids
+
+    def _insert_self_rows(self, user_ids: List[int]) -> None:
+        if not user_ids:
+            return
+        db.session.execute(
+            text(
+                """
+                INSERT INTO referral_network (ancestor_id, descendant_id, depth, path_length)
+                SELECT id, id, 0, 0 FROM users WHERE id IN :ids
+                ON CONFLICT (ancestor_id, descendant_id) DO NOTHING
+                """
+            ).bindparams(bindparam('ids', expanding=True)),
+            {'ids': user_ids},
+        )
+
+    @staticmethod
+    def _sponsor_id(sponsor: Optional[str], sponsors: Dict[str, int], ids_by_phone: Dict[str, int]) -> Optional[int]:
+        if not sponsor:
+            return None
+        return sponsors.get(sponsor) or ids_by_phone[sponsor]
+
+    def _generate_referral_codes(self, count: int, length: int = 8) -> List[str]:
+        """Unique referral codes, checked against existing ones in bulk"""
+        chars = string.ascii_uppercase + string.digits
+        codes = set()
+        while len(codes) < count:
+            candidates = {''.join(secrets.choice(chars) for _ in range(length)) for _ in range(count - len(codes))}
+            candidates -= codes
+            for chunk in self._chunks(sorted(candidates)):
+                taken = db.session.execute(
+                    text("SELECT referral_code FROM users WHERE referral_code IN :codes")
+                    .bindparams(bindparam('codes', expanding=True)),
+                    {'codes': chunk},
+                ).scalars().all()
+                candidates -= set(taken)
+            codes |= candidates
+        return list(codes)
+
+    def _chunks(self, items: List[Any]) -> Iterable[List[Any]]:
+        for start in range(0, len(items), self.chunk_size):
+            yield items[start:start + self.chunk_size]
@@ -1,21 +1,393 @@
-from redis import Redis
-import pickle
-from bonus.refferral_tree import ReferralTreeHelper
-
-class ReferralCache:
-    """Cache frequently accessed referral data"""
-    
-    def __init__(self):
-        self.redis = Redis(host='localhost', port=6379, db=0)
-    
-    def get_ancestors_cached(self, user_id: int) -> List[Dict]:
-        cache_key = f"ancestors:{user_id}"
-        cached = self.redis.get(cache_key)
-        
-        if cached:
-            return pickle.loads(cached)
-        
-        # Cache miss - compute and store
-        ancestors = ReferralTreeHelper.get_ancestors_optimized(user_id)
-        self.redis.setex(cache_key, 300, pickle.dumps(ancestors))  # 5 min cache
-        return ancestors
\ No newline at end of file
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class AncestorChainCache:
+    """
+    Per-worker LRU cache of ancestor chains keyed by user id, backed by a
+    shared Redis tier.
+
+    A user's ancestry is fixed at signup, so chains are cached per gunicorn
+    worker and only change when the tree is explicitly rewritten
+    (add_new_user, store_referral_path, re-parenting). Entries also carry a
+    TTL because the cached rows include is_active / referral_bonus_eligible.
+
+    The Redis tier shares chains and invalidations between workers.
+    Whole-cache invalidation bumps a generation counter that every worker
+    checks, so a re-parent done in one worker is seen by the others.
+    Per-user invalidation bumps that user's version; every entry remembers
+    the versions of its owner and each ancestor in the chain, and is dropped
+    when any of them moves. Workers re-read those versions at most every
+    VERSION_CHECK_INTERVAL per entry, so an invalidation (or an is_active /
+    referral_bonus_eligible change, see watch_user_flags) in one worker
+    reaches the others within about a second instead of at TTL.
+
+    Without a shared tier (no ANCESTOR_CACHE_REDIS_URL) the cache is off:
+    invalidations would stay inside one gunicorn worker, and the others
+    would keep paying bonuses to a moved or deactivated upline until TTL.
+    """
+
+    GENERATION_KEY = "ancestors:generation"
+    GENERATION_CHECK_INTERVAL = 1.0  # seconds between shared generation reads
+    VERSION_CHECK_INTERVAL = 1.0  # seconds between shared version reads per entry
+
+    def __init__(self, maxsize: int = 50000, ttl_seconds: int = 300, redis_url: Optional[str] = None):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._generation_checked_at = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.shared_hits = 0
+        self.shared_errors = 0
+
+        self.redis = None
+        if redis_url:
+            try:
+                from redis import Redis
+                self.redis = Redis.from_url(redis_url, socket_timeout=0.2, socket_connect_timeout=0.2)
+            except Exception as e:
+                logger.warning(f"Ancestor cache shared tier disabled: {e}")
+                self.redis = None
+        if self.redis is None:
+            self.maxsize = 0  # local-only invalidation can't reach the other workers
+
+    # -------------------------
+    # Public API
+    # -------------------------
+    def get(self, user_id: int) -> Optional[List[Dict[str, Any]]]:
+        """Return a copy of the cached chain, or None on miss"""
+        generation = self._current_generation()
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is not None:
+            chain, entry_generation, expires_at, _, _ = entry
+            if entry_generation == generation and expires_at > now and self._entry_current(user_id, entry, now):
+                with self._lock:
+                    if user_id in self._entries:
+                        self._entries.move_to_end(user_id)
+                    self.hits += 1
+                return [dict(a) for a in chain]
+
+            with self._lock:
+                if self._entries.pop(user_id, None) is not None:
+                    self.expirations += 1
+
+        shared = self._shared_get(user_id, generation)
+        if shared is not None:
+            chain, versions = shared
+            if self._read_versions(self._member_ids(user_id, chain)) == versions:
+                with self._lock:
+                    self.shared_hits += 1
+                self._local_set(user_id, chain, generation, versions)
+                return [dict(a) for a in chain]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, user_id: int, chain: List[Dict[str, Any]]) -> None:
+        """Store a chain in the local tier and, if configured, the shared tier"""
+        generation = self._current_generation()
+        chain = [dict(a) for a in chain]
+        versions = self._read_versions(self._member_ids(user_id, chain))
+        self._local_set(user_id, chain, generation, versions)
+        self._shared_set(user_id, chain, generation, versions)
+
+    def invalidate(self, *user_ids: int) -> None:
+        """
+        Invalidate specific users everywhere: their own chains (e.g. a new
+        signup or a rewritten path) and every cached chain they appear in
+        (their is_active / referral_bonus_eligible changed).
+        """
+        user_ids = [uid for uid in user_ids if uid is not None]
+        self._bump_versions(user_ids)
+        self._drop(user_ids)
+
+    def watch_user_flags(self, session, user_model, fields=("is_active", "referral_bonus_eligible")) -> None:
+        """
+        Invalidate users whose cached flags change through the ORM, once the
+        change commits. Raw UPDATEs of those columns must call invalidate().
+        """
+        from sqlalchemy import event, inspect
+
+        @event.listens_for(session, "after_flush")
+        def _collect(flush_session, _context):
+            changed = flush_session.info.setdefault("ancestor_cache_changed", set())
+            for obj in flush_session.dirty:
+                if isinstance(obj, user_model):
+                    state = inspect(obj)
+                    if any(state.attrs[field].history.has_changes() for field in fields):
+                        changed.add(obj.id)
+
+        @event.listens_for(session, "after_commit")
+        def _invalidate(commit_session):
+            changed = commit_session.info.pop("ancestor_cache_changed", None)
+            if changed:
+                self.invalidate(*changed)
+
+        @event.listens_for(session, "after_rollback")
+        def _discard(rollback_session):
+            rollback_session.info.pop("ancestor_cache_changed", None)
+
+    def invalidate_all(self) -> None:
+        """Bump the generation so every worker discards its chains (re-parenting)"""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.invalidations += 1
+
+        if self.redis is not None:
+            try:
+                self._generation = int(self.redis.incr(self.GENERATION_KEY))
+            except Exception as e:
+                self._shared_failed("incr", e)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl_seconds': self.ttl_seconds,
+                'generation': self._generation,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'shared_errors': self.shared_errors,
+                'shared_tier': self.redis is not None,
+                'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
+
+    # -------------------------
+    # Local tier
+    # -------------------------
+    def _local_set(self, user_id: int, chain: List[Dict[str, Any]], generation: int,
+                   versions: List[int]) -> None:
+        if self.maxsize <= 0:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            if generation != self._generation:
+                return  # invalidated while loading
+            self._entries[user_id] = (chain, generation, now + self.ttl_seconds, versions, now)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _drop(self, user_ids: Iterable[int]) -> None:
+        user_ids = [uid for uid in user_ids if uid is not None]
+        with self._lock:
+            for uid in user_ids:
+                if self._entries.pop(uid, None) is not None:
+                    self.invalidations += 1
+
+        if self.redis is not None and user_ids:
+            try:
+                self.redis.delete(*[self._shared_key(uid, self._generation) for uid in user_ids])
+            except Exception as e:
+                self._shared_failed("delete", e)
+
+    # -------------------------
+    # Per-user versions
+    # -------------------------
+    def _entry_current(self, user_id: int, entry: tuple, now: float) -> bool:
+        """Whether no member of the entry's chain was invalidated since it was cached"""
+        chain, generation, expires_at, versions, checked_at = entry
+        if now - checked_at < self.VERSION_CHECK_INTERVAL:
+            return True
+        if self._read_versions(self._member_ids(user_id, chain)) != versions:
+            return False
+        with self._lock:
+            if self._entries.get(user_id) is entry:
+                self._entries[user_id] = (chain, generation, expires_at, versions, now)
+        return True
+
+    @staticmethod
+    def _member_ids(user_id: int, chain: List[Dict[str, Any]]) -> List[int]:
+        return [user_id] + [a['id'] for a in chain]
+
+    def _version_key(self, user_id: int) -> str:
+        return f"ancestors:v:{user_id}"
+
+    def _read_versions(self, user_ids: List[int]) -> List[int]:
+        """
+        Current versions (0 = never bumped). A version outlives any entry
+        that could have seen the previous value (2x TTL), so expiring back
+        to 0 can't revalidate a stale entry.
+        """
+        if self.redis is None:
+            return [0] * len(user_ids)
+        try:
+            return [int(v or 0) for v in self.redis.mget([self._version_key(uid) for uid in user_ids])]
+        except Exception as e:
+            self._shared_failed("versions", e)
+            return [-1] * len(user_ids)  # unverifiable: never matches, so it's a miss
+
+    def _bump_versions(self, user_ids: List[int]) -> None:
+        if not user_ids or self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            for uid in user_ids:
+                pipe.incr(self._version_key(uid))
+                pipe.expire(self._version_key(uid), self.ttl_seconds * 2)
+            pipe.execute()
+        except Exception as e:
+            self._shared_failed("bump", e)
+
+    # -------------------------
+    # Shared tier
+    # -------------------------
+    def _current_generation(self) -> int:
+        if self.redis is None:
+            return self._generation
+
+        now = time.monotonic()
+        if now - self._generation_checked_at < self.GENERATION_CHECK_INTERVAL:
+            return self._generation
+
+        self._generation_checked_at = now
+        try:
+            shared = int(self.redis.get(self.GENERATION_KEY) or 0)
+        except Exception as e:
+            self._shared_failed("generation", e)
+            return self._generation
+
+        with self._lock:
+            if shared != self._generation:
+                self._entries.clear()
+                self._generation = shared
+        return shared
+
+    def _shared_key(self, user_id: int, generation: int) -> str:
+        return f"ancestors:{generation}:{user_id}"
+
+    def _shared_get(self, user_id: int, generation: int) -> Optional[tuple]:
+        """(chain, versions it was cached under), or None"""
+        if self.redis is None:
+            return None
+        try:
+            raw = self.redis.get(self._shared_key(user_id, generation))
+            if not raw:
+                return None
+            payload = json.loads(raw)
+            return payload['chain'], payload['versions']
+        except Exception as e:
+            self._shared_failed("get", e)
+            return None
+
+    def _shared_set(self, user_id: int, chain: List[Dict[str, Any]], generation: int,
+                    versions: List[int]) -> None:
+        if self.redis is None:
+            return
+        try:
+            payload = json.dumps({'chain': chain, 'versions': versions}, default=str)
+            self.redis.setex(self._shared_key(user_id, generation), self.ttl_seconds, payload)
+        except Exception as e:
+            self._shared_failed("set", e)
+
+    def _shared_failed(self, op: str, error: Exception) -> None:
+        with self._lock:
+            self.shared_errors += 1
+        logger.warning(f"Ancestor cache shared tier {op} failed: {error}")
+
+
+class TreeNodeCache:
+    """
+    Process-local LRU + TTL cache for the tree visualizer's expanded nodes.
+
+    Entries are grouped per node: each holds the pages of that node's direct
+    children (keyed by cursor and page size) with their counters. A signup
+    drops its sponsor's pages. Counters further up are allowed to lag by up
+    to `ttl_seconds`.
+    """
+
+    def __init__(self, maxsize: int = 20000, ttl_seconds: int = 30):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._nodes: "OrderedDict[int, Dict[tuple, tuple]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, node_id: int, page: tuple) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            pages = self._nodes.get(node_id)
+            entry = pages.get(page) if pages else None
+            if entry is not None and entry[1] > now:
+                self._nodes.move_to_end(node_id)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del pages[page]
+            self.misses += 1
+            return None
+
+    def set(self, node_id: int, page: tuple, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._nodes.setdefault(node_id, {})[page] = (value, time.monotonic() + self.ttl_seconds)
+            self._nodes.move_to_end(node_id)
+            while len(self._nodes) > self.maxsize:
+                self._nodes.popitem(last=False)
+
+    def invalidate_node(self, *node_ids: int) -> None:
+        with self._lock:
+            for node_id in node_ids:
+                self._nodes.pop(node_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._nodes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'nodes': len(self._nodes),
+                'maxsize': self.maxsize,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Create a singleton instance per worker process
+ancestor_cache = AncestorChainCache(
+    maxsize=int(os.getenv("ANCESTOR_CACHE_SIZE", "50000")),
+    ttl_seconds=int(os.getenv("ANCESTOR_CACHE_TTL", "300")),
+    redis_url=os.getenv("ANCESTOR_CACHE_REDIS_URL"),
+)
+
+tree_node_cache = TreeNodeCache(
+    maxsize=int(os.getenv("TREE_NODE_CACHE_SIZE", "20000")),
+    ttl_seconds=int(os.getenv("TREE_NODE_CACHE_TTL", "30")),
+)
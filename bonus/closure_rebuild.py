@@ -0,0 +1,318 @@
+# bonus/closure_rebuild.py
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, Callable, List, Tuple
+
+from sqlalchemy import text, UniqueConstraint
+
+from extensions import db
+from models import ReferralNetwork
+from bonus.refferral_tree import MAX_REFERRAL_DEPTH
+from bonus.cache_strategy import ancestor_cache
+
+logger = logging.getLogger(__name__)
+
+LIVE_TABLE = "referral_network"
+SHADOW_TABLE = "referral_network_shadow"
+STATE_TABLE = "referral_network_rebuild"
+
+
+class ClosureTableRebuilder:
+    """
+    Set-based rebuild of the referral_network closure table from users.referred_by.
+
+    Builds the depth-limited closure (<= MAX_REFERRAL_DEPTH) into a shadow
+    table one depth at a time. Each depth is filled with INSERT ... SELECT
+    batches over user id ranges. Every batch commits together with a
+    checkpoint row, so an interrupted run resumes where it stopped. When
+    the build is complete the shadow table is swapped in atomically.
+
+    Works on SQLite (tests / local) and Postgres (production).
+    """
+
+    def __init__(self, batch_size: int = 50000, max_depth: int = MAX_REFERRAL_DEPTH,
+                 progress: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.batch_size = batch_size
+        self.max_depth = max_depth
+        self.progress = progress or self._log_progress
+        self.dialect = db.engine.dialect.name
+
+    # -------------------------
+    # Entry point
+    # -------------------------
+    def run(self, restart: bool = False, swap: bool = True) -> Dict[str, Any]:
+        """
+        Build (or resume building) the shadow closure and optionally swap it in.
+        Returns the final checkpoint state.
+        """
+        self._ensure_state_table()
+        state = self._load_state()
+
+        if restart or state is None or state['status'] == 'swapped':
+            state = self._start_fresh()
+        else:
+            logger.info(
+                f"Resuming closure rebuild at depth {state['depth']}, user id > {state['last_user_id']}"
+            )
+
+        if state['status'] == 'building':
+            state = self._build(state)
+
+        if swap and state['status'] == 'built':
+            state = self._swap(state)
+
+        return state
+
+    # -------------------------
+    # Build phase
+    # -------------------------
+    def _start_fresh(self) -> Dict[str, Any]:
+        db.session.execute(text(f"DROP TABLE IF EXISTS {SHADOW_TABLE}"))
+        self._create_shadow_table()
+
+        max_user_id = db.session.execute(text("SELECT COALESCE(MAX(id), 0) FROM users")).scalar()
+        now = datetime.now(timezone.utc)
+        state = {
+            'status': 'building',
+            'depth': 0,
+            'last_user_id': 0,
+            'max_user_id': int(max_user_id),
+            'rows_inserted': 0,
+            'started_at': now,
+            'updated_at': now,
+        }
+        db.session.execute(text(f"DELETE FROM {STATE_TABLE}"))
+        db.session.execute(
+            text(f"""
+                INSERT INTO {STATE_TABLE}
+                    (id, status, depth, last_user_id, max_user_id, rows_inserted, started_at, updated_at)
+                VALUES (1, :status, :depth, :last_user_id, :max_user_id, :rows_inserted, :started_at, :updated_at)
+            """),
+            state,
+        )
+        db.session.commit()
+        logger.info(f"Started closure rebuild for users up to id {state['max_user_id']}")
+        return state
+
+    def _build(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        started = time.monotonic()
+        rows_at_start = state['rows_inserted']
+
+        while state['depth'] <= self.max_depth:
+            depth = state['depth']
+
+            while state['last_user_id'] < state['max_user_id']:
+                lo = state['last_user_id'] + 1
+                hi = min(lo + self.batch_size - 1, state['max_user_id'])
+
+                inserted = self._insert_depth_batch(depth, lo, hi)
+
+                state['last_user_id'] = hi
+                state['rows_inserted'] += inserted
+                self._save_state(state)  # commits batch + checkpoint together
+
+                elapsed = time.monotonic() - started
+                self.progress({
+                    'depth': depth,
+                    'last_user_id': hi,
+                    'max_user_id': state['max_user_id'],
+                    'batch_rows': inserted,
+                    'rows_inserted': state['rows_inserted'],
+                    'rows_per_sec': (state['rows_inserted'] - rows_at_start) / elapsed if elapsed > 0 else 0.0,
+                })
+
+            # Nothing at this depth means nothing deeper either
+            has_rows = db.session.execute(
+                text(f"SELECT 1 FROM {SHADOW_TABLE} WHERE depth = :depth LIMIT 1"),
+                {'depth': depth},
+            ).scalar()
+
+            if depth >= self.max_depth or not has_rows:
+                break
+
+            state['depth'] = depth + 1
+            state['last_user_id'] = 0
+            self._save_state(state)
+
+        state['status'] = 'built'
+        self._save_state(state)
+        logger.info(f"Closure rebuild built {state['rows_inserted']} rows")
+        return state
+
+    def _insert_depth_batch(self, depth: int, lo: int, hi: int) -> int:
+        """Insert all closure rows of `depth` whose descendant id is in [lo, hi]"""
+        params = {'depth': depth, 'lo': lo, 'hi': hi}
+
+        if depth == 0:
+            query = f"""
+                INSERT INTO {SHADOW_TABLE} (ancestor_id, descendant_id, depth, path_length, created_at)
+                SELECT u.id, u.id, 0, 0, COALESCE(u.created_at, CURRENT_TIMESTAMP)
+                FROM users u
+                WHERE u.id BETWEEN :lo AND :hi
+            """
+        elif depth == 1:
+            query = f"""
+                INSERT INTO {SHADOW_TABLE} (ancestor_id, descendant_id, depth, path_length, created_at)
+                SELECT u.referred_by, u.id, 1, 1, COALESCE(u.created_at, CURRENT_TIMESTAMP)
+                FROM users u
+                WHERE u.id BETWEEN :lo AND :hi
+                AND u.referred_by IS NOT NULL
+                AND u.referred_by <> u.id
+                ON CONFLICT (ancestor_id, descendant_id) DO NOTHING
+            """
+        else:
+            # Ancestors at `depth` are the sponsor's ancestors at `depth - 1`
+            query = f"""
+                INSERT INTO {SHADOW_TABLE} (ancestor_id, descendant_id, depth, path_length, created_at)
+                SELECT s.ancestor_id, u.id, :depth, :depth, COALESCE(u.created_at, CURRENT_TIMESTAMP)
+                FROM users u
+                JOIN {SHADOW_TABLE} s
+                    ON s.descendant_id = u.referred_by AND s.depth = :prev_depth
+                WHERE u.id BETWEEN :lo AND :hi
+                AND s.ancestor_id <> u.id
+                ON CONFLICT (ancestor_id, descendant_id) DO NOTHING
+            """
+            params['prev_depth'] = depth - 1
+
+        result = db.session.execute(text(query), params)
+        return max(result.rowcount or 0, 0)
+
+    # -------------------------
+    # Swap phase
+    # -------------------------
+    def _swap(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """Atomically replace referral_network with the shadow table"""
+        try:
+            if self.dialect == 'postgresql':
+                db.session.execute(text(f"LOCK TABLE {LIVE_TABLE} IN ACCESS EXCLUSIVE MODE"))
+
+            # Users who signed up during the build only have live rows
+            caught_up = db.session.execute(
+                text(f"""
+                    INSERT INTO {SHADOW_TABLE} (ancestor_id, descendant_id, depth, path_length, created_at)
+                    SELECT ancestor_id, descendant_id, depth, path_length, created_at
+                    FROM {LIVE_TABLE}
+                    WHERE descendant_id > :max_user_id AND depth <= :max_depth
+                    ON CONFLICT (ancestor_id, descendant_id) DO NOTHING
+                """),
+                {'max_user_id': state['max_user_id'], 'max_depth': self.max_depth},
+            ).rowcount or 0
+
+            db.session.execute(text(f"DROP TABLE {LIVE_TABLE}"))
+            db.session.execute(text(f"ALTER TABLE {SHADOW_TABLE} RENAME TO {LIVE_TABLE}"))
+
+            for name, columns, unique in self._canonical_indexes():
+                shadow_name = f"shadow_{name}"
+                if self.dialect == 'postgresql':
+                    if name == 'uq_network_relationship':
+                        db.session.execute(text(
+                            f"ALTER TABLE {LIVE_TABLE} ADD CONSTRAINT {name} UNIQUE USING INDEX {shadow_name}"
+                        ))
+                    else:
+                        db.session.execute(text(f"ALTER INDEX {shadow_name} RENAME TO {name}"))
+                else:
+                    # SQLite cannot rename indexes
+                    db.session.execute(text(f"DROP INDEX {shadow_name}"))
+                    db.session.execute(text(
+                        f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {LIVE_TABLE} ({', '.join(columns)})"
+                    ))
+
+            if self.dialect == 'postgresql':
+                db.session.execute(text(f"ALTER INDEX {SHADOW_TABLE}_pkey RENAME TO {LIVE_TABLE}_pkey"))
+                db.session.execute(text(f"ALTER SEQUENCE {SHADOW_TABLE}_id_seq RENAME TO {LIVE_TABLE}_id_seq"))
+
+            state['status'] = 'swapped'
+            state['rows_inserted'] += caught_up
+            self._save_state(state)
+
+        except Exception:
+            db.session.rollback()
+            logger.exception("Closure table swap failed; live table left unchanged")
+            raise
+
+        ancestor_cache.invalidate_all()
+        logger.info(f"Swapped in rebuilt closure table ({state['rows_inserted']} rows, {caught_up} caught up)")
+        return state
+
+    # -------------------------
+    # DDL helpers
+    # -------------------------
+    def _create_shadow_table(self):
+        id_column = "id SERIAL PRIMARY KEY" if self.dialect == 'postgresql' else "id INTEGER PRIMARY KEY"
+        timestamp = "TIMESTAMP WITH TIME ZONE" if self.dialect == 'postgresql' else "TIMESTAMP"
+
+        db.session.execute(text(f"""
+            CREATE TABLE {SHADOW_TABLE} (
+                {id_column},
+                ancestor_id INTEGER NOT NULL REFERENCES users (id),
+                descendant_id INTEGER NOT NULL REFERENCES users (id),
+                depth INTEGER NOT NULL,
+                path_length INTEGER NOT NULL,
+                created_at {timestamp} DEFAULT CURRENT_TIMESTAMP,
+                updated_at {timestamp} DEFAULT CURRENT_TIMESTAMP
+            )
+        """))
+
+        # Create the live indexes up front under shadow names so the swap is only renames
+        for name, columns, unique in self._canonical_indexes():
+            db.session.execute(text(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX shadow_{name} ON {SHADOW_TABLE} ({', '.join(columns)})"
+            ))
+
+    @staticmethod
+    def _canonical_indexes() -> List[Tuple[str, List[str], bool]]:
+        """Index definitions of the live table, taken from the ReferralNetwork model"""
+        table = ReferralNetwork.__table__
+        indexes = [
+            (index.name, [column.name for column in index.columns], bool(index.unique))
+            for index in table.indexes
+        ]
+        for constraint in table.constraints:
+            if isinstance(constraint, UniqueConstraint):
+                indexes.append((constraint.name, [column.name for column in constraint.columns], True))
+        return sorted(indexes)
+
+    def _ensure_state_table(self):
+        timestamp = "TIMESTAMP WITH TIME ZONE" if self.dialect == 'postgresql' else "TIMESTAMP"
+        db.session.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+                id INTEGER PRIMARY KEY,
+                status VARCHAR(20) NOT NULL,
+                depth INTEGER NOT NULL,
+                last_user_id INTEGER NOT NULL,
+                max_user_id INTEGER NOT NULL,
+                rows_inserted BIGINT NOT NULL DEFAULT 0,
+                started_at {timestamp},
+                updated_at {timestamp}
+            )
+        """))
+        db.session.commit()
+
+    def _load_state(self) -> Optional[Dict[str, Any]]:
+        row = db.session.execute(text(f"""
+            SELECT status, depth, last_user_id, max_user_id, rows_inserted, started_at, updated_at
+            FROM {STATE_TABLE} WHERE id = 1
+        """)).fetchone()
+        return dict(row._mapping) if row else None
+
+    def _save_state(self, state: Dict[str, Any]):
+        state['updated_at'] = datetime.now(timezone.utc)
+        db.session.execute(
+            text(f"""
+                UPDATE {STATE_TABLE}
+                SET status = :status, depth = :depth, last_user_id = :last_user_id,
+                    rows_inserted = :rows_inserted, updated_at = :updated_at
+                WHERE id = 1
+            """),
+            state,
+        )
+        db.session.commit()
+
+    @staticmethod
+    def _log_progress(progress: Dict[str, Any]):
+        logger.info(
+            f"Closure rebuild depth {progress['depth']}: users <= {progress['last_user_id']}/"
+            f"{progress['max_user_id']}, +{progress['batch_rows']} rows "
+            f"({progress['rows_inserted']} total, {progress['rows_per_sec']:.0f} rows/s)"
+        )
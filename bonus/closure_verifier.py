@@ -0,0 +1,247 @@
+# bonus/closure_verifier.py
+import logging
+import time
+from typing import Dict, Any, Optional, Callable, List, Set, Tuple
+
+from sqlalchemy import text, bindparam
+
+from extensions import db
+from bonus.refferral_tree import MAX_REFERRAL_DEPTH
+from bonus.cache_strategy import ancestor_cache
+
+logger = logging.getLogger(__name__)
+
+ClosureRow = Tuple[int, int, int]  # (ancestor_id, descendant_id, depth)
+
+
+class ClosureVerifier:
+    """
+    Streaming integrity check of referral_network against users.referred_by.
+
+    Walks descendant ids in fixed-size chunks. For each chunk it recomputes
+    the expected closure rows in memory by following referred_by upwards,
+    one IN-query per level. It then diffs them against the stored rows with
+    set operations. Only one chunk is held at a time, so memory stays flat
+    however large the table grows.
+
+    With repair=True every chunk's minimal DELETE / INSERT batches are applied
+    in their own short transaction. Deletes match the exact stored row and
+    inserts use ON CONFLICT DO NOTHING, so a concurrent signup is never
+    clobbered. Users whose tree update job is still queued are skipped,
+    because the queue will write their rows.
+    """
+
+    def __init__(self, chunk_size: int = 2000, max_depth: int = MAX_REFERRAL_DEPTH, pause: float = 0.0,
+                 sample_limit: int = 50, progress: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.chunk_size = chunk_size
+        self.max_depth = max_depth
+        self.pause = pause  # seconds to sleep between chunks to throttle production runs
+        self.sample_limit = sample_limit
+        self.progress = progress or self._log_progress
+
+    # -------------------------
+    # Entry point
+    # -------------------------
+    def run(self, repair: bool = False, start_id: int = 1) -> Dict[str, Any]:
+        started = time.monotonic()
+        max_id = db.session.execute(
+            text("""
+                SELECT MAX(top_id) FROM (
+                    SELECT COALESCE(MAX(id), 0) AS top_id FROM users
+                    UNION ALL
+                    SELECT COALESCE(MAX(descendant_id), 0) FROM referral_network
+                ) ids
+            """)
+        ).scalar() or 0
+        db.session.rollback()
+
+        report = {
+            'repair': repair,
+            'users_checked': 0,
+            'users_skipped_queued': 0,
+            'users_broken': 0,
+            'missing_rows': 0,
+            'extra_rows': 0,
+            'missing_self_rows': 0,
+            'wrong_depth_rows': 0,
+            'orphan_rows': 0,
+            'cycles': 0,
+            'rows_inserted': 0,
+            'rows_deleted': 0,
+            'samples': [],
+        }
+
+        lo = start_id
+        while lo <= max_id:
+            hi = min(lo + self.chunk_size - 1, max_id)
+            self._verify_chunk(lo, hi, repair, report)
+
+            elapsed = time.monotonic() - started
+            self.progress({
+                'last_id': hi,
+                'max_id': max_id,
+                'users_checked': report['users_checked'],
+                'users_broken': report['users_broken'],
+                'ids_per_sec': (hi - start_id + 1) / elapsed if elapsed > 0 else 0.0,
+            })
+            lo = hi + 1
+            if self.pause:
+                time.sleep(self.pause)
+
+        report['seconds'] = round(time.monotonic() - started, 3)
+        logger.info(
+            f"Closure verification: {report['users_broken']}/{report['users_checked']} users broken, "
+            f"{report['missing_rows']} missing / {report['extra_rows']} extra rows, repair={repair}"
+        )
+        return report
+
+    # -------------------------
+    # Per-chunk diff
+    # -------------------------
+    def _verify_chunk(self, lo: int, hi: int, repair: bool, report: Dict[str, Any]) -> None:
+        params = {'lo': lo, 'hi': hi}
+        sponsors = {
+            row.id: row.referred_by
+            for row in db.session.execute(
+                text("SELECT id, referred_by FROM users WHERE id BETWEEN :lo AND :hi"), params
+            )
+        }
+        queued = set(db.session.execute(
+            text("""
+                SELECT user_id FROM tree_update_jobs
+                WHERE user_id BETWEEN :lo AND :hi AND status IN ('pending', 'processing')
+            """),
+            params,
+        ).scalars())
+
+        stored: Set[ClosureRow] = {
+            (row.ancestor_id, row.descendant_id, row.depth)
+            for row in db.session.execute(
+                text("""
+                    SELECT ancestor_id, descendant_id, depth FROM referral_network
+                    WHERE descendant_id BETWEEN :lo AND :hi
+                """),
+                params,
+            )
+            if row.descendant_id not in queued
+        }
+        expected, cycles = self._expected_rows({uid: ref for uid, ref in sponsors.items() if uid not in queued})
+
+        missing = expected - stored
+        extra = stored - expected
+        report['users_checked'] += len(sponsors) - len(queued & sponsors.keys())
+        report['users_skipped_queued'] += len(queued & sponsors.keys())
+        report['cycles'] += len(cycles)
+        self._classify(missing, extra, sponsors, report)
+        db.session.rollback()  # end the read transaction before any writes
+
+        if repair and (missing or extra):
+            deleted, inserted = self._apply(missing, extra)
+            report['rows_deleted'] += deleted
+            report['rows_inserted'] += inserted
+
+    def _expected_rows(self, sponsors: Dict[int, Optional[int]]) -> Tuple[Set[ClosureRow], Set[int]]:
+        """Depth-limited closure of the given users, walking referred_by level by level"""
+        parent: Dict[int, Optional[int]] = dict(sponsors)
+        absent: Set[int] = set()  # sponsor ids with no user row
+        chains: Dict[int, List[int]] = {uid: [] for uid in sponsors}
+        heads: Dict[int, Optional[int]] = dict(sponsors)
+        cycles: Set[int] = set()
+
+        for _ in range(self.max_depth):
+            unknown = {ref for ref in heads.values() if ref is not None and ref not in parent and ref not in absent}
+            if unknown:
+                found = {
+                    row.id: row.referred_by
+                    for row in db.session.execute(
+                        text("SELECT id, referred_by FROM users WHERE id IN :ids")
+                        .bindparams(bindparam('ids', expanding=True)),
+                        {'ids': list(unknown)},
+                    )
+                }
+                parent.update(found)
+                absent.update(unknown - found.keys())
+
+            next_heads = {}
+            for uid, ref in heads.items():
+                if ref is None or ref in absent:
+                    continue
+                if ref == uid or ref in chains[uid]:
+                    cycles.add(uid)
+                    continue
+                chains[uid].append(ref)
+                next_heads[uid] = parent[ref]
+            heads = next_heads
+            if not heads:
+                break
+
+        expected = set()
+        for uid, chain in chains.items():
+            expected.add((uid, uid, 0))
+            expected.update((ancestor_id, uid, depth) for depth, ancestor_id in enumerate(chain, start=1))
+        return expected, cycles
+
+    def _classify(self, missing: Set[ClosureRow], extra: Set[ClosureRow],
+                  sponsors: Dict[int, Optional[int]], report: Dict[str, Any]) -> None:
+        missing_pairs = {(a, d) for a, d, _ in missing}
+        broken = {d for _, d, _ in missing} | {d for _, d, _ in extra}
+
+        report['missing_rows'] += len(missing)
+        report['extra_rows'] += len(extra)
+        report['missing_self_rows'] += sum(1 for a, d, depth in missing if depth == 0)
+        report['wrong_depth_rows'] += sum(1 for a, d, _ in extra if (a, d) in missing_pairs)
+        report['orphan_rows'] += sum(1 for _, d, _ in extra if d not in sponsors)
+        report['users_broken'] += len(broken & sponsors.keys())
+
+        for descendant_id in sorted(broken):
+            if len(report['samples']) >= self.sample_limit:
+                break
+            report['samples'].append({
+                'descendant_id': descendant_id,
+                'missing': sorted((a, depth) for a, d, depth in missing if d == descendant_id),
+                'extra': sorted((a, depth) for a, d, depth in extra if d == descendant_id),
+            })
+
+    # -------------------------
+    # Repair
+    # -------------------------
+    def _apply(self, missing: Set[ClosureRow], extra: Set[ClosureRow]) -> Tuple[int, int]:
+        """Apply one chunk's DELETE / INSERT batches in a single short transaction"""
+        deleted = inserted = 0
+        try:
+            if extra:
+                deleted = db.session.execute(
+                    text("""
+                        DELETE FROM referral_network
+                        WHERE ancestor_id = :ancestor_id AND descendant_id = :descendant_id AND depth = :depth
+                    """),
+                    [{'ancestor_id': a, 'descendant_id': d, 'depth': depth} for a, d, depth in extra],
+                ).rowcount
+            if missing:
+                inserted = db.session.execute(
+                    text("""
+                        INSERT INTO referral_network (ancestor_id, descendant_id, depth, path_length)
+                        VALUES (:ancestor_id, :descendant_id, :depth, :depth)
+                        ON CONFLICT (ancestor_id, descendant_id) DO NOTHING
+                    """),
+                    [{'ancestor_id': a, 'descendant_id': d, 'depth': depth} for a, d, depth in missing],
+                ).rowcount
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.exception("Closure repair batch failed; chunk left unchanged")
+            raise
+
+        ancestor_cache.invalidate(*({d for _, d, _ in missing} | {d for _, d, _ in extra}))
+        # Some drivers report -1 for executemany; fall back to the batch size
+        deleted = deleted if deleted >= 0 else len(extra)
+        inserted = inserted if inserted >= 0 else len(missing)
+        logger.info(f"Closure repair: -{deleted} / +{inserted} rows")
+        return deleted, inserted
+
+    @staticmethod
+    def _log_progress(progress: Dict[str, Any]):
+        logger.info(
+            f"Verified ids <= {progress['last_id']}/{progress['max_id']}: "
+            f"{progress['users_broken']} broken of {progress['users_checked']}"
+        )
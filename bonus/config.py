@@ -1,7 +1,188 @@
 # bonus/config.py
+import logging
+import os
+import threading
+import time
 from decimal import Decimal
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Tuple, Optional
+
+import numpy as np
 from flask import current_app
+from sqlalchemy import text
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+BONUS_PLAN_CHECK_SECONDS = float(os.getenv("BONUS_PLAN_CHECK_SECONDS", "30"))  # plan version poll interval
+_PERCENT_UNITS = 10000          # referral_bonus_plan.bonus_percentage is NUMERIC(5, 4)
+_MAX_EXACT_CENTS = 2 ** 62 // _PERCENT_UNITS  # keeps cents * units inside int64
+
+
+class BonusSchedule:
+    """
+    Immutable, precompiled bonus plan for one package (or the default plan).
+
+    Percentages are held as integer ten-thousandths and minimum qualifying
+    amounts as integer cents, so all 20 level amounts for a payment come
+    from one int64 numpy expression and are exact Decimals.
+    """
+
+    __slots__ = ('version', 'package_id', 'source', 'percentages', 'minimums',
+                 '_units', '_minimum_cents', '_summary')
+
+    def __init__(self, percentages: Tuple[Decimal, ...], minimums: Tuple[Decimal, ...],
+                 version: Any = None, package_id: Optional[int] = None, source: str = 'default'):
+        self.version = version
+        self.package_id = package_id
+        self.source = source
+        self.percentages = percentages
+        self.minimums = minimums
+        self._units = np.array([int(p * _PERCENT_UNITS) for p in percentages], dtype=np.int64)
+        self._minimum_cents = np.array([int(m * 100) for m in minimums], dtype=np.int64)
+        self._units.flags.writeable = False
+        self._minimum_cents.flags.writeable = False
+        self._summary = self._build_summary()
+
+    def percentage(self, level: int) -> Decimal:
+        return self.percentages[level - 1]
+
+    def level_amounts(self, amount) -> Tuple[Decimal, ...]:
+        """Bonus for levels 1..20 on `amount`; 0 where the amount is below a level's minimum"""
+        amount = Decimal(str(amount))
+        cents = amount * 100
+        if cents != cents.to_integral_value() or abs(cents) >= _MAX_EXACT_CENTS:
+            return tuple(
+                amount * p if cents >= m * 100 else Decimal('0')
+                for p, m in zip(self.percentages, self.minimums)
+            )
+        cents = int(cents)
+        raw = np.where(cents >= self._minimum_cents, cents * self._units, 0)
+        return tuple(Decimal(int(v)).scaleb(-6) for v in raw)
+
+    def summary(self) -> Dict[str, Any]:
+        return self._summary
+
+    def _build_summary(self) -> Dict[str, Any]:
+        distribution = {
+            level: {
+                'percentage': float(p),
+                'percentage_display': f"{float(p) * 100}%",
+                'minimum_qualifying_amount': float(m),
+            }
+            for level, (p, m) in enumerate(zip(self.percentages, self.minimums), start=1)
+        }
+        return {
+            'distribution': distribution,
+            'total_percentage': float(sum(self.percentages, Decimal('0'))),
+            'max_level': len(self.percentages),
+            'levels_with_specific_percentages': [
+                level for level, p in enumerate(self.percentages, start=1)
+                if p != BonusConfigHelper.DEFAULT_PERCENTAGE
+            ],
+            'source': self.source,
+            'package_id': self.package_id,
+        }
+
+
+class BonusPlanRegistry:
+    """
+    Loads referral_bonus_plan once and hands out compiled BonusSchedules.
+
+    Active rows with package_catalog_id NULL form the default plan (levels
+    without a row keep BonusConfigHelper's built-in percentages); rows for
+    a package override those levels for that package only. At most every
+    BONUS_PLAN_CHECK_SECONDS a cheap fingerprint query decides whether to
+    recompile, so plan edits apply without a restart. reload() forces it.
+    The fingerprint sums the plan columns themselves, each weighted by row
+    id, so raw SQL edits that leave updated_at alone (it is only bumped by
+    the ORM) are still picked up.
+    """
+
+    def __init__(self, check_seconds: float = BONUS_PLAN_CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self._schedules: Dict[Optional[int], BonusSchedule] = {}
+        self._default: Optional[BonusSchedule] = None
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, package_id: Optional[int] = None) -> BonusSchedule:
+        if self._default is None or time.monotonic() - self._checked_at > self.check_seconds:
+            self._check()
+        return self._schedules.get(package_id, self._default)
+
+    def reload(self) -> BonusSchedule:
+        with self._lock:
+            self._version = None
+            self._checked_at = 0.0
+        return self.get()
+
+    def _check(self) -> None:
+        with self._lock:
+            if self._default is not None and time.monotonic() - self._checked_at <= self.check_seconds:
+                return
+            try:
+                # Own connection: never touches (or aborts) the caller's transaction
+                with db.engine.connect() as conn:
+                    version = tuple(conn.execute(text("""
+                        SELECT COUNT(*), COALESCE(SUM(id), 0),
+                               COALESCE(SUM(id * level), 0),
+                               COALESCE(SUM(id * COALESCE(package_catalog_id, 0)), 0),
+                               COALESCE(SUM(id * bonus_percentage), 0),
+                               COALESCE(SUM(id * COALESCE(minimum_qualifying_amount, 0)), 0),
+                               COALESCE(SUM(CASE WHEN is_active THEN id ELSE 0 END), 0),
+                               MAX(COALESCE(updated_at, created_at))
+                        FROM referral_bonus_plan
+                    """)).one())
+                    if version != self._version or self._default is None:
+                        self._compile(conn, version)
+            except Exception as e:
+                # Keep serving the last compiled plan (or the built-in one)
+                logger.error(f"Could not load referral_bonus_plan: {e}")
+                if self._default is None:
+                    self._default = BonusSchedule(*BonusPlanRegistry._builtin())
+            self._checked_at = time.monotonic()
+
+    def _compile(self, conn, version) -> None:
+        rows = conn.execute(text("""
+            SELECT package_catalog_id, level, bonus_percentage, minimum_qualifying_amount
+            FROM referral_bonus_plan
+            WHERE is_active = TRUE AND level BETWEEN 1 AND :max_level
+            ORDER BY id
+        """), {'max_level': BonusConfigHelper.MAX_LEVEL}).fetchall()
+
+        percentages, minimums = (list(v) for v in BonusPlanRegistry._builtin())
+        overrides: Dict[int, Dict[int, Tuple[Decimal, Decimal]]] = {}
+        for row in rows:
+            entry = (Decimal(str(row.bonus_percentage)), Decimal(str(row.minimum_qualifying_amount or 0)))
+            if row.package_catalog_id is None:
+                percentages[row.level - 1], minimums[row.level - 1] = entry
+            else:
+                overrides.setdefault(row.package_catalog_id, {})[row.level] = entry
+
+        source = 'table' if rows else 'default'
+        default = BonusSchedule(tuple(percentages), tuple(minimums), version, None, source)
+        schedules: Dict[Optional[int], BonusSchedule] = {None: default}
+        for package_id, levels in overrides.items():
+            p, m = list(percentages), list(minimums)
+            for level, (percentage, minimum) in levels.items():
+                p[level - 1], m[level - 1] = percentage, minimum
+            schedules[package_id] = BonusSchedule(tuple(p), tuple(m), version, package_id, 'table')
+
+        self._schedules, self._default, self._version = schedules, default, version
+        logger.info(
+            f"Compiled bonus plan ({source}): {default.summary()['total_percentage'] * 100:.2f}% total, "
+            f"{len(overrides)} package override(s)"
+        )
+
+    @staticmethod
+    def _builtin() -> Tuple[Tuple[Decimal, ...], Tuple[Decimal, ...]]:
+        levels = range(1, BonusConfigHelper.MAX_LEVEL + 1)
+        percentages = tuple(
+            BonusConfigHelper.BONUS_PERCENTAGES.get(level, BonusConfigHelper.DEFAULT_PERCENTAGE) for level in levels
+        )
+        return percentages, tuple(Decimal('0') for _ in levels)
 
 
 class BonusConfigHelper:
@@ -26,56 +207,32 @@ class BonusConfigHelper:
     
     MAX_LEVEL = 20
     
+    @staticmethod
+    def get_schedule(package_id: int = None) -> BonusSchedule:
+        """Compiled plan for a package (the default plan if it has no overrides)"""
+        return bonus_plan.get(package_id)
+
     @staticmethod
     def get_bonus_percentage(level: int, package_id: int = None) -> Decimal:
         """
-        Get bonus percentage for a given level
-        Levels 1-5 have specific percentages, levels 6-20 get 0.5%
+        Get bonus percentage for a given level from the compiled plan
+        (referral_bonus_plan, falling back to the built-in percentages)
         """
-        try:
-            if not isinstance(level, int) or level < 1 or level > BonusConfigHelper.MAX_LEVEL:
-                current_app.logger.warning(f"Invalid level {level}, using default percentage")
-                return BonusConfigHelper.DEFAULT_PERCENTAGE
-            
-            # Return specific percentage for levels 1-5, default for 6-20
-            return BonusConfigHelper.BONUS_PERCENTAGES.get(
-                level, 
-                BonusConfigHelper.DEFAULT_PERCENTAGE
-            )
-        except Exception as e:
-            current_app.logger.error(f"Error getting bonus percentage for level {level}: {e}")
+        if not isinstance(level, int) or level < 1 or level > BonusConfigHelper.MAX_LEVEL:
+            current_app.logger.warning(f"Invalid level {level}, using default percentage")
             return BonusConfigHelper.DEFAULT_PERCENTAGE
+        return bonus_plan.get(package_id).percentage(level)
     
     @staticmethod
-    def get_bonus_distribution_summary() -> Dict[str, Any]:
-        """Get summary of bonus distribution across all levels"""
-        distribution = {}
-        total_percentage = Decimal('0')
-        
-        for level in range(1, BonusConfigHelper.MAX_LEVEL + 1):
-            percentage = BonusConfigHelper.get_bonus_percentage(level)
-            distribution[level] = {
-                'percentage': float(percentage),
-                'percentage_display': f"{float(percentage) * 100}%"
-            }
-            total_percentage += percentage
-        
-        return {
-            'distribution': distribution,
-            'total_percentage': float(total_percentage),
-            'max_level': BonusConfigHelper.MAX_LEVEL,
-            'levels_with_specific_percentages': list(BonusConfigHelper.BONUS_PERCENTAGES.keys())
-        }
+    def get_bonus_distribution_summary(package_id: int = None) -> Dict[str, Any]:
+        """Get summary of bonus distribution across all levels (precomputed per plan version)"""
+        return bonus_plan.get(package_id).summary()
     
     @staticmethod
     def validate_bonus_configuration() -> Tuple[bool, str]:
         """Validate that bonus configuration is mathematically sound"""
         try:
-            total_percentage = Decimal('0')
-            
-            for level in range(1, BonusConfigHelper.MAX_LEVEL + 1):
-                percentage = BonusConfigHelper.get_bonus_percentage(level)
-                total_percentage += percentage
+            total_percentage = sum(bonus_plan.get().percentages, Decimal('0'))
             
             # Total should be reasonable (not exceeding 50% for example)
             if total_percentage > Decimal('0.5'):  # 50%
@@ -88,7 +245,11 @@ class BonusConfigHelper:
             
         except Exception as e:
             return False, f"Configuration validation error: {str(e)}"
-        
+
+
+# Create a singleton instance per worker process
+bonus_plan = BonusPlanRegistry()
+
 import hashlib
 import secrets
 
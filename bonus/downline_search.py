@@ -0,0 +1,196 @@
+# bonus/downline_search.py
+import logging
+import threading
+import time
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from sqlalchemy import text, bindparam
+
+from extensions import db
+from bonus.refferral_tree import MAX_REFERRAL_DEPTH
+
+logger = logging.getLogger(__name__)
+
+SEARCH_MIN_CHARS = 3          # trigram indexes can't help below this
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _mask_phone(phone: Optional[str]) -> Optional[str]:
+    if not phone or len(phone) <= 5:
+        return phone
+    return phone[:3] + '*' * (len(phone) - 5) + phone[-2:]
+
+
+class NgramIndex:
+    """
+    In-process trigram index over username / phone / referral_code, used when
+    the database has no trigram support (SQLite in dev and tests).
+
+    New users are picked up incrementally (id > last seen id) at most every
+    `refresh_seconds`; a full rebuild every `rebuild_seconds` catches edits.
+    """
+
+    def __init__(self, refresh_seconds: float = 5.0, rebuild_seconds: float = 600.0):
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self._postings: Dict[str, Set[int]] = {}
+        self._docs: Dict[int, Tuple[str, str, str]] = {}
+        self._last_id = 0
+        self._refreshed_at = 0.0
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def grams(value: str) -> Set[str]:
+        value = value.lower()
+        return {value[i:i + 3] for i in range(len(value) - 2)}
+
+    def refresh(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._built_at > self.rebuild_seconds:
+                self._postings, self._docs, self._last_id = {}, {}, 0
+                self._built_at = now
+            elif now - self._refreshed_at < self.refresh_seconds:
+                return
+            self._refreshed_at = now
+
+            rows = db.session.execute(
+                text("""
+                    SELECT id, username, phone, referral_code FROM users
+                    WHERE id > :last_id ORDER BY id
+                """),
+                {'last_id': self._last_id},
+            )
+            for row in rows:
+                doc = (row.username or '', row.phone or '', row.referral_code or '')
+                self._docs[row.id] = tuple(field.lower() for field in doc)
+                for field in doc:
+                    for gram in self.grams(field):
+                        self._postings.setdefault(gram, set()).add(row.id)
+                self._last_id = row.id
+
+    def candidates(self, query: str) -> List[int]:
+        """Ids whose username, phone or referral code contains `query`"""
+        self.refresh()
+        query = query.lower()
+        with self._lock:
+            postings = sorted((self._postings.get(gram, set()) for gram in self.grams(query)), key=len)
+            if not postings or not postings[0]:
+                return []
+            ids = set(postings[0]).intersection(*postings[1:])
+            return [uid for uid in ids if any(query in field for field in self._docs[uid])]
+
+
+class DownlineSearch:
+    """
+    Find members of one sponsor's downline by name, phone fragment or referral code.
+
+    On Postgres the text match runs on pg_trgm GIN indexes and is joined to
+    the sponsor's referral_network rows. Elsewhere NgramIndex produces candidates and the ancestor
+    filter is one IN-query. Results are ranked exact > prefix > substring,
+    then by depth, and capped at `limit`.
+    """
+
+    @staticmethod
+    def search(sponsor_id: int, query: str, limit: int = SEARCH_DEFAULT_LIMIT,
+               max_depth: int = MAX_REFERRAL_DEPTH) -> List[Dict[str, Any]]:
+        query = query.strip()
+        if len(query) < SEARCH_MIN_CHARS:
+            raise ValueError(f"query must be at least {SEARCH_MIN_CHARS} characters")
+        limit = min(max(limit, 1), SEARCH_MAX_LIMIT)
+
+        if db.engine.dialect.name == 'postgresql':
+            rows = DownlineSearch._search_sql(sponsor_id, query, limit, max_depth)
+        else:
+            rows = DownlineSearch._search_ngram(sponsor_id, query, limit, max_depth)
+
+        for row in rows:
+            row['phone'] = _mask_phone(row['phone'])
+        return rows
+
+    @staticmethod
+    def _rank(row: Dict[str, Any], query: str) -> int:
+        fields = [(row.get(name) or '').lower() for name in ('username', 'phone', 'referral_code')]
+        if query in fields:
+            return 0
+        if any(field.startswith(query) for field in fields):
+            return 1
+        return 2
+
+    @staticmethod
+    def _search_sql(sponsor_id: int, query: str, limit: int, max_depth: int) -> List[Dict[str, Any]]:
+        rows = db.session.execute(
+            text(f"""
+                SELECT u.id, u.username, u.phone, u.referral_code, u.is_active, rn.depth AS level,
+                       CASE
+                           WHEN lower(u.username) = lower(:query) OR u.phone = :query
+                                OR upper(u.referral_code) = upper(:query) THEN 0
+                           WHEN u.username ILIKE :prefix ESCAPE '\\' OR u.phone LIKE :prefix ESCAPE '\\'
+                                OR u.referral_code ILIKE :prefix ESCAPE '\\' THEN 1
+                           ELSE 2
+                       END AS rank
+                FROM users u
+                JOIN referral_network rn ON rn.descendant_id = u.id AND rn.ancestor_id = :sponsor
+                WHERE rn.depth BETWEEN 1 AND :max_depth
+                AND (u.username ILIKE :pattern ESCAPE '\\'
+                     OR u.phone LIKE :pattern ESCAPE '\\'
+                     OR u.referral_code ILIKE :pattern ESCAPE '\\')
+                ORDER BY rank, rn.depth, u.id
+                LIMIT :limit
+            """),
+            {
+                'sponsor': sponsor_id,
+                'query': query,
+                'prefix': _escape_like(query) + '%',
+                'pattern': '%' + _escape_like(query) + '%',
+                'max_depth': max_depth,
+                'limit': limit,
+            },
+        )
+        results = []
+        for row in rows:
+            result = dict(row._mapping)
+            result.pop('rank')
+            results.append(result)
+        return results
+
+    @staticmethod
+    def _search_ngram(sponsor_id: int, query: str, limit: int, max_depth: int,
+                      chunk_size: int = 1000) -> List[Dict[str, Any]]:
+        candidates = downline_ngram_index.candidates(query)
+        if not candidates:
+            return []
+
+        depths = {}
+        scope = text("""
+            SELECT descendant_id, depth FROM referral_network
+            WHERE ancestor_id = :sponsor AND depth BETWEEN 1 AND :max_depth AND descendant_id IN :ids
+        """).bindparams(bindparam('ids', expanding=True))
+        for start in range(0, len(candidates), chunk_size):
+            rows = db.session.execute(
+                scope,
+                {'sponsor': sponsor_id, 'max_depth': max_depth, 'ids': candidates[start:start + chunk_size]},
+            )
+            depths.update((row.descendant_id, row.depth) for row in rows)
+        if not depths:
+            return []
+
+        members = db.session.execute(
+            text("SELECT id, username, phone, referral_code, is_active FROM users WHERE id IN :ids")
+            .bindparams(bindparam('ids', expanding=True)),
+            {'ids': list(depths)},
+        )
+        query = query.lower()
+        results = [dict(row._mapping, level=depths[row.id]) for row in members]
+        results.sort(key=lambda r: (DownlineSearch._rank(r, query), r['level'], r['id']))
+        return results[:limit]
+
+
+# Create a singleton instance per worker process
+downline_ngram_index = NgramIndex()
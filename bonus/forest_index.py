@@ -0,0 +1,247 @@
+# bonus/forest_index.py
+import logging
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import text
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+ROOT = -1     # parent value for users without a (known) sponsor
+ABSENT = -2   # parent value for ids with no user row
+
+
+class ReferralForestIndex:
+    """
+    Compact in-process index of the whole referral forest for analytics and
+    fraud jobs. It never touches referral_network.
+
+    Arrays are indexed by user id (ids are dense autoincrement values):
+      parent  int32  referred_by, ROOT or ABSENT
+      depth   int32  distance from the user's root (-1 if unreachable, i.e. on a cycle)
+      tin     int32  pre-order position in the Euler tour
+      tout    int32  tin + subtree size
+      order   int32  user ids in pre-order, so order[tin[y]:tout[y]] is y's subtree
+
+    That gives O(depth) ancestor walks, O(1) "x in y's subtree" checks and
+    subtree slicing. The tour is built level by level with vectorized NumPy,
+    not a per-node DFS, so chains thousands of levels deep are fine.
+
+    append() adds new signups without rebuilding. Appended users are outside
+    the tour until the next reindex() and are answered by ancestor walks.
+    """
+
+    def __init__(self, parent: np.ndarray, rebuild_threshold: int = 100000):
+        self.parent = parent.astype(np.int32, copy=False)
+        self.rebuild_threshold = rebuild_threshold
+        self._pending: List[int] = []
+        self.unreachable = 0
+        self.build_seconds = 0.0
+        self.reindex()
+
+    # -------------------------
+    # Loading
+    # -------------------------
+    @classmethod
+    def from_db(cls, fetch_size: int = 100000, rebuild_threshold: int = 100000) -> "ReferralForestIndex":
+        """Load (id, referred_by) for every user in one streaming pass"""
+        started = time.monotonic()
+        result = db.session.execute(
+            text("SELECT id, COALESCE(referred_by, -1) AS referred_by FROM users ORDER BY id"),
+            execution_options={'stream_results': True, 'yield_per': fetch_size},
+        )
+
+        id_chunks, parent_chunks = [], []
+        for partition in result.partitions(fetch_size):
+            chunk = np.array(partition, dtype=np.int64).reshape(-1, 2)
+            id_chunks.append(chunk[:, 0])
+            parent_chunks.append(chunk[:, 1])
+
+        ids = np.concatenate(id_chunks) if id_chunks else np.empty(0, dtype=np.int64)
+        parents = np.concatenate(parent_chunks) if parent_chunks else np.empty(0, dtype=np.int64)
+
+        size = int(ids.max()) + 1 if ids.size else 0
+        parent = np.full(size, ABSENT, dtype=np.int32)
+        parent[ids] = parents
+
+        index = cls(parent, rebuild_threshold=rebuild_threshold)
+        logger.info(
+            f"Loaded referral forest: {ids.size} users in {time.monotonic() - started:.2f}s "
+            f"({index.unreachable} unreachable)"
+        )
+        return index
+
+    # -------------------------
+    # Euler tour construction
+    # -------------------------
+    def reindex(self) -> None:
+        """(Re)build depth and the Euler tour from the parent array"""
+        started = time.monotonic()
+        parent = self.parent
+        n = parent.size
+        present = parent != ABSENT
+
+        # A sponsor id with no user row makes its referral a root
+        has_parent = parent >= 0
+        has_parent[has_parent] = present[parent[has_parent]]
+        roots = np.flatnonzero(present & ~has_parent).astype(np.int32)
+
+        # CSR children lists: children grouped by parent, ascending ids within a group
+        child_ids = np.flatnonzero(has_parent).astype(np.int32)
+        child_ids = child_ids[np.argsort(parent[child_ids], kind='stable')]
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.add.at(indptr, parent[child_ids].astype(np.int64) + 1, 1)
+        np.cumsum(indptr, out=indptr)
+
+        # Top-down BFS to collect levels (each level grouped by parent)
+        depth = np.full(n, -1, dtype=np.int32)
+        levels: List[Tuple[np.ndarray, np.ndarray]] = []  # (nodes, per-parent counts of the level above)
+        frontier = roots
+        level = 0
+        while frontier.size:
+            depth[frontier] = level
+            starts = indptr[frontier]
+            counts = indptr[frontier + 1] - starts
+            total = int(counts.sum())
+            if total == 0:
+                break
+            offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total)
+            children = child_ids[offsets]
+            levels.append((children, counts[counts > 0]))
+            frontier = children
+            level += 1
+
+        # Bottom-up subtree sizes
+        size = np.where(depth >= 0, 1, 0).astype(np.int64)
+        for children, _ in reversed(levels):
+            np.add.at(size, parent[children], size[children])
+
+        # Top-down pre-order positions: a child starts after its parent and earlier siblings
+        tin = np.full(n, -1, dtype=np.int64)
+        tin[roots] = np.cumsum(size[roots]) - size[roots]
+        for children, group_counts in levels:
+            child_sizes = size[children]
+            before = np.cumsum(child_sizes) - child_sizes
+            group_base = np.repeat(before[np.cumsum(group_counts) - group_counts], group_counts)
+            tin[children] = tin[parent[children]] + 1 + (before - group_base)
+
+        reached = np.flatnonzero(depth >= 0)
+        order = np.empty(reached.size, dtype=np.int32)
+        order[tin[reached]] = reached
+
+        self.depth = depth
+        self.tin = tin.astype(np.int32)
+        self.tout = np.where(depth >= 0, tin + size, -1).astype(np.int32)
+        self.order = order
+        self.unreachable = int(present.sum() - reached.size)
+        self._pending = []
+        self.build_seconds = time.monotonic() - started
+
+    # -------------------------
+    # Incremental appends
+    # -------------------------
+    def append(self, user_id: int, referrer_id: Optional[int]) -> None:
+        """Add a new signup; it is answered by ancestor walks until the next reindex()"""
+        if user_id >= self.parent.size:
+            self._grow(user_id + 1)
+
+        known_referrer = referrer_id is not None and 0 <= referrer_id < self.parent.size \
+            and self.parent[referrer_id] != ABSENT
+        self.parent[user_id] = referrer_id if known_referrer else ROOT
+        if known_referrer and self.depth[referrer_id] >= 0:
+            self.depth[user_id] = self.depth[referrer_id] + 1
+        else:
+            self.depth[user_id] = 0 if not known_referrer else -1
+        self.tin[user_id] = -1
+        self.tout[user_id] = -1
+        self._pending.append(user_id)
+
+        if len(self._pending) >= self.rebuild_threshold:
+            self.reindex()
+
+    def _grow(self, min_size: int) -> None:
+        new_size = max(min_size, int(self.parent.size * 1.5) + 1)
+        extra = new_size - self.parent.size
+        self.parent = np.concatenate([self.parent, np.full(extra, ABSENT, dtype=np.int32)])
+        self.depth = np.concatenate([self.depth, np.full(extra, -1, dtype=np.int32)])
+        self.tin = np.concatenate([self.tin, np.full(extra, -1, dtype=np.int32)])
+        self.tout = np.concatenate([self.tout, np.full(extra, -1, dtype=np.int32)])
+
+    # -------------------------
+    # Queries
+    # -------------------------
+    def ancestors(self, user_id: int, max_levels: int = 20) -> List[int]:
+        """Sponsor chain, nearest first; O(max_levels)"""
+        chain = []
+        node = self._parent_of(user_id)
+        while node >= 0 and len(chain) < max_levels:
+            chain.append(node)
+            node = self._parent_of(node)
+        return chain
+
+    def is_in_subtree(self, user_id: int, root_id: int) -> bool:
+        """True if user_id is root_id or one of its descendants"""
+        if not (self._known(user_id) and self._known(root_id)):
+            return False
+        if self.tin[user_id] >= 0 and self.tin[root_id] >= 0:
+            return bool(self.tin[root_id] <= self.tin[user_id] < self.tout[root_id])
+
+        # One side was appended after the last reindex: walk up to the tour
+        node, steps = user_id, 0
+        while node >= 0 and steps <= self.parent.size:
+            if node == root_id:
+                return True
+            if self.tin[node] >= 0:
+                if self.tin[root_id] < 0:
+                    return False  # an appended root cannot be above an indexed node
+                return bool(self.tin[root_id] <= self.tin[node] < self.tout[root_id])
+            node = self._parent_of(node)
+            steps += 1
+        return False
+
+    def subtree(self, root_id: int) -> np.ndarray:
+        """All user ids in root_id's subtree (root included), as one array slice plus recent appends"""
+        if not self._known(root_id):
+            return np.empty(0, dtype=np.int32)
+        members = self.order[self.tin[root_id]:self.tout[root_id]] if self.tin[root_id] >= 0 \
+            else np.empty(0, dtype=np.int32)
+        extra = [uid for uid in self._pending if self.is_in_subtree(uid, root_id)]
+        return np.concatenate([members, np.array(extra, dtype=np.int32)]) if extra else members
+
+    def subtree_size(self, root_id: int) -> int:
+        return int(self.subtree(root_id).size)
+
+    def _known(self, user_id: int) -> bool:
+        return 0 <= user_id < self.parent.size and self.parent[user_id] != ABSENT
+
+    def _parent_of(self, user_id: int) -> int:
+        if not self._known(user_id):
+            return ROOT
+        return int(self.parent[user_id])
+
+    # -------------------------
+    # Reporting
+    # -------------------------
+    def memory_footprint(self) -> Dict[str, Any]:
+        arrays = {
+            'parent': self.parent.nbytes,
+            'depth': self.depth.nbytes,
+            'tin': self.tin.nbytes,
+            'tout': self.tout.nbytes,
+            'order': self.order.nbytes,
+        }
+        users = int((self.parent != ABSENT).sum())
+        total = sum(arrays.values())
+        return {
+            'users': users,
+            'unreachable': self.unreachable,
+            'pending_appends': len(self._pending),
+            'arrays_bytes': arrays,
+            'total_bytes': total,
+            'bytes_per_user': round(total / users, 2) if users else 0.0,
+            'mb_per_million_users': round(total / users * 1_000_000 / 2 ** 20, 2) if users else 0.0,
+            'build_seconds': round(self.build_seconds, 3),
+        }
@@ -0,0 +1,317 @@
+# bonus/job_queue.py
+import logging
+import threading
+import traceback
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import text, bindparam
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+
+class DurableJobQueue:
+    """
+    Base for the DB-backed job queues (tree_update_jobs, bonus_jobs).
+
+    Producers insert a job row in the same transaction as the work that
+    needs it, so a crash can never lose it. A bounded per-process pool of
+    workers (greenlets under gevent, threads otherwise) claims due jobs in
+    batches: FOR UPDATE SKIP LOCKED on Postgres, plus a re-checking UPDATE
+    so only one worker gets each row. Failures are retried with
+    exponential backoff up to max_attempts, and jobs left in 'processing'
+    by a dead worker are reclaimed after a lease timeout. stats() exposes
+    queue depth, lag of the oldest open job and processing latency.
+
+    Subclasses set the table, its unique key column and the columns the
+    handler needs, and implement _handle(); _blocker() can hold a job back
+    without running it.
+    """
+
+    table = ''
+    key_column = ''
+    job_columns = ''  # extra columns loaded into each claimed job
+    job_label = 'Job'  # log prefix, followed by the key value
+    worker_name = 'job'
+
+    def __init__(self, workers: int = 2, batch_size: int = 50, poll_interval: float = 2.0,
+                 max_attempts: int = 8, lease_seconds: int = 60):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+
+        self._app = None
+        self._threads: List[threading.Thread] = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+        self.last_latency_seconds: Optional[float] = None
+        self.max_latency_seconds: Optional[float] = None
+
+    # -------------------------
+    # Lifecycle
+    # -------------------------
+    def init_app(self, app) -> None:
+        """Remember the app; workers start lazily with the first request in this process"""
+        self._app = app
+        if self.workers <= 0:
+            return
+
+        @app.before_request
+        def _start_queue_workers():
+            if not self._threads:
+                self.start()
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._threads or self._app is None:
+                return
+            self._stop.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run_worker, name=f"{self.worker_name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            logger.info(f"Started {self.workers} {self.worker_name} workers")
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def wake(self) -> None:
+        """Nudge idle workers after a commit that enqueued jobs"""
+        self._wake.set()
+
+    # -------------------------
+    # Consumer side
+    # -------------------------
+    def _run_worker(self) -> None:
+        while not self._stop.is_set():
+            try:
+                with self._app.app_context():
+                    handled = self.drain_once()
+            except Exception:
+                logger.error(f"{self.worker_name} worker error:\n" + traceback.format_exc())
+                handled = 0
+
+            if handled < self.batch_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def drain_once(self) -> int:
+        """Claim and run one batch; returns how many jobs were handled"""
+        jobs = self._claim_batch()
+        for job in jobs:
+            self._process(job)
+        return len(jobs)
+
+    def drain(self, max_jobs: Optional[int] = None) -> int:
+        """Run batches until the queue has nothing due (used by the replay CLIs)"""
+        total = 0
+        while max_jobs is None or total < max_jobs:
+            handled = self.drain_once()
+            total += handled
+            if handled == 0:
+                break
+        return total
+
+    def _claim_batch(self) -> List[Dict[str, Any]]:
+        now = datetime.now(timezone.utc)
+        params = {
+            'now': now,
+            'stale': now - timedelta(seconds=self.lease_seconds),
+            'limit': self.batch_size,
+        }
+        skip_locked = " FOR UPDATE SKIP LOCKED" if db.engine.dialect.name == 'postgresql' else ""
+
+        rows = db.session.execute(
+            text(f"""
+                SELECT id, {self.job_columns}, attempt_count, created_at
+                FROM {self.table}
+                WHERE (status = 'pending' AND next_attempt <= :now)
+                   OR (status = 'processing' AND locked_at < :stale)
+                ORDER BY id
+                LIMIT :limit{skip_locked}
+            """),
+            params,
+        ).fetchall()
+
+        if not rows:
+            db.session.rollback()
+            return []
+
+        # Re-check the predicate so only the worker that flips a row gets it
+        # (SQLite has no SKIP LOCKED)
+        claimed = set(db.session.execute(
+            text(f"""
+                UPDATE {self.table}
+                SET status = 'processing', locked_at = :now, attempt_count = attempt_count + 1
+                WHERE id IN :ids
+                  AND ((status = 'pending' AND next_attempt <= :now)
+                       OR (status = 'processing' AND locked_at < :stale))
+                RETURNING id
+            """).bindparams(bindparam('ids', expanding=True)),
+            dict(params, ids=[row.id for row in rows]),
+        ).scalars())
+        db.session.commit()
+        return [dict(row._mapping, attempt_count=row.attempt_count + 1) for row in rows if row.id in claimed]
+
+    def _handle(self, job: Dict[str, Any]) -> Optional[str]:
+        """
+        Run one job. On success mark it done (_finish) and commit, then
+        return None; otherwise return the error and the job is retried.
+        """
+        raise NotImplementedError
+
+    def _blocker(self, job: Dict[str, Any]) -> Tuple[Optional[str], bool]:
+        """
+        Why the job can't run yet (None if it can), and whether it is
+        waiting on another open job (see _defer)
+        """
+        return None, False
+
+    def _process(self, job: Dict[str, Any]) -> None:
+        error = None
+        try:
+            blocker, waiting_on_job = self._blocker(job)
+            if blocker:
+                self._defer(job, blocker, waiting_on_job)
+                return
+            error = self._handle(job)
+            if error is None:
+                self._record_latency(job)
+                return
+        except Exception as e:
+            error = str(e)
+
+        db.session.rollback()
+        if job['attempt_count'] >= self.max_attempts:
+            self._finish(job, 'failed', error)
+            self.failed += 1
+            logger.error(f"{self._describe(job)} failed permanently: {error}")
+        else:
+            backoff = min(2 ** job['attempt_count'], 300)
+            db.session.execute(
+                text(f"""
+                    UPDATE {self.table}
+                    SET status = 'pending', locked_at = NULL, last_error = :error, next_attempt = :next_attempt
+                    WHERE id = :id
+                """),
+                {
+                    'id': job['id'],
+                    'error': error,
+                    'next_attempt': datetime.now(timezone.utc) + timedelta(seconds=backoff),
+                },
+            )
+            self.retried += 1
+            logger.warning(f"{self._describe(job)} retrying in {backoff}s: {error}")
+        db.session.commit()
+
+    def _defer(self, job: Dict[str, Any], reason: str, waiting_on_job: bool) -> None:
+        """
+        Put a blocked job back without using up an attempt while the job it
+        waits on is still open; any other blocker counts as a failed
+        attempt, so the job ends up 'failed' and visible to replay rather
+        than waiting forever.
+        """
+        db.session.rollback()
+        if not waiting_on_job and job['attempt_count'] >= self.max_attempts:
+            self._finish(job, 'failed', reason)
+            self.failed += 1
+            logger.error(f"{self._describe(job)} failed permanently: {reason}")
+        else:
+            delay = self.poll_interval if waiting_on_job else min(2 ** job['attempt_count'], 300)
+            db.session.execute(
+                text(f"""
+                    UPDATE {self.table}
+                    SET status = 'pending', locked_at = NULL, last_error = :error, next_attempt = :next_attempt,
+                        attempt_count = attempt_count - :refund
+                    WHERE id = :id
+                """),
+                {
+                    'id': job['id'],
+                    'error': reason,
+                    'next_attempt': datetime.now(timezone.utc) + timedelta(seconds=delay),
+                    'refund': 1 if waiting_on_job else 0,
+                },
+            )
+            logger.info(f"{self._describe(job)} deferred {delay}s: {reason}")
+        db.session.commit()
+
+    def _finish(self, job: Dict[str, Any], status: str, error: Optional[str] = None) -> None:
+        db.session.execute(
+            text(f"""
+                UPDATE {self.table}
+                SET status = :status, locked_at = NULL, last_error = :error, processed_at = :now
+                WHERE id = :id
+            """),
+            {'id': job['id'], 'status': status, 'error': error, 'now': datetime.now(timezone.utc)},
+        )
+
+    def _record_latency(self, job: Dict[str, Any]) -> None:
+        """End-to-end lag: job enqueued to work committed"""
+        self.processed += 1
+        created_at = job['created_at']
+        if isinstance(created_at, datetime):
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            self.last_latency_seconds = (datetime.now(timezone.utc) - created_at).total_seconds()
+            self.max_latency_seconds = max(self.max_latency_seconds or 0.0, self.last_latency_seconds)
+
+    def _describe(self, job: Dict[str, Any]) -> str:
+        return f"{self.job_label} {job[self.key_column]}"
+
+    # -------------------------
+    # Monitoring and replay
+    # -------------------------
+    def stats(self) -> Dict[str, Any]:
+        counts = {
+            row.status: row.jobs
+            for row in db.session.execute(
+                text(f"SELECT status, COUNT(*) AS jobs FROM {self.table} WHERE status <> 'done' GROUP BY status")
+            )
+        }
+        oldest = db.session.execute(
+            text(f"SELECT MIN(created_at) FROM {self.table} WHERE status IN ('pending', 'processing')")
+        ).scalar()
+
+        lag_seconds = 0.0
+        if isinstance(oldest, datetime):
+            if oldest.tzinfo is None:
+                oldest = oldest.replace(tzinfo=timezone.utc)
+            lag_seconds = max((datetime.now(timezone.utc) - oldest).total_seconds(), 0.0)
+
+        return {
+            'pending': counts.get('pending', 0),
+            'processing': counts.get('processing', 0),
+            'failed': counts.get('failed', 0),
+            'lag_seconds': round(lag_seconds, 3),
+            'workers': len(self._threads),
+            'processed_here': self.processed,
+            'retried_here': self.retried,
+            'failed_here': self.failed,
+            'last_latency_seconds': self.last_latency_seconds,
+            'max_latency_seconds': self.max_latency_seconds,
+        }
+
+    @classmethod
+    def _requeue_failed(cls, now: datetime) -> int:
+        """Give every failed job a fresh set of attempts; the caller commits"""
+        return db.session.execute(
+            text(f"""
+                UPDATE {cls.table}
+                SET status = 'pending', attempt_count = 0, next_attempt = :now, locked_at = NULL
+                WHERE status = 'failed'
+            """),
+            {'now': now},
+        ).rowcount or 0
@@ -0,0 +1,330 @@
+# bonus/mega_sponsors.py
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, FrozenSet
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import text, bindparam
+
+from extensions import db
+from bonus.refferral_tree import MAX_REFERRAL_DEPTH
+
+logger = logging.getLogger(__name__)
+
+MEGA_SPONSOR_THRESHOLD = int(os.getenv("MEGA_SPONSOR_THRESHOLD", "50000"))  # 20-level network size
+MEGA_IDS_TTL = 60  # seconds between reloads of the mega sponsor id set
+
+
+class HyperLogLog:
+    """
+    Small mergeable distinct-count sketch (2**precision one-byte registers,
+    ~1.6% error at precision 12). Ids are hashed with splitmix64, so sketches
+    built in different runs merge with np.maximum.
+    """
+
+    def __init__(self, precision: int = 12, registers: Optional[np.ndarray] = None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = registers if registers is not None else np.zeros(self.m, dtype=np.uint8)
+
+    @staticmethod
+    def _hash(values: np.ndarray) -> np.ndarray:
+        z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+    def add_many(self, ids: np.ndarray) -> None:
+        if ids.size == 0:
+            return
+        hashed = self._hash(ids)
+        bits = 64 - self.precision
+        index = (hashed >> np.uint64(bits)).astype(np.int64)
+        rest = hashed & np.uint64((1 << bits) - 1)
+        # rest < 2**52, so float64 log2 is exact
+        rank = np.full(ids.size, bits + 1, dtype=np.uint8)
+        nonzero = rest > 0
+        rank[nonzero] = bits - np.floor(np.log2(rest[nonzero].astype(np.float64))).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        return HyperLogLog(self.precision, np.maximum(self.registers, other.registers))
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * np.log(self.m / zeros)  # linear counting for small sets
+        return int(round(estimate))
+
+
+class MegaSponsorIndex:
+    """
+    High fan-out tree nodes: the system referrer every code-less signup hangs
+    under, plus any sponsor whose 20-level network reaches the threshold.
+
+    For these nodes:
+      - sizes and level breakdowns come from the maintained counters;
+      - active-member counts come from per-level HyperLogLog sketches built
+        by refresh() (estimates, as of refreshed_at); recount() gives the
+        exact figure on demand;
+      - downline pages come from mega_sponsor_downline, a precomputed copy of
+        their closure rows with joined_at / is_active denormalized so
+        filtered keyset pages don't join users row by row.
+
+    New signups are appended to mega_sponsor_downline together with the
+    other counters (NetworkCounterHelper.record_new_member).
+    """
+
+    _ids: FrozenSet[int] = frozenset()
+    _loaded_at = 0.0
+    _lock = threading.Lock()
+
+    # -------------------------
+    # Membership
+    # -------------------------
+    @classmethod
+    def ids(cls) -> FrozenSet[int]:
+        if time.monotonic() - cls._loaded_at > MEGA_IDS_TTL:
+            with cls._lock:
+                cls._ids = frozenset(db.session.execute(text("SELECT user_id FROM mega_sponsors")).scalars())
+                cls._loaded_at = time.monotonic()
+        return cls._ids
+
+    @classmethod
+    def is_mega(cls, user_id: int) -> bool:
+        return user_id in cls.ids()
+
+    @classmethod
+    def forget(cls) -> None:
+        cls._loaded_at = 0.0
+
+    # -------------------------
+    # Signup hook
+    # -------------------------
+    @classmethod
+    def append_member(cls, new_user_id: int) -> None:
+        """Add a freshly placed user to the downline index of each mega ancestor"""
+        cls.append_members([new_user_id])
+
+    @classmethod
+    def append_members(cls, new_user_ids: List[int]) -> None:
+        """Closure-table form of append_member for one or more new users"""
+        if not new_user_ids or not cls.ids():
+            return
+        db.session.execute(
+            text("""
+                INSERT INTO mega_sponsor_downline (ancestor_id, depth, descendant_id, joined_at, is_active)
+                SELECT rn.ancestor_id, rn.depth, rn.descendant_id, u.created_at, COALESCE(u.is_active, TRUE)
+                FROM referral_network rn
+                JOIN mega_sponsors m ON m.user_id = rn.ancestor_id
+                JOIN users u ON u.id = rn.descendant_id
+                WHERE rn.descendant_id IN :ids AND rn.depth > 0
+                ON CONFLICT (ancestor_id, depth, descendant_id) DO NOTHING
+            """).bindparams(bindparam('ids', expanding=True)),
+            {'ids': new_user_ids},
+        )
+
+    # -------------------------
+    # Refresh (nightly job)
+    # -------------------------
+    @classmethod
+    def refresh(cls, threshold: int = MEGA_SPONSOR_THRESHOLD, chunk_size: int = 50000) -> Dict[str, Any]:
+        """Promote / demote mega sponsors, then resync each one's downline index and sketch"""
+        wanted = {
+            row.id: 'fanout'
+            for row in db.session.execute(
+                text("SELECT id FROM users WHERE total_network_size >= :threshold"), {'threshold': threshold}
+            )
+        }
+        system_id = current_app.config.get('SYSTEM_REFERRER_CODE')
+        if system_id:
+            wanted[int(system_id)] = 'system'
+
+        current = set(db.session.execute(text("SELECT user_id FROM mega_sponsors")).scalars())
+        demoted = sorted(current - wanted.keys())
+        if demoted:
+            ids = bindparam('ids', expanding=True)
+            db.session.execute(
+                text("DELETE FROM mega_sponsor_downline WHERE ancestor_id IN :ids").bindparams(ids), {'ids': demoted}
+            )
+            db.session.execute(
+                text("DELETE FROM mega_sponsors WHERE user_id IN :ids").bindparams(ids), {'ids': demoted}
+            )
+        if wanted:
+            db.session.execute(
+                text("""
+                    INSERT INTO mega_sponsors (user_id, reason, network_size, promoted_at)
+                    SELECT id, :reason, COALESCE(total_network_size, 0), :now FROM users WHERE id = :user_id
+                    ON CONFLICT (user_id) DO UPDATE SET reason = EXCLUDED.reason
+                """),
+                [
+                    {'user_id': user_id, 'reason': reason, 'now': datetime.now(timezone.utc)}
+                    for user_id, reason in wanted.items()
+                ],
+            )
+        db.session.commit()
+        cls.forget()
+
+        report = {'mega_sponsors': len(wanted), 'promoted': len(wanted.keys() - current),
+                  'demoted': len(demoted), 'sponsors': []}
+        for user_id in sorted(wanted):
+            report['sponsors'].append(cls.refresh_sponsor(user_id, chunk_size))
+        return report
+
+    @classmethod
+    def refresh_sponsor(cls, user_id: int, chunk_size: int = 50000) -> Dict[str, Any]:
+        """
+        Resync one sponsor's downline index from referral_network (upsert in
+        descendant-id chunks, then drop stale rows) and rebuild its sketch.
+        Readers keep seeing a complete index throughout.
+        """
+        started = time.monotonic()
+        max_id = db.session.execute(
+            text("SELECT COALESCE(MAX(descendant_id), 0) FROM referral_network WHERE ancestor_id = :s"),
+            {'s': user_id},
+        ).scalar() or 0
+
+        upserted = 0
+        for lo in range(1, max_id + 1, chunk_size):
+            upserted += db.session.execute(
+                text("""
+                    INSERT INTO mega_sponsor_downline (ancestor_id, depth, descendant_id, joined_at, is_active)
+                    SELECT rn.ancestor_id, rn.depth, rn.descendant_id, u.created_at, COALESCE(u.is_active, TRUE)
+                    FROM referral_network rn
+                    JOIN users u ON u.id = rn.descendant_id
+                    WHERE rn.ancestor_id = :s AND rn.depth BETWEEN 1 AND :max_depth
+                    AND rn.descendant_id BETWEEN :lo AND :hi
+                    ON CONFLICT (ancestor_id, depth, descendant_id)
+                    DO UPDATE SET is_active = EXCLUDED.is_active, joined_at = EXCLUDED.joined_at
+                """),
+                {'s': user_id, 'max_depth': MAX_REFERRAL_DEPTH, 'lo': lo, 'hi': lo + chunk_size - 1},
+            ).rowcount or 0
+            db.session.commit()
+
+        removed = db.session.execute(
+            text("""
+                DELETE FROM mega_sponsor_downline
+                WHERE ancestor_id = :s AND NOT EXISTS (
+                    SELECT 1 FROM referral_network rn
+                    WHERE rn.ancestor_id = mega_sponsor_downline.ancestor_id
+                    AND rn.descendant_id = mega_sponsor_downline.descendant_id
+                    AND rn.depth = mega_sponsor_downline.depth
+                )
+            """),
+            {'s': user_id},
+        ).rowcount or 0
+        db.session.commit()
+
+        sketches = cls._build_sketches(user_id, chunk_size)
+        merged = HyperLogLog()
+        for sketch in sketches:
+            merged = merged.merge(sketch)
+        db.session.execute(
+            text("""
+                UPDATE mega_sponsors SET
+                    active_sketch = :sketch,
+                    active_estimate = :estimate,
+                    network_size = (SELECT COALESCE(total_network_size, 0) FROM users WHERE id = :s),
+                    refreshed_at = :now
+                WHERE user_id = :s
+            """).bindparams(bindparam('sketch', type_=db.LargeBinary)),
+            {
+                's': user_id,
+                'sketch': np.stack([sketch.registers for sketch in sketches]).tobytes(),
+                'estimate': merged.count(),
+                'now': datetime.now(timezone.utc),
+            },
+        )
+        db.session.commit()
+
+        return {
+            'user_id': user_id,
+            'rows_upserted': upserted,
+            'rows_removed': removed,
+            'active_estimate': merged.count(),
+            'seconds': round(time.monotonic() - started, 3),
+        }
+
+    @staticmethod
+    def _build_sketches(user_id: int, fetch_size: int) -> List[HyperLogLog]:
+        sketches = [HyperLogLog() for _ in range(MAX_REFERRAL_DEPTH)]
+        result = db.session.execute(
+            text("""
+                SELECT depth, descendant_id FROM mega_sponsor_downline
+                WHERE ancestor_id = :s AND is_active = TRUE
+            """),
+            {'s': user_id},
+            execution_options={'stream_results': True, 'yield_per': fetch_size},
+        )
+        for partition in result.partitions(fetch_size):
+            chunk = np.array(partition, dtype=np.int64).reshape(-1, 2)
+            for depth in np.unique(chunk[:, 0]):
+                if 1 <= depth <= MAX_REFERRAL_DEPTH:
+                    sketches[depth - 1].add_many(chunk[chunk[:, 0] == depth, 1])
+        return sketches
+
+    # -------------------------
+    # Counts
+    # -------------------------
+    @staticmethod
+    def counts(user_id: int, min_depth: int = 1, max_depth: int = MAX_REFERRAL_DEPTH) -> Optional[Dict[str, Any]]:
+        """Counter- and sketch-based figures for a mega sponsor (None if it isn't one)"""
+        from bonus.network_counters import NetworkCounterHelper
+
+        row = db.session.execute(
+            text("""
+                SELECT m.reason, m.active_sketch, m.active_estimate, m.exact_active_members,
+                       m.refreshed_at, m.recounted_at, COALESCE(u.total_network_size, 0) AS total_network_size,
+                       COALESCE(u.direct_referrals_count, 0) AS direct_referrals_count
+                FROM mega_sponsors m JOIN users u ON u.id = m.user_id
+                WHERE m.user_id = :s
+            """),
+            {'s': user_id},
+        ).first()
+        if row is None:
+            return None
+
+        active_estimate = row.active_estimate
+        if row.active_sketch and (min_depth, max_depth) != (1, MAX_REFERRAL_DEPTH):
+            registers = np.frombuffer(row.active_sketch, dtype=np.uint8).reshape(MAX_REFERRAL_DEPTH, -1)
+            merged = registers[max(min_depth, 1) - 1:min(max_depth, MAX_REFERRAL_DEPTH)].max(axis=0)
+            active_estimate = HyperLogLog(registers=merged.copy()).count()
+
+        level_breakdown = NetworkCounterHelper.get_level_breakdown(user_id)
+        return {
+            'user_id': user_id,
+            'reason': row.reason,
+            'total_network_size': row.total_network_size,
+            'direct_referrals_count': row.direct_referrals_count,
+            'level_breakdown': level_breakdown,
+            'members_in_range': sum(c for d, c in level_breakdown.items() if min_depth <= d <= max_depth),
+            'active_members_estimate': active_estimate,
+            'exact_active_members': row.exact_active_members,
+            'refreshed_at': row.refreshed_at,
+            'recounted_at': row.recounted_at,
+        }
+
+    @staticmethod
+    def recount(user_id: int) -> Dict[str, Any]:
+        """Exact active-member count from the closure table (expensive; on demand only)"""
+        started = time.monotonic()
+        exact = db.session.execute(
+            text("""
+                SELECT COUNT(*) FROM referral_network rn
+                JOIN users u ON u.id = rn.descendant_id
+                WHERE rn.ancestor_id = :s AND rn.depth BETWEEN 1 AND :max_depth AND u.is_active = TRUE
+            """),
+            {'s': user_id, 'max_depth': MAX_REFERRAL_DEPTH},
+        ).scalar() or 0
+        db.session.execute(
+            text("UPDATE mega_sponsors SET exact_active_members = :exact, recounted_at = :now WHERE user_id = :s"),
+            {'s': user_id, 'exact': exact, 'now': datetime.now(timezone.utc)},
+        )
+        db.session.commit()
+        return {'user_id': user_id, 'exact_active_members': exact, 'seconds': round(time.monotonic() - started, 3)}
@@ -0,0 +1,543 @@
+# bonus/network_counters.py
+import logging
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Any, List, Tuple
+
+from sqlalchemy import text, bindparam
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+
+class NetworkCounterHelper:
+    """
+    Incrementally maintained downline counters.
+
+    users.total_network_size / direct_referrals_count / network_depth and
+    referral_level_counts(ancestor_id, depth, member_count) are bumped in
+    the same transaction that writes a new user's closure rows, so network
+    size and per-level breakdowns are O(1) reads instead of subtree scans.
+    Daily growth buckets (GrowthCounterHelper) are bumped alongside.
+    """
+
+    @staticmethod
+    def record_new_member(new_user_id: int, referrer_id: int) -> None:
+        """
+        Bump counters for every (<= 20 level) ancestor of a freshly inserted user.
+        Must run after the new user's closure rows exist, inside the same transaction.
+        """
+        params = {"new_id": new_user_id, "ref_id": referrer_id}
+
+        # One set-based UPDATE for all ancestors
+        db.session.execute(
+            text(
+                """
+                UPDATE users SET
+                    total_network_size = COALESCE(total_network_size, 0) + 1,
+                    direct_referrals_count = COALESCE(direct_referrals_count, 0)
+                        + CASE WHEN id = :ref_id THEN 1 ELSE 0 END
+                WHERE id IN (
+                    SELECT ancestor_id FROM referral_network
+                    WHERE descendant_id = :new_id AND depth > 0
+                )
+                """
+            ),
+            params,
+        )
+
+        db.session.execute(
+            text(
+                """
+                INSERT INTO referral_level_counts (ancestor_id, depth, member_count)
+                SELECT ancestor_id, depth, 1
+                FROM referral_network
+                WHERE descendant_id = :new_id AND depth > 0
+                ON CONFLICT (ancestor_id, depth)
+                DO UPDATE SET member_count = referral_level_counts.member_count + 1
+                """
+            ),
+            params,
+        )
+
+        db.session.execute(
+            text(
+                """
+                INSERT INTO referral_level_growth (ancestor_id, period, bucket_start, depth, member_count)
+                SELECT ancestor_id, 'day', :day, depth, 1
+                FROM referral_network
+                WHERE descendant_id = :new_id AND depth > 0
+                ON CONFLICT (ancestor_id, period, bucket_start, depth)
+                DO UPDATE SET member_count = referral_level_growth.member_count + 1
+                """
+            ),
+            dict(params, day=GrowthCounterHelper.joined_day(new_user_id)),
+        )
+
+        db.session.execute(
+            text(
+                """
+                UPDATE users SET network_depth = (
+                    SELECT COALESCE(MAX(depth), 0) FROM referral_network WHERE descendant_id = :new_id
+                )
+                WHERE id = :new_id
+                """
+            ),
+            params,
+        )
+        from bonus.mega_sponsors import MegaSponsorIndex
+        MegaSponsorIndex.append_member(new_user_id)
+
+    @staticmethod
+    def record_new_members(new_user_ids: List[int], chunk_size: int = 1000) -> int:
+        """
+        Bulk form of record_new_member for imports: aggregate the new users'
+        closure rows per (ancestor, depth) and apply each delta once. Growth
+        buckets go to each member's own signup day, so imported and replayed
+        historical signups don't land on today.
+        Returns the number of ancestors whose counters changed.
+        """
+        from bonus.mega_sponsors import MegaSponsorIndex
+
+        level_deltas: Dict[Tuple[int, int], int] = {}
+        growth_deltas: Dict[date, Dict[Tuple[int, int], int]] = {}
+        ids_param = bindparam('ids', expanding=True)
+        joined_day = GrowthCounterHelper._day_expr("u.created_at")
+
+        for start in range(0, len(new_user_ids), chunk_size):
+            chunk = new_user_ids[start:start + chunk_size]
+            rows = db.session.execute(
+                text(
+                    f"""
+                    SELECT rn.ancestor_id, rn.depth, {joined_day} AS joined_day, COUNT(*) AS members
+                    FROM referral_network rn
+                    JOIN users u ON u.id = rn.descendant_id
+                    WHERE rn.descendant_id IN :ids AND rn.depth > 0
+                    GROUP BY rn.ancestor_id, rn.depth, {joined_day}
+                    """
+                ).bindparams(ids_param),
+                {"ids": chunk},
+            )
+            for row in rows:
+                key = (row.ancestor_id, row.depth)
+                level_deltas[key] = level_deltas.get(key, 0) + row.members
+                day_deltas = growth_deltas.setdefault(GrowthCounterHelper.as_day(row.joined_day), {})
+                day_deltas[key] = day_deltas.get(key, 0) + row.members
+
+            db.session.execute(
+                text(
+                    """
+                    UPDATE users SET network_depth = (
+                        SELECT COALESCE(MAX(depth), 0) FROM referral_network WHERE descendant_id = users.id
+                    )
+                    WHERE id IN :ids
+                    """
+                ).bindparams(ids_param),
+                {"ids": chunk},
+            )
+            MegaSponsorIndex.append_members(chunk)
+
+        for day, day_deltas in growth_deltas.items():
+            GrowthCounterHelper.bump(day_deltas, day)
+        return NetworkCounterHelper.apply_level_deltas(level_deltas)
+
+    @staticmethod
+    def apply_level_deltas(level_deltas: Dict[Tuple[int, int], int]) -> int:
+        """
+        Apply signed per-(ancestor, depth) member deltas to users and
+        referral_level_counts. Used by bulk imports and subtree moves.
+        Returns the number of ancestors whose counters changed.
+        """
+        level_deltas = {key: members for key, members in level_deltas.items() if members}
+        if not level_deltas:
+            return 0
+
+        user_deltas: Dict[int, Dict[str, int]] = {}
+        for (ancestor_id, depth), members in level_deltas.items():
+            delta = user_deltas.setdefault(ancestor_id, {'id': ancestor_id, 'total': 0, 'direct': 0})
+            delta['total'] += members
+            if depth == 1:
+                delta['direct'] += members
+
+        db.session.execute(
+            text(
+                """
+                UPDATE users SET
+                    total_network_size = COALESCE(total_network_size, 0) + :total,
+                    direct_referrals_count = COALESCE(direct_referrals_count, 0) + :direct
+                WHERE id = :id
+                """
+            ),
+            list(user_deltas.values()),
+        )
+
+        db.session.execute(
+            text(
+                """
+                INSERT INTO referral_level_counts (ancestor_id, depth, member_count)
+                VALUES (:ancestor_id, :depth, :members)
+                ON CONFLICT (ancestor_id, depth)
+                DO UPDATE SET member_count = referral_level_counts.member_count + EXCLUDED.member_count
+                """
+            ),
+            [
+                {'ancestor_id': ancestor_id, 'depth': depth, 'members': members}
+                for (ancestor_id, depth), members in level_deltas.items()
+            ],
+        )
+        return len(user_deltas)
+
+    @staticmethod
+    def get_level_breakdown(user_id: int) -> Dict[int, int]:
+        """Downline size per depth, e.g. {1: 5, 2: 25, 3: 120}"""
+        rows = db.session.execute(
+            text(
+                """
+                SELECT depth, member_count FROM referral_level_counts
+                WHERE ancestor_id = :user_id AND member_count > 0
+                ORDER BY depth
+                """
+            ),
+            {"user_id": user_id},
+        )
+        return {row.depth: row.member_count for row in rows}
+
+    @staticmethod
+    def verify_counters(fix: bool = False, chunk_size: int = 5000,
+                        sample_limit: int = 100) -> Dict[str, Any]:
+        """
+        Recompute counters from referral_network in id-ordered chunks and report drift.
+        With fix=True the drifting users' counters and level counts are rewritten.
+        """
+        report = {
+            'users_checked': 0,
+            'users_drifted': 0,
+            'level_rows_drifted': 0,
+            'fixed': fix,
+            'samples': [],
+        }
+
+        max_id = db.session.execute(text("SELECT COALESCE(MAX(id), 0) FROM users")).scalar() or 0
+        lo = 1
+        while lo <= max_id:
+            hi = lo + chunk_size - 1
+            NetworkCounterHelper._verify_chunk(lo, hi, fix, report, sample_limit)
+            if fix:
+                db.session.commit()
+            lo = hi + 1
+
+        logger.info(
+            f"Network counter verification: {report['users_drifted']}/{report['users_checked']} users drifted, "
+            f"{report['level_rows_drifted']} level rows drifted, fix={fix}"
+        )
+        return report
+
+    @staticmethod
+    def _verify_chunk(lo: int, hi: int, fix: bool, report: Dict[str, Any], sample_limit: int) -> None:
+        params = {"lo": lo, "hi": hi}
+
+        expected_levels: Dict[int, Dict[int, int]] = {}
+        for row in db.session.execute(
+            text(
+                """
+                SELECT ancestor_id, depth, COUNT(*) AS member_count
+                FROM referral_network
+                WHERE ancestor_id BETWEEN :lo AND :hi AND depth > 0
+                GROUP BY ancestor_id, depth
+                """
+            ),
+            params,
+        ):
+            expected_levels.setdefault(row.ancestor_id, {})[row.depth] = row.member_count
+
+        stored_levels: Dict[int, Dict[int, int]] = {}
+        for row in db.session.execute(
+            text(
+                """
+                SELECT ancestor_id, depth, member_count FROM referral_level_counts
+                WHERE ancestor_id BETWEEN :lo AND :hi AND member_count > 0
+                """
+            ),
+            params,
+        ):
+            stored_levels.setdefault(row.ancestor_id, {})[row.depth] = row.member_count
+
+        depths = {
+            row.descendant_id: row.depth
+            for row in db.session.execute(
+                text(
+                    """
+                    SELECT descendant_id, MAX(depth) AS depth FROM referral_network
+                    WHERE descendant_id BETWEEN :lo AND :hi
+                    GROUP BY descendant_id
+                    """
+                ),
+                params,
+            )
+        }
+
+        users = db.session.execute(
+            text(
+                """
+                SELECT id, total_network_size, direct_referrals_count, network_depth
+                FROM users WHERE id BETWEEN :lo AND :hi
+                """
+            ),
+            params,
+        ).fetchall()
+
+        user_fixes: List[Dict[str, Any]] = []
+        level_fix_ids: List[int] = []
+
+        for user in users:
+            report['users_checked'] += 1
+            levels = expected_levels.get(user.id, {})
+            expected = {
+                'total_network_size': sum(levels.values()),
+                'direct_referrals_count': levels.get(1, 0),
+                'network_depth': depths.get(user.id, 0),
+            }
+            stored = {
+                'total_network_size': user.total_network_size or 0,
+                'direct_referrals_count': user.direct_referrals_count or 0,
+                'network_depth': user.network_depth or 0,
+            }
+
+            level_diff = NetworkCounterHelper._diff_levels(levels, stored_levels.get(user.id, {}))
+            if expected == stored and not level_diff:
+                continue
+
+            report['users_drifted'] += 1
+            report['level_rows_drifted'] += len(level_diff)
+            if len(report['samples']) < sample_limit:
+                report['samples'].append({
+                    'user_id': user.id,
+                    'expected': expected,
+                    'stored': stored,
+                    'level_diff': level_diff,
+                })
+
+            if expected != stored:
+                user_fixes.append({'id': user.id, **expected})
+            if level_diff:
+                level_fix_ids.append(user.id)
+
+        if fix:
+            NetworkCounterHelper._apply_fixes(user_fixes, level_fix_ids, expected_levels)
+
+    @staticmethod
+    def _diff_levels(expected: Dict[int, int], stored: Dict[int, int]) -> Dict[int, Dict[str, int]]:
+        return {
+            depth: {'expected': expected.get(depth, 0), 'stored': stored.get(depth, 0)}
+            for depth in set(expected) | set(stored)
+            if expected.get(depth, 0) != stored.get(depth, 0)
+        }
+
+    @staticmethod
+    def _apply_fixes(user_fixes: List[Dict[str, Any]], level_fix_ids: List[int],
+                     expected_levels: Dict[int, Dict[int, int]]) -> None:
+        if user_fixes:
+            db.session.execute(
+                text(
+                    """
+                    UPDATE users SET
+                        total_network_size = :total_network_size,
+                        direct_referrals_count = :direct_referrals_count,
+                        network_depth = :network_depth
+                    WHERE id = :id
+                    """
+                ),
+                user_fixes,
+            )
+
+        if level_fix_ids:
+            db.session.execute(
+                text("DELETE FROM referral_level_counts WHERE ancestor_id = :id"),
+                [{'id': uid} for uid in level_fix_ids],
+            )
+            rows = [
+                {'ancestor_id': uid, 'depth': depth, 'member_count': count}
+                for uid in level_fix_ids
+                for depth, count in expected_levels.get(uid, {}).items()
+            ]
+            if rows:
+                db.session.execute(
+                    text(
+                        """
+                        INSERT INTO referral_level_counts (ancestor_id, depth, member_count)
+                        VALUES (:ancestor_id, :depth, :member_count)
+                        """
+                    ),
+                    rows,
+                )
+
+
+class GrowthCounterHelper:
+    """
+    New members per (ancestor, depth, day) in referral_level_growth.
+
+    Day buckets are bumped together with the other counters when a user is
+    placed in the tree, so "new members per level per day" reads a bounded
+    range of buckets instead of scanning the subtree. compact() folds day
+    buckets older than the retention window into one bucket per month.
+    Subtree moves do not touch these counters: they count joins, not moves.
+    """
+
+    @staticmethod
+    def joined_day(user_id: int) -> date:
+        """UTC signup date of a user (today if unknown)"""
+        created_at = db.session.execute(
+            text("SELECT created_at FROM users WHERE id = :user_id"), {"user_id": user_id}
+        ).scalar()
+        return GrowthCounterHelper.as_day(created_at)
+
+    @staticmethod
+    def as_day(value) -> date:
+        """UTC date of a created_at / day value as the driver returns it (today if unknown)"""
+        if isinstance(value, str):  # SQLite returns raw strings
+            value = datetime.fromisoformat(value)
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc)
+            return value.date()
+        if isinstance(value, date):
+            return value
+        return datetime.now(timezone.utc).date()
+
+    @staticmethod
+    def bump(level_deltas: Dict[Tuple[int, int], int], day: date) -> None:
+        rows = [
+            {"ancestor_id": ancestor_id, "depth": depth, "members": members, "day": day}
+            for (ancestor_id, depth), members in level_deltas.items() if members
+        ]
+        if not rows:
+            return
+        db.session.execute(
+            text(
+                """
+                INSERT INTO referral_level_growth (ancestor_id, period, bucket_start, depth, member_count)
+                VALUES (:ancestor_id, 'day', :day, :depth, :members)
+                ON CONFLICT (ancestor_id, period, bucket_start, depth)
+                DO UPDATE SET member_count = referral_level_growth.member_count + EXCLUDED.member_count
+                """
+            ),
+            rows,
+        )
+
+    @staticmethod
+    def get_growth(ancestor_id: int, start: date, end: date) -> List[Dict[str, Any]]:
+        """
+        Buckets overlapping [start, end], oldest first:
+        [{'bucket_start': '2026-10-01', 'period': 'day', 'levels': {1: 3, 2: 11}}, ...]
+        Month buckets are returned whole, so a range reaching into compacted
+        history includes that entire month.
+        """
+        rows = db.session.execute(
+            text(
+                """
+                SELECT period, bucket_start, depth, member_count
+                FROM referral_level_growth
+                WHERE ancestor_id = :ancestor_id
+                AND ((period = 'day' AND bucket_start BETWEEN :start AND :end)
+                     OR (period = 'month' AND bucket_start BETWEEN :month_start AND :end))
+                ORDER BY bucket_start, period, depth
+                """
+            ),
+            {"ancestor_id": ancestor_id, "start": start, "end": end, "month_start": start.replace(day=1)},
+        )
+        buckets: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for row in rows:
+            bucket_start = row.bucket_start.isoformat() if hasattr(row.bucket_start, "isoformat") else row.bucket_start
+            bucket = buckets.setdefault(
+                (bucket_start, row.period), {"bucket_start": bucket_start, "period": row.period, "levels": {}}
+            )
+            bucket["levels"][row.depth] = row.member_count
+        return list(buckets.values())
+
+    @staticmethod
+    def _day_expr(column: str) -> str:
+        if db.engine.dialect.name == "postgresql":
+            return f"CAST(({column}) AT TIME ZONE 'UTC' AS DATE)"
+        return f"date({column})"
+
+    @staticmethod
+    def _month_expr(column: str) -> str:
+        if db.engine.dialect.name == "postgresql":
+            return f"CAST(date_trunc('month', {column}) AS DATE)"
+        return f"date({column}, 'start of month')"
+
+    @staticmethod
+    def backfill(chunk_size: int = 5000) -> int:
+        """
+        Rebuild all buckets from referral_network and users.created_at, one
+        ancestor id range per transaction. Returns the number of day buckets written.
+        """
+        max_id = db.session.execute(text("SELECT COALESCE(MAX(id), 0) FROM users")).scalar() or 0
+        joined_day = GrowthCounterHelper._day_expr("u.created_at")
+        written = 0
+
+        for lo in range(1, max_id + 1, chunk_size):
+            params = {"lo": lo, "hi": lo + chunk_size - 1}
+            db.session.execute(
+                text("DELETE FROM referral_level_growth WHERE ancestor_id BETWEEN :lo AND :hi"), params
+            )
+            written += db.session.execute(
+                text(
+                    f"""
+                    INSERT INTO referral_level_growth (ancestor_id, period, bucket_start, depth, member_count)
+                    SELECT rn.ancestor_id, 'day', {joined_day}, rn.depth, COUNT(*)
+                    FROM referral_network rn
+                    JOIN users u ON u.id = rn.descendant_id
+                    WHERE rn.ancestor_id BETWEEN :lo AND :hi AND rn.depth > 0 AND u.created_at IS NOT NULL
+                    GROUP BY rn.ancestor_id, {joined_day}, rn.depth
+                    """
+                ),
+                params,
+            ).rowcount or 0
+            db.session.commit()
+
+        logger.info(f"Backfilled {written} daily growth buckets")
+        return written
+
+    @staticmethod
+    def compact(keep_days: int = 90, chunk_size: int = 5000) -> int:
+        """
+        Fold day buckets from months that ended before `keep_days` ago into
+        month buckets. Returns the number of day buckets removed.
+        """
+        cutoff = (datetime.now(timezone.utc).date() - timedelta(days=keep_days)).replace(day=1)
+        month = GrowthCounterHelper._month_expr("bucket_start")
+        max_id = db.session.execute(
+            text("SELECT COALESCE(MAX(ancestor_id), 0) FROM referral_level_growth")
+        ).scalar() or 0
+        removed = 0
+
+        for lo in range(1, max_id + 1, chunk_size):
+            params = {"lo": lo, "hi": lo + chunk_size - 1, "cutoff": cutoff}
+            db.session.execute(
+                text(
+                    f"""
+                    INSERT INTO referral_level_growth (ancestor_id, period, bucket_start, depth, member_count)
+                    SELECT ancestor_id, 'month', {month}, depth, SUM(member_count)
+                    FROM referral_level_growth
+                    WHERE period = 'day' AND bucket_start < :cutoff AND ancestor_id BETWEEN :lo AND :hi
+                    GROUP BY ancestor_id, {month}, depth
+                    ON CONFLICT (ancestor_id, period, bucket_start, depth)
+                    DO UPDATE SET member_count = referral_level_growth.member_count + EXCLUDED.member_count
+                    """
+                ),
+                params,
+            )
+            removed += db.session.execute(
+                text(
+                    """
+                    DELETE FROM referral_level_growth
+                    WHERE period = 'day' AND bucket_start < :cutoff AND ancestor_id BETWEEN :lo AND :hi
+                    """
+                ),
+                params,
+            ).rowcount or 0
+            db.session.commit()
+
+        logger.info(f"Compacted {removed} daily growth buckets older than {cutoff} into months")
+        return removed
@@ -0,0 +1,165 @@
+# bonus/network_snapshots.py
+import logging
+import resource
+import time
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from typing import Dict, Any, Optional, Callable, List
+
+from sqlalchemy import text, bindparam
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+
+class NetworkSnapshotBuilder:
+    """
+    Builds the daily network_snapshots rows for every user with a downline.
+
+    Works over ancestor id ranges so memory stays flat. Each chunk needs two
+    grouped scans of referral_network: one for per-depth member counts and
+    active members, and one joined to active packages for investment. The
+    rows are upserted on uq_daily_snapshot, so re-running a day overwrites
+    it instead of failing.
+    """
+
+    UPSERT_SQL = text(
+        """
+        INSERT INTO network_snapshots
+            (user_id, snapshot_date, total_downline, active_downline, direct_referrals,
+             network_investment, level_breakdown)
+        VALUES
+            (:user_id, :snapshot_date, :total_downline, :active_downline, :direct_referrals,
+             :network_investment, :level_breakdown)
+        ON CONFLICT (user_id, snapshot_date) DO UPDATE SET
+            total_downline = EXCLUDED.total_downline,
+            active_downline = EXCLUDED.active_downline,
+            direct_referrals = EXCLUDED.direct_referrals,
+            network_investment = EXCLUDED.network_investment,
+            level_breakdown = EXCLUDED.level_breakdown
+        """
+    ).bindparams(
+        bindparam('network_investment', type_=db.Numeric(18, 2)),
+        bindparam('level_breakdown', type_=db.JSON),
+    )
+
+    def __init__(self, snapshot_date: Optional[date] = None, chunk_size: int = 5000,
+                 progress: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.snapshot_date = snapshot_date or datetime.now(timezone.utc).date()
+        self.chunk_size = chunk_size
+        self.progress = progress or self._log_progress
+
+    def run(self) -> Dict[str, Any]:
+        """Snapshot every user's network for snapshot_date and return a throughput report"""
+        started = time.monotonic()
+        max_id = db.session.execute(text("SELECT COALESCE(MAX(id), 0) FROM users")).scalar() or 0
+
+        report = {
+            'snapshot_date': self.snapshot_date.isoformat(),
+            'users_scanned': int(max_id),
+            'rows_written': 0,
+            'elapsed_seconds': 0.0,
+            'rows_per_sec': 0.0,
+            'peak_memory_mb': 0.0,
+        }
+
+        lo = 1
+        while lo <= max_id:
+            hi = min(lo + self.chunk_size - 1, max_id)
+            rows = self._build_chunk(lo, hi)
+            if rows:
+                db.session.execute(self.UPSERT_SQL, rows)
+            db.session.commit()
+
+            report['rows_written'] += len(rows)
+            elapsed = time.monotonic() - started
+            self.progress({
+                'last_user_id': hi,
+                'max_user_id': max_id,
+                'chunk_rows': len(rows),
+                'rows_written': report['rows_written'],
+                'rows_per_sec': report['rows_written'] / elapsed if elapsed else 0.0,
+            })
+            lo = hi + 1
+
+        elapsed = time.monotonic() - started
+        report['elapsed_seconds'] = round(elapsed, 3)
+        report['rows_per_sec'] = round(report['rows_written'] / elapsed, 1) if elapsed else 0.0
+        report['peak_memory_mb'] = round(self._peak_memory_mb(), 1)
+
+        logger.info(
+            f"Network snapshots for {report['snapshot_date']}: {report['rows_written']} rows in "
+            f"{report['elapsed_seconds']}s ({report['rows_per_sec']} rows/s, peak {report['peak_memory_mb']} MB)"
+        )
+        return report
+
+    def _build_chunk(self, lo: int, hi: int) -> List[Dict[str, Any]]:
+        params = {'lo': lo, 'hi': hi}
+        snapshots: Dict[int, Dict[str, Any]] = {}
+
+        level_rows = db.session.execute(
+            text(
+                """
+                SELECT rn.ancestor_id, rn.depth,
+                       COUNT(*) AS members,
+                       SUM(CASE WHEN u.is_active THEN 1 ELSE 0 END) AS active_members
+                FROM referral_network rn
+                JOIN users u ON u.id = rn.descendant_id
+                WHERE rn.ancestor_id BETWEEN :lo AND :hi AND rn.depth > 0
+                GROUP BY rn.ancestor_id, rn.depth
+                """
+            ),
+            params,
+        )
+        for row in level_rows:
+            snap = snapshots.get(row.ancestor_id)
+            if snap is None:
+                snap = snapshots[row.ancestor_id] = {
+                    'user_id': row.ancestor_id,
+                    'snapshot_date': self.snapshot_date,
+                    'total_downline': 0,
+                    'active_downline': 0,
+                    'direct_referrals': 0,
+                    'network_investment': Decimal('0'),
+                    'level_breakdown': {},
+                }
+            snap['total_downline'] += row.members
+            snap['active_downline'] += int(row.active_members or 0)
+            snap['level_breakdown'][str(row.depth)] = row.members
+            if row.depth == 1:
+                snap['direct_referrals'] = row.members
+
+        if not snapshots:
+            return []
+
+        investment_rows = db.session.execute(
+            text(
+                """
+                SELECT rn.ancestor_id, SUM(p.package_amount) AS investment
+                FROM referral_network rn
+                JOIN packages p ON p.user_id = rn.descendant_id AND p.status = 'active'
+                WHERE rn.ancestor_id BETWEEN :lo AND :hi AND rn.depth > 0
+                GROUP BY rn.ancestor_id
+                """
+            ),
+            params,
+        )
+        for row in investment_rows:
+            snap = snapshots.get(row.ancestor_id)
+            if snap is not None:
+                snap['network_investment'] = Decimal(str(row.investment or 0))
+
+        return list(snapshots.values())
+
+    @staticmethod
+    def _peak_memory_mb() -> float:
+        # ru_maxrss is reported in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    @staticmethod
+    def _log_progress(progress: Dict[str, Any]) -> None:
+        logger.info(
+            f"Snapshots: users <= {progress['last_user_id']}/{progress['max_user_id']}, "
+            f"{progress['rows_written']} rows, {progress['rows_per_sec']:.0f} rows/s"
+        )
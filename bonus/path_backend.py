@@ -0,0 +1,298 @@
+# bonus/path_backend.py
+import logging
+from typing import List, Dict, Any, Optional, Tuple
+
+from flask import current_app
+from sqlalchemy import text, bindparam
+
+from extensions import db
+from models import AncestorPath
+from bonus.cache_strategy import ancestor_cache, tree_node_cache
+from bonus.network_counters import NetworkCounterHelper, GrowthCounterHelper
+from bonus.mega_sponsors import MegaSponsorIndex
+from bonus.refferral_tree import MAX_REFERRAL_DEPTH
+
+logger = logging.getLogger(__name__)
+
+class MaterializedPathBackend:
+    """
+    Referral tree storage as one capped ancestor path per user
+    (users.ancestor_path, nearest sponsor first) instead of up to 21
+    referral_network rows.
+
+    Not wired into ReferralTreeHelper: the app reads and writes the closure
+    table only. bench_tree_backends.py drives this class directly to compare
+    the two layouts, and backfill_paths() fills the column from
+    referral_network for such a run. Costs per operation:
+      - insert: one single-row read of the sponsor's path, one UPDATE
+      - ancestors / is_descendant: one primary-key fetch of the path
+      - descendants: `ancestor_path @> ARRAY[id]` on a GIN index
+        (Postgres); a LIKE scan on SQLite, which is fine for dev only
+
+    A root user has an empty path. NULL means "not placed yet".
+    """
+
+    PATH_COLUMNS = {'ancestor_path': AncestorPath()}
+
+    @staticmethod
+    def get_path(user_id: int) -> Optional[List[int]]:
+        row = db.session.execute(
+            text("SELECT ancestor_path, referred_by FROM users WHERE id = :user_id")
+            .columns(**MaterializedPathBackend.PATH_COLUMNS),
+            {'user_id': user_id},
+        ).first()
+        if row is None:
+            return None
+        if row.ancestor_path is None and row.referred_by is None:
+            return []  # never-initialized root
+        return row.ancestor_path
+
+    @staticmethod
+    def set_path(user_id: int, path: List[int], only_if_unset: bool = False) -> int:
+        sql = "UPDATE users SET ancestor_path = :path WHERE id = :user_id"
+        if only_if_unset:
+            sql += " AND ancestor_path IS NULL"
+        return db.session.execute(
+            text(sql).bindparams(bindparam('path', type_=AncestorPath())),
+            {'path': path[:MAX_REFERRAL_DEPTH], 'user_id': user_id},
+        ).rowcount or 0
+
+    @staticmethod
+    def add_user(new_user_id: int, referrer_id: int) -> bool:
+        """Path form of ReferralTreeHelper.add_new_user; runs inside the caller's transaction"""
+        if new_user_id == referrer_id:
+            current_app.logger.warning("User attempted self-referral.")
+            return False
+
+        referrer_path = MaterializedPathBackend.get_path(referrer_id)
+        if referrer_path is None:
+            current_app.logger.warning(
+                f"Referrer {referrer_id} has no ancestor_path; run backfill_paths before switching backends"
+            )
+            return False
+        if new_user_id in referrer_path:
+            current_app.logger.warning(
+                f"Cycle detected: referrer_id={referrer_id} is descendant of new_user_id={new_user_id}"
+            )
+            return False
+
+        path = ([referrer_id] + referrer_path)[:MAX_REFERRAL_DEPTH]
+        if MaterializedPathBackend.set_path(new_user_id, path, only_if_unset=True):
+            MaterializedPathBackend._record_new_member(new_user_id, referrer_id, path)
+
+        ancestor_cache.invalidate(new_user_id)
+        tree_node_cache.invalidate_node(referrer_id)
+        return True
+
+    @staticmethod
+    def _record_new_member(new_user_id: int, referrer_id: int, ancestors: List[int]) -> None:
+        """Path form of NetworkCounterHelper.record_new_member: `ancestors` replaces the closure rows"""
+        if ancestors:
+            db.session.execute(
+                text("""
+                    UPDATE users SET
+                        total_network_size = COALESCE(total_network_size, 0) + 1,
+                        direct_referrals_count = COALESCE(direct_referrals_count, 0)
+                            + CASE WHEN id = :ref_id THEN 1 ELSE 0 END
+                    WHERE id IN :ids
+                """).bindparams(bindparam('ids', expanding=True)),
+                {'ref_id': referrer_id, 'ids': ancestors},
+            )
+            db.session.execute(
+                text("""
+                    INSERT INTO referral_level_counts (ancestor_id, depth, member_count)
+                    VALUES (:ancestor_id, :depth, 1)
+                    ON CONFLICT (ancestor_id, depth)
+                    DO UPDATE SET member_count = referral_level_counts.member_count + 1
+                """),
+                [{'ancestor_id': a, 'depth': d} for d, a in enumerate(ancestors, start=1)],
+            )
+            GrowthCounterHelper.bump(
+                {(a, d): 1 for d, a in enumerate(ancestors, start=1)}, GrowthCounterHelper.joined_day(new_user_id)
+            )
+
+        db.session.execute(
+            text("UPDATE users SET network_depth = :depth WHERE id = :new_id"),
+            {'depth': len(ancestors), 'new_id': new_user_id},
+        )
+
+        mega = MegaSponsorIndex.ids()
+        rows = [
+            {'ancestor_id': ancestor_id, 'depth': depth, 'new_id': new_user_id}
+            for depth, ancestor_id in enumerate(ancestors, start=1) if ancestor_id in mega
+        ]
+        if rows:
+            db.session.execute(
+                text("""
+                    INSERT INTO mega_sponsor_downline (ancestor_id, depth, descendant_id, joined_at, is_active)
+                    SELECT :ancestor_id, :depth, id, created_at, COALESCE(is_active, TRUE)
+                    FROM users WHERE id = :new_id
+                    ON CONFLICT (ancestor_id, depth, descendant_id) DO NOTHING
+                """),
+                rows,
+            )
+
+    @staticmethod
+    def get_ancestors(user_id: int, max_levels: int = MAX_REFERRAL_DEPTH) -> List[Dict]:
+        """Same rows as ReferralTreeHelper._get_ancestors_closure, from one path fetch"""
+        path = (MaterializedPathBackend.get_path(user_id) or [])[:max_levels]
+        if not path:
+            return []
+
+        rows = db.session.execute(
+            text("""
+                SELECT id, username, email, phone, is_active, is_verified,
+                       referral_bonus_eligible, referred_by
+                FROM users WHERE id IN :ids
+            """).bindparams(bindparam('ids', expanding=True)),
+            {'ids': path},
+        )
+        by_id = {row.id: dict(row._mapping) for row in rows}
+        return [
+            dict(by_id[ancestor_id], level=level)
+            for level, ancestor_id in enumerate(path, start=1)
+            if ancestor_id in by_id
+        ]
+
+    @staticmethod
+    def get_ancestors_bulk(user_ids: List[int], max_levels: int = MAX_REFERRAL_DEPTH,
+                           chunk_size: int = 1000) -> Dict[int, Tuple[int, ...]]:
+        """Path form of ReferralTreeHelper.get_ancestors_bulk: one row per user"""
+        unique_ids = list(dict.fromkeys(user_ids))
+        chains: Dict[int, Tuple[int, ...]] = {user_id: () for user_id in unique_ids}
+        query = text("SELECT id, ancestor_path FROM users WHERE id IN :ids") \
+            .bindparams(bindparam('ids', expanding=True)) \
+            .columns(**MaterializedPathBackend.PATH_COLUMNS)
+
+        for start in range(0, len(unique_ids), chunk_size):
+            for row in db.session.execute(query, {'ids': unique_ids[start:start + chunk_size]}):
+                chains[row.id] = tuple((row.ancestor_path or [])[:max_levels])
+        return chains
+
+    @staticmethod
+    def is_descendant(ancestor_id: int, descendant_id: int) -> bool:
+        return ancestor_id in (MaterializedPathBackend.get_path(descendant_id) or [])
+
+    @staticmethod
+    def get_descendants(user_id: int, level: Optional[int] = None) -> List[Dict]:
+        """Active descendants (optionally at one level) via path containment"""
+        if db.engine.dialect.name == 'postgresql':
+            sql = """
+                SELECT id, username, created_at, is_active,
+                       array_position(ancestor_path, CAST(:user_id AS INTEGER)) AS level
+                FROM users
+                WHERE ancestor_path @> ARRAY[CAST(:user_id AS INTEGER)]
+                AND is_active = TRUE
+            """
+            if level:
+                sql += " AND ancestor_path[:level] = :user_id"
+            sql += " ORDER BY level ASC"
+            rows = db.session.execute(text(sql), {'user_id': user_id, 'level': level})
+            return [dict(row._mapping) for row in rows]
+
+        rows = db.session.execute(
+            text("""
+                SELECT id, username, created_at, is_active, ancestor_path
+                FROM users
+                WHERE (',' || ancestor_path || ',') LIKE :pattern
+                AND is_active = TRUE
+            """).columns(**MaterializedPathBackend.PATH_COLUMNS),
+            {'pattern': f'%,{user_id},%'},
+        )
+        descendants = []
+        for row in rows:
+            row_level = row.ancestor_path.index(user_id) + 1
+            if level and row_level != level:
+                continue
+            descendants.append({
+                'id': row.id, 'username': row.username, 'created_at': row.created_at,
+                'is_active': row.is_active, 'level': row_level,
+            })
+        descendants.sort(key=lambda d: d['level'])
+        return descendants
+
+    @staticmethod
+    def move_subtree(user_id: int, new_sponsor_id: int) -> Dict[str, Any]:
+        """
+        Path form of ReferralTreeHelper._move_subtree_closure (the caller
+        validates the move). Every member whose path contains user_id keeps the part
+        below it and gets the new sponsor's path appended.
+        """
+        sponsor_path = ([new_sponsor_id] + (MaterializedPathBackend.get_path(new_sponsor_id) or []))
+        members = [(user_id, MaterializedPathBackend.get_path(user_id) or [])]
+        if db.engine.dialect.name == 'postgresql':
+            rows = db.session.execute(
+                text("SELECT id, ancestor_path FROM users WHERE ancestor_path @> ARRAY[CAST(:user_id AS INTEGER)]")
+                .columns(**MaterializedPathBackend.PATH_COLUMNS),
+                {'user_id': user_id},
+            )
+        else:
+            rows = db.session.execute(
+                text("SELECT id, ancestor_path FROM users WHERE (',' || ancestor_path || ',') LIKE :pattern")
+                .columns(**MaterializedPathBackend.PATH_COLUMNS),
+                {'pattern': f'%,{user_id},%'},
+            )
+        members.extend((row.id, row.ancestor_path) for row in rows)
+
+        level_deltas: Dict[Tuple[int, int], int] = {}
+        updates = []
+        for member_id, old_path in members:
+            below = old_path.index(user_id) + 1 if member_id != user_id else 0
+            new_path = (old_path[:below] + sponsor_path)[:MAX_REFERRAL_DEPTH]
+            if new_path == old_path:
+                continue
+            for depth, ancestor_id in enumerate(old_path[below:], start=below + 1):
+                level_deltas[(ancestor_id, depth)] = level_deltas.get((ancestor_id, depth), 0) - 1
+            for depth, ancestor_id in enumerate(new_path[below:], start=below + 1):
+                level_deltas[(ancestor_id, depth)] = level_deltas.get((ancestor_id, depth), 0) + 1
+            updates.append({'id': member_id, 'path': new_path, 'depth': len(new_path)})
+
+        if updates:
+            db.session.execute(
+                text("UPDATE users SET ancestor_path = :path, network_depth = :depth WHERE id = :id")
+                .bindparams(bindparam('path', type_=AncestorPath())),
+                updates,
+            )
+
+        return {
+            'subtree_size': len(members),
+            'rows_deleted': 0,
+            'rows_inserted': 0,
+            'paths_updated': len(updates),
+            'ancestors_updated': NetworkCounterHelper.apply_level_deltas(level_deltas),
+        }
+
+    @staticmethod
+    def backfill_paths(chunk_size: int = 5000) -> int:
+        """Fill users.ancestor_path from referral_network, chunked by user id"""
+        update = text("UPDATE users SET ancestor_path = :path WHERE id = :id") \
+            .bindparams(bindparam('path', type_=AncestorPath()))
+        max_id = db.session.execute(text("SELECT COALESCE(MAX(id), 0) FROM users")).scalar() or 0
+        written = 0
+
+        for lo in range(1, max_id + 1, chunk_size):
+            hi = lo + chunk_size - 1
+            paths: Dict[int, List[int]] = {
+                uid: [] for uid in db.session.execute(
+                    text("SELECT id FROM users WHERE id BETWEEN :lo AND :hi"), {'lo': lo, 'hi': hi}
+                ).scalars()
+            }
+            rows = db.session.execute(
+                text("""
+                    SELECT descendant_id, ancestor_id FROM referral_network
+                    WHERE descendant_id BETWEEN :lo AND :hi AND depth BETWEEN 1 AND :cap
+                    ORDER BY descendant_id, depth
+                """),
+                {'lo': lo, 'hi': hi, 'cap': MAX_REFERRAL_DEPTH},
+            )
+            for row in rows:
+                if row.descendant_id in paths:
+                    paths[row.descendant_id].append(row.ancestor_id)
+
+            if paths:
+                db.session.execute(update, [{'id': uid, 'path': path} for uid, path in paths.items()])
+                written += len(paths)
+            db.session.commit()
+
+        logger.info(f"Backfilled ancestor_path for {written} users")
+        return written
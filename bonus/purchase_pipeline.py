@@ -0,0 +1,231 @@
+# bonus/purchase_pipeline.py
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
+from decimal import Decimal
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import text, insert
+
+from extensions import db
+from models import Payment, PackageCatalog, Package, User, Notification
+from bonus.validation import BonusValidationHelper
+from bonus.bonus_calculation import BonusCalculationHelper
+from bonus.bonus_storage import ReferralBonusStore
+from bonus.wallet_credit import WalletCreditService
+
+logger = logging.getLogger(__name__)
+
+
+class PurchasePipeline:
+    """
+    Package purchase processing as one database transaction.
+
+    Phases:
+      load       lock the payment row, resolve package and buyer, stop early
+                 if the payment already has bonuses
+      calculate  upline and per-level bonus amounts (reads only)
+      validate   set-based batch validation
+      write      package, bonuses (inserted already paid), balance credits
+                 and their transactions (WalletCreditService) and
+                 notifications, each as one batched statement
+      commit     the single commit
+
+    Any failure rolls the whole purchase back, so there is never a package
+    without its bonuses or a bonus without its credit. `before_commit`, if
+    given, runs last in the write phase so callers can record their own
+    bookkeeping (e.g. BonusJobQueue marking its job done) atomically with
+    the purchase. Per-phase wall time in milliseconds is returned under
+    'timings'.
+    """
+
+    def __init__(self, payment: Payment, before_commit: Optional[Callable[[], None]] = None):
+        self.payment = payment
+        self.before_commit = before_commit
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def _phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round((time.perf_counter() - started) * 1000, 2)
+
+    def run(self) -> Dict[str, Any]:
+        result = {
+            'success': False,
+            'message': '',
+            'bonus_ids': [],
+            'credited_count': 0,
+            'total_amount': Decimal('0'),
+            'notifications': 0,
+            'timings': self.timings,
+        }
+        started = time.perf_counter()
+        try:
+            with self._phase('load'):
+                package_catalog, user, error = self._load()
+            if error:
+                db.session.rollback()
+                result['success'], result['message'] = error == "Already processed", error
+                return result
+
+            with self._phase('calculate'):
+                calculations = self._calculate()
+            with self._phase('validate'):
+                valid_bonuses = []
+                if calculations:
+                    valid_bonuses, invalid_bonuses, _ = BonusValidationHelper.validate_bonus_batch(calculations)
+                    logger.info(f"Valid: {len(valid_bonuses)}, Invalid: {len(invalid_bonuses)}")
+
+            with self._phase('write'):
+                self._write_package(user, package_catalog)
+                inserted = self._write_bonuses(valid_bonuses, user)
+                self._write_credits(inserted)
+                result['notifications'] = self._write_notifications(
+                    user, package_catalog, len(inserted), no_bonuses=not valid_bonuses
+                )
+                if self.before_commit:
+                    self.before_commit()
+
+            with self._phase('commit'):
+                db.session.commit()
+
+            result['bonus_ids'] = [row['id'] for row in inserted]
+            result['credited_count'] = len(inserted)
+            result['total_amount'] = sum((Decimal(str(row['bonus_amount'])) for row in inserted), Decimal('0'))
+            result['success'] = True
+            result['message'] = (
+                f"Successfully processed {result['credited_count']} bonuses totaling {result['total_amount']}"
+            )
+            return result
+
+        except Exception as e:
+            logger.exception(f"Package purchase processing failed for payment {self.payment.id}")
+            db.session.rollback()
+            result['message'] = f"Processing error: {str(e)}"
+            return result
+
+        finally:
+            self.timings['total'] = round((time.perf_counter() - started) * 1000, 2)
+            logger.info(f"Purchase pipeline for payment {self.payment.id}: {self.timings}")
+
+    # -------------------------
+    # Phases
+    # -------------------------
+    def _load(self) -> Tuple[Optional[PackageCatalog], Optional[User], Optional[str]]:
+        """Check the payment, package and buyer without committing"""
+        payment = Payment.query.with_for_update().get(self.payment.id) or self.payment
+        if not payment.amount or payment.amount <= 0:
+            logger.error(f"Invalid payment: {payment.id}")
+            return None, None, "Purchase validation failed"
+
+        if not payment.package_catalog_id:
+            package_catalog = PackageCatalog.query.filter_by(amount=payment.amount).first()
+            if package_catalog:
+                payment.package_catalog_id = package_catalog.id  # committed with the purchase
+                logger.info(f"Fixed package_catalog_id: {package_catalog.id}")
+        else:
+            package_catalog = db.session.get(PackageCatalog, payment.package_catalog_id)
+        if not package_catalog:
+            logger.error(f"Package catalog not found for payment {payment.id}")
+            return None, None, "Purchase validation failed"
+
+        user = db.session.get(User, payment.user_id) if payment.user_id else None
+        if not user:
+            logger.error(f"User {payment.user_id} not found for payment {payment.id}")
+            return None, None, "Purchase validation failed"
+
+        existing = db.session.execute(
+            text("SELECT COUNT(*) FROM referral_bonuses WHERE payment_id = :payment_id"), {'payment_id': payment.id}
+        ).scalar()
+        if existing:
+            logger.warning(f"Payment {payment.id} already has {existing} bonuses")
+            return package_catalog, user, "Already processed"
+
+        self.payment = payment
+        return package_catalog, user, None
+
+    def _calculate(self) -> List[Dict[str, Any]]:
+        is_valid, reason = BonusValidationHelper.check_purchase(self.payment)
+        if not is_valid:
+            logger.warning(f"Bonus processing skipped: {reason}")
+            return []
+        success, calculations, message, _ = BonusCalculationHelper.calculate_all_bonuses_secure(self.payment)
+        if not success:
+            logger.error(f"Bonus calculation failed: {message}")
+            return []
+        logger.info(f"Calculated {len(calculations)} potential bonuses")
+        return calculations
+
+    def _write_package(self, user: User, package_catalog: PackageCatalog) -> None:
+        existing = Package.query.filter_by(user_id=user.id, catalog_id=package_catalog.id, status='active').first()
+        if existing:
+            logger.info(f"Using existing package for user {user.id}")
+            return
+        now = datetime.now(timezone.utc)
+        db.session.add(Package(
+            user_id=user.id,
+            catalog_id=package_catalog.id,
+            package=package_catalog.name,
+            status='active',
+            package_amount=package_catalog.amount,
+            activated_at=now,
+            expires_at=now + timedelta(days=package_catalog.duration_days or 30),
+            created_at=now,
+        ))
+
+    def _write_bonuses(self, valid_bonuses: List[Dict[str, Any]], user: User) -> List[Dict[str, Any]]:
+        """One multi-row insert; rows go in already paid since they're credited in this transaction"""
+        now = datetime.now(timezone.utc)
+        rows = [
+            ReferralBonusStore.build_row(
+                bonus_data,
+                payment_id=self.payment.id,
+                referrer_id=bonus_data.get('referrer_id') or user.referred_by,
+                referred_id=bonus_data.get('referred_id') or self.payment.user_id,
+                status='paid',
+                is_paid_out=True,
+                paid_out_at=now,
+            )
+            for bonus_data in valid_bonuses
+        ]
+        return ReferralBonusStore.insert_many(rows)
+
+    def _write_credits(self, inserted: List[Dict[str, Any]]) -> None:
+        """Credit the inserted bonuses to their recipients (one coalesced update + transactions)"""
+        WalletCreditService.credit(
+            [(row['user_id'], row['bonus_amount']) for row in inserted], reference=f"BONUS_P{self.payment.id}"
+        )
+
+    def _write_notifications(self, user: User, package_catalog: PackageCatalog, credited_count: int,
+                             no_bonuses: bool) -> int:
+        """Purchase, bonus and referrer notifications in one insert"""
+        package_name = package_catalog.name
+        messages = [(user.id, f"✅ Your {package_name} package has been activated!", 'purchase_confirmation')]
+        if no_bonuses:
+            messages.append((user.id, f"📦 Your {package_name} package is active. Invite friends to earn bonuses!", 'info'))
+        if credited_count > 0:
+            messages.append((
+                user.id,
+                f"🎉 You earned {credited_count} referral bonus(es) from your {package_name} purchase!",
+                'bonus_earning',
+            ))
+        if user.referred_by:
+            messages.append((
+                user.referred_by,
+                f"📢 Your referral (User #{user.id}) purchased a {package_name} package!",
+                'referral_earning',
+            ))
+
+        now = datetime.utcnow()
+        db.session.execute(
+            insert(Notification),
+            [
+                {'user_id': user_id, 'message': message, 'notification_type': kind, 'is_read': False, 'created_at': now}
+                for user_id, message, kind in messages
+            ],
+        )
+        return len(messages)
@@ -1,9 +1,12 @@
+from datetime import datetime
 from decimal import Decimal
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterator
 from flask import current_app
-from sqlalchemy import text
+from sqlalchemy import text, bindparam
 from extensions import db
 from models import User, ReferralNetwork
+from bonus.cache_strategy import ancestor_cache, tree_node_cache
+from bonus.network_counters import NetworkCounterHelper
 import logging
 from typing import List, Tuple, Optional
 import traceback
@@ -13,6 +16,14 @@ from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 logger = logging.getLogger(__name__)
 
 MAX_REFERRAL_DEPTH = 20  # your 20-level limit
+DOWNLINE_PAGE_SIZE = 100
+DOWNLINE_MAX_PAGE_SIZE = 1000
+DOWNLINE_FETCH_SIZE = 200  # rows pulled per round-trip from the server-side cursor
+ANCESTOR_BULK_CHUNK_SIZE = 1000  # users per IN-list in get_ancestors_bulk
+MEGA_SUMMARY_DIRECT_LIMIT = 100  # direct referrals listed in a mega sponsor's network summary
+
+# Cached upline chains carry these flags; ORM changes to them invalidate the chains
+ancestor_cache.watch_user_flags(db.session, User)
 
 
 
@@ -102,7 +113,7 @@ class ReferralTreeHelper:
 
             # 5️⃣ Insert all ancestor relationships
             print("Inserting ancestor->new_user relationships")
-            db.session.execute(
+            inserted = db.session.execute(
                 text(
                     """
                     INSERT INTO referral_network (ancestor_id, descendant_id, depth, path_length)
@@ -113,11 +124,11 @@ class ReferralTreeHelper:
                     """
                 ),
                 {"new_id": new_user_id, "ref_id": referrer_id, "max_depth": MAX_REFERRAL_DEPTH},
-            )
+            ).rowcount or 0
 
             # 6️⃣ Insert direct referrer relationship
             print("Inserting direct referrer->new_user relationship")
-            db.session.execute(
+            inserted += db.session.execute(
                 text(
                     """
                     INSERT INTO referral_network (ancestor_id, descendant_id, depth, path_length)
@@ -126,7 +137,14 @@ class ReferralTreeHelper:
                     """
                 ),
                 {"ref_id": referrer_id, "new_id": new_user_id},
-            )
+            ).rowcount or 0
+
+            # 7️⃣ Bump downline counters (skip on a repeated call that inserted nothing)
+            if inserted > 0:
+                NetworkCounterHelper.record_new_member(new_user_id, referrer_id)
+
+            ancestor_cache.invalidate(new_user_id)
+            tree_node_cache.invalidate_node(referrer_id)
 
             print("Referral network insertion completed successfully")
             return True
@@ -195,28 +213,163 @@ class ReferralTreeHelper:
 
 
     @staticmethod
-    def get_ancestors_optimized(user_id: int, max_levels: int = 20) -> List[Dict]:
+    def get_ancestors_optimized(user_id: int, max_levels: int = 20, active_only: bool = True) -> List[Dict]:
         """
-        Optimized ancestor query with user data in single query
+        Optimized ancestor query with user data in single query.
+        Served from the per-worker ancestor cache when possible.
+        Pass active_only=False to keep inactive ancestors so levels stay contiguous.
+        """
+        chain = ReferralTreeHelper.get_upline_chain(user_id, max_levels)
+        if active_only:
+            chain = [ancestor for ancestor in chain if ancestor['is_active']]
+        return chain
+
+    @staticmethod
+    def _get_ancestors_closure(user_id: int, max_levels: int = MAX_REFERRAL_DEPTH) -> List[Dict]:
+        """
+        Read a user's ancestors (active or not) from the closure table
         """
         query = text("""
-            SELECT 
+            SELECT
                 u.id, u.username, u.email, u.phone, u.is_active, u.is_verified,
+                u.referral_bonus_eligible, u.referred_by,
                 rn.depth as level
             FROM referral_network rn
             JOIN users u ON rn.ancestor_id = u.id
-            WHERE rn.descendant_id = :user_id 
+            WHERE rn.descendant_id = :user_id
             AND rn.depth BETWEEN 1 AND :max_levels
-            AND u.is_active = TRUE
             ORDER BY rn.depth ASC
         """)
-        
+
         result = db.session.execute(query, {
-            'user_id': user_id, 
+            'user_id': user_id,
             'max_levels': max_levels
         })
-        
-        return [dict(row) for row in result]
+
+        return [dict(row._mapping) for row in result]
+
+    @staticmethod
+    def get_ancestors_recursive(user_id: int, max_levels: int = MAX_REFERRAL_DEPTH) -> List[Dict]:
+        """
+        Walk users.referred_by with a recursive CTE. Used when the closure
+        table is missing or disagrees with the referred_by chain.
+        """
+        query = text("""
+            WITH RECURSIVE upline(id, level) AS (
+                SELECT referred_by, 1
+                FROM users
+                WHERE id = :user_id AND referred_by IS NOT NULL
+                UNION ALL
+                SELECT u.referred_by, up.level + 1
+                FROM upline up
+                JOIN users u ON u.id = up.id
+                WHERE u.referred_by IS NOT NULL AND up.level < :max_levels
+            )
+            SELECT
+                u.id, u.username, u.email, u.phone, u.is_active, u.is_verified,
+                u.referral_bonus_eligible, u.referred_by,
+                up.level
+            FROM upline up
+            JOIN users u ON u.id = up.id
+            ORDER BY up.level ASC
+        """)
+
+        result = db.session.execute(query, {
+            'user_id': user_id,
+            'max_levels': max_levels
+        })
+
+        return [dict(row._mapping) for row in result]
+
+    @staticmethod
+    def get_upline_chain(user_id: int, max_levels: int = MAX_REFERRAL_DEPTH,
+                         referrer_id: Optional[int] = None) -> List[Dict]:
+        """
+        Resolve the full upline (level 1 = direct sponsor) in one round trip.
+
+        Checks the per-worker ancestor cache first. On a miss, reads the
+        closure table and checks that it matches the referred_by chain
+        (contiguous depths, each row pointing at the next, first row equal
+        to `referrer_id` when given). Falls back to the recursive CTE when
+        the closure rows are missing or inconsistent.
+        Inactive ancestors are kept so callers can index by level.
+        """
+        cached = ancestor_cache.get(user_id)
+        if cached is not None:
+            if referrer_id is None or (cached and cached[0]['id'] == referrer_id):
+                return cached[:max_levels]
+            ancestor_cache.invalidate(user_id)
+
+        # Always load the full chain so one cache entry serves every max_levels
+        chain = None
+        closure_chain = []
+        try:
+            # Savepoint: a failed read must not roll back the caller's transaction
+            # (PurchasePipeline holds the payment row FOR UPDATE in it)
+            with db.session.begin_nested():
+                closure_chain = ReferralTreeHelper._get_ancestors_closure(user_id, MAX_REFERRAL_DEPTH)
+            if ReferralTreeHelper._is_consistent_chain(closure_chain, MAX_REFERRAL_DEPTH, referrer_id):
+                chain = closure_chain
+        except SQLAlchemyError:
+            current_app.logger.error("get_upline_chain closure read failed:\n" + traceback.format_exc())
+
+        if chain is None:
+            chain = ReferralTreeHelper.get_ancestors_recursive(user_id, MAX_REFERRAL_DEPTH)
+            if chain:
+                current_app.logger.warning(
+                    f"Closure upline for user {user_id} incomplete ({len(closure_chain)} of {len(chain)} rows), "
+                    f"used recursive fallback"
+                )
+
+        ancestor_cache.set(user_id, chain)
+        return chain[:max_levels]
+
+    @staticmethod
+    def _is_consistent_chain(chain: List[Dict], max_levels: int, referrer_id: Optional[int] = None) -> bool:
+        """Check closure rows form an unbroken referred_by chain"""
+        if not chain:
+            return False
+
+        if referrer_id is not None and chain[0]['id'] != referrer_id:
+            return False
+
+        for expected_level, ancestor in enumerate(chain, start=1):
+            if ancestor['level'] != expected_level:
+                return False
+            if expected_level > 1 and chain[expected_level - 2]['referred_by'] != ancestor['id']:
+                return False
+
+        # A short chain is only complete if it really ends at a root
+        return len(chain) >= max_levels or chain[-1]['referred_by'] is None
+
+    @staticmethod
+    def get_ancestors_bulk(user_ids: List[int], max_levels: int = MAX_REFERRAL_DEPTH,
+                           chunk_size: int = ANCESTOR_BULK_CHUNK_SIZE) -> Dict[int, Tuple[int, ...]]:
+        """
+        Ancestor ids for many users at once: {user_id: (level 1 id, level 2 id, ...)}.
+
+        One closure query per `chunk_size` users instead of one per user.
+        Every requested id is in the result (roots and unknown ids map to ()).
+        Reads the stored rows as-is; the cache and the recursive fallback
+        of get_upline_chain are not used.
+        """
+        unique_ids = list(dict.fromkeys(user_ids))
+        chains: Dict[int, List[int]] = {user_id: [] for user_id in unique_ids}
+        query = text("""
+            SELECT descendant_id, ancestor_id
+            FROM referral_network
+            WHERE descendant_id IN :ids AND depth BETWEEN 1 AND :max_levels
+            ORDER BY descendant_id, depth
+        """).bindparams(bindparam('ids', expanding=True))
+
+        for start in range(0, len(unique_ids), chunk_size):
+            rows = db.session.execute(
+                query, {'ids': unique_ids[start:start + chunk_size], 'max_levels': max_levels}
+            )
+            for descendant_id, ancestor_id in rows:
+                chains[descendant_id].append(ancestor_id)
+
+        return {user_id: tuple(chain) for user_id, chain in chains.items()}
     
     @staticmethod
     def get_descendants_optimized(user_id: int, level: int = None) -> List[Dict]:
@@ -245,7 +398,89 @@ class ReferralTreeHelper:
             """)
             result = db.session.execute(query, {'user_id': user_id})
         
-        return [dict(row) for row in result]
+        return [dict(row._mapping) for row in result]
+
+    @staticmethod
+    def encode_downline_cursor(depth: int, descendant_id: int) -> str:
+        """Opaque keyset cursor for the (depth, descendant_id) ordering"""
+        return f"{depth}.{descendant_id}"
+
+    @staticmethod
+    def decode_downline_cursor(cursor: Optional[str]) -> Optional[Tuple[int, int]]:
+        """Parse a cursor from encode_downline_cursor; raises ValueError if malformed"""
+        if not cursor:
+            return None
+        depth, _, descendant_id = cursor.partition(".")
+        return int(depth), int(descendant_id)
+
+    @staticmethod
+    def stream_downline(user_id: int, limit: int = DOWNLINE_PAGE_SIZE, after: Optional[Tuple[int, int]] = None,
+                        min_depth: int = 1, max_depth: int = MAX_REFERRAL_DEPTH, active: Optional[bool] = None,
+                        joined_from: Optional[datetime] = None, joined_to: Optional[datetime] = None
+                        ) -> Iterator[Dict[str, Any]]:
+        """
+        Yield one page of a user's downline ordered by (depth, descendant_id).
+
+        Keyset pagination: pass the last row's (depth, id) as `after` to get the
+        next page, so deep pages cost the same as the first one. Rows are pulled
+        from a server-side cursor in small batches rather than materialized.
+
+        Mega sponsors page through mega_sponsor_downline instead, whose
+        denormalized is_active / joined_at let filtered pages seek on one index.
+        Its is_active is as of the last refresh, so the live flag is checked too.
+        """
+        from bonus.mega_sponsors import MegaSponsorIndex
+
+        mega = MegaSponsorIndex.is_mega(user_id)
+        source = "mega_sponsor_downline" if mega else "referral_network"
+        joined_column = "rn.joined_at" if mega else "u.created_at"
+        conditions = [
+            "rn.ancestor_id = :user_id",
+            "rn.depth BETWEEN :min_depth AND :max_depth",
+        ]
+        params = {
+            'user_id': user_id,
+            'min_depth': max(1, min_depth),
+            'max_depth': min(MAX_REFERRAL_DEPTH, max_depth),
+            'limit': limit,
+        }
+
+        if after is not None:
+            conditions.append(
+                "(rn.depth > :after_depth OR (rn.depth = :after_depth AND rn.descendant_id > :after_id))"
+            )
+            params['after_depth'], params['after_id'] = after
+        if active is not None:
+            conditions.append("u.is_active = :active")
+            if mega:
+                conditions.append("rn.is_active = :active")
+            params['active'] = active
+        if joined_from is not None:
+            conditions.append(f"{joined_column} >= :joined_from")
+            params['joined_from'] = joined_from
+        if joined_to is not None:
+            conditions.append(f"{joined_column} < :joined_to")
+            params['joined_to'] = joined_to
+
+        query = text(f"""
+            SELECT rn.depth AS level, u.id, u.username, u.is_active, u.created_at,
+                   u.direct_referrals_count, u.total_network_size
+            FROM {source} rn
+            JOIN users u ON rn.descendant_id = u.id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY rn.depth, rn.descendant_id
+            LIMIT :limit
+        """)
+
+        result = db.session.execute(
+            query, params,
+            execution_options={'stream_results': True, 'yield_per': DOWNLINE_FETCH_SIZE}
+        )
+        try:
+            for row in result:
+                yield dict(row._mapping)
+        finally:
+            result.close()
 
     @staticmethod
     def validate_referrer(referrer_id: int, new_user_id: int) -> tuple[bool, str]:
@@ -296,7 +531,7 @@ class ReferralTreeHelper:
         """Build the complete referral path from root to user"""
         try:
             ancestors = ReferralTreeHelper.get_ancestors_optimized(user_id, 20)
-            path = [ancestor['user_id'] for ancestor in ancestors]
+            path = [ancestor['id'] for ancestor in ancestors]
             path.reverse()  # Root first, then descendants
             path.append(user_id)  # Add current user at the end
             return path
@@ -344,6 +579,7 @@ class ReferralTreeHelper:
                 )
             
             db.session.commit()
+            ancestor_cache.invalidate(user_id)
             return True
             
         except Exception as e:
@@ -351,6 +587,152 @@ class ReferralTreeHelper:
             current_app.logger.error(f"Error storing referral path for {user_id}: {str(e)}")
             return False
 
+    @staticmethod
+    def move_subtree(user_id: int, new_sponsor_id: int) -> Dict[str, Any]:
+        """
+        Re-parent `user_id` and its whole downline under `new_sponsor_id`.
+
+        Uses a fixed number of set-based statements however large the subtree
+        is: the pairs linking the subtree to its old upline are deleted and the
+        pairs to the new upline are inserted (capped at MAX_REFERRAL_DEPTH).
+        Counters are adjusted from the aggregated pair deltas. Commits on success.
+        """
+        report = {
+            'success': False, 'error': None, 'user_id': user_id, 'new_sponsor_id': new_sponsor_id,
+            'old_sponsor_id': None, 'subtree_size': 0, 'rows_deleted': 0, 'rows_inserted': 0,
+            'ancestors_updated': 0,
+        }
+        try:
+            if user_id == new_sponsor_id:
+                report['error'] = "A user cannot sponsor themselves"
+                return report
+
+            lock = " FOR UPDATE" if db.engine.dialect.name == 'postgresql' else ""
+            sponsors = {
+                row.id: row.referred_by
+                for row in db.session.execute(
+                    text(f"SELECT id, referred_by FROM users WHERE id IN (:uid, :sponsor){lock}"),
+                    {'uid': user_id, 'sponsor': new_sponsor_id},
+                )
+            }
+            if user_id not in sponsors or new_sponsor_id not in sponsors:
+                report['error'] = "User or new sponsor not found"
+                return report
+
+            report['old_sponsor_id'] = sponsors[user_id]
+            if sponsors[user_id] == new_sponsor_id:
+                report['success'] = True
+                return report
+
+            # Uncapped referred_by walk, so a sponsor more than 20 levels down is still caught
+            in_own_downline = db.session.execute(
+                text("""
+                    WITH RECURSIVE upline(id) AS (
+                        SELECT referred_by FROM users WHERE id = :sponsor
+                        UNION
+                        SELECT u.referred_by FROM users u JOIN upline up ON u.id = up.id
+                    )
+                    SELECT 1 FROM upline WHERE id = :uid LIMIT 1
+                """),
+                {'uid': user_id, 'sponsor': new_sponsor_id},
+            ).scalar()
+            if in_own_downline:
+                report['error'] = "New sponsor is in the user's downline"
+                return report
+
+            report.update(ReferralTreeHelper._move_subtree_closure(user_id, new_sponsor_id))
+
+            db.session.execute(
+                text("UPDATE users SET referred_by = :sponsor WHERE id = :uid"),
+                {'uid': user_id, 'sponsor': new_sponsor_id},
+            )
+            db.session.execute(
+                text("UPDATE referrals SET referrer_id = :sponsor WHERE referred_id = :uid"),
+                {'uid': user_id, 'sponsor': new_sponsor_id},
+            )
+            db.session.commit()
+            ancestor_cache.invalidate_all()
+            tree_node_cache.clear()
+
+            report['success'] = True
+            current_app.logger.info(
+                f"Moved subtree of user {user_id} ({report['subtree_size']} users) from sponsor "
+                f"{report['old_sponsor_id']} to {new_sponsor_id}: -{report['rows_deleted']} / "
+                f"+{report['rows_inserted']} closure rows"
+            )
+            return report
+
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error moving subtree of user {user_id}:\n" + traceback.format_exc())
+            report['error'] = str(e)
+            return report
+
+    @staticmethod
+    def _move_subtree_closure(user_id: int, new_sponsor_id: int) -> Dict[str, Any]:
+        params = {'uid': user_id, 'sponsor': new_sponsor_id, 'max_depth': MAX_REFERRAL_DEPTH}
+
+        # Pairs (old upline ancestor, subtree member): deeper than the member sits below user_id
+        old_pairs = """
+            FROM referral_network rn
+            JOIN referral_network s ON s.descendant_id = rn.descendant_id AND s.ancestor_id = :uid
+            WHERE rn.depth > s.depth
+        """
+        # Pairs (new upline ancestor incl. the sponsor, subtree member) within the depth cap
+        new_pairs = """
+            FROM referral_network p
+            JOIN referral_network s ON s.ancestor_id = :uid
+            WHERE p.descendant_id = :sponsor AND p.depth + 1 + s.depth <= :max_depth
+        """
+
+        level_deltas: Dict[Tuple[int, int], int] = {}
+        for sign, query in (
+            (-1, f"SELECT rn.ancestor_id, rn.depth, COUNT(*) AS members {old_pairs} GROUP BY rn.ancestor_id, rn.depth"),
+            (1, f"SELECT p.ancestor_id, p.depth + 1 + s.depth AS depth, COUNT(*) AS members {new_pairs} "
+                f"GROUP BY p.ancestor_id, p.depth + 1 + s.depth"),
+        ):
+            for row in db.session.execute(text(query), params):
+                key = (row.ancestor_id, row.depth)
+                level_deltas[key] = level_deltas.get(key, 0) + sign * row.members
+
+        db.session.execute(
+            text("""
+                INSERT INTO referral_network (ancestor_id, descendant_id, depth, path_length)
+                VALUES (:sponsor, :sponsor, 0, 0)
+                ON CONFLICT (ancestor_id, descendant_id) DO NOTHING
+            """),
+            params,
+        )
+        deleted = db.session.execute(
+            text(f"DELETE FROM referral_network WHERE id IN (SELECT rn.id {old_pairs})"), params
+        ).rowcount or 0
+        inserted = db.session.execute(
+            text(f"""
+                INSERT INTO referral_network (ancestor_id, descendant_id, depth, path_length)
+                SELECT p.ancestor_id, s.descendant_id, p.depth + 1 + s.depth, p.depth + 1 + s.depth
+                {new_pairs}
+                ON CONFLICT (ancestor_id, descendant_id) DO NOTHING
+            """),
+            params,
+        ).rowcount or 0
+
+        subtree_size = db.session.execute(
+            text("""
+                UPDATE users SET network_depth = (
+                    SELECT COALESCE(MAX(depth), 0) FROM referral_network WHERE descendant_id = users.id
+                )
+                WHERE id IN (SELECT descendant_id FROM referral_network WHERE ancestor_id = :uid)
+            """),
+            params,
+        ).rowcount or 0
+
+        return {
+            'subtree_size': subtree_size,
+            'rows_deleted': deleted,
+            'rows_inserted': inserted,
+            'ancestors_updated': NetworkCounterHelper.apply_level_deltas(level_deltas),
+        }
+
    
     # Add this method to your existing ReferralTreeHelper class
 
@@ -360,12 +742,11 @@ class ReferralTreeHelper:
         Initialize a user who joined without referral (standalone in network)
         """
         try:
-           
             query = text("""
                 INSERT INTO referral_network (ancestor_id, descendant_id, depth, path_length)
                 VALUES (:user_id, :user_id, 0, 0)
             """)
-            
+
             db.session.execute(query, {'user_id': user_id})
             
             # Update user's network depth to 0 (root level)
@@ -375,6 +756,7 @@ class ReferralTreeHelper:
                 user.direct_referrals_count = 0
                 user.total_network_size = 0
             
+            ancestor_cache.invalidate(user_id)
             current_app.logger.info(f"Initialized standalone user {user_id} in referral network")
             return True
             
@@ -391,19 +773,22 @@ class ReferralTreeHelper:
             # Get ancestors (upline)
             ancestors = ReferralTreeHelper.get_ancestors_optimized(user_id, 20)
             
-            # Get direct descendants (level 1 downline)
-            direct_descendants_query = text("""
+            # Get direct descendants (level 1 downline); mega sponsors only list the newest
+            from bonus.mega_sponsors import MegaSponsorIndex
+            mega = MegaSponsorIndex.is_mega(user_id)
+            direct_descendants_query = text(f"""
                 SELECT u.id, u.username, u.created_at, u.is_active
                 FROM referral_network rn
                 JOIN users u ON rn.descendant_id = u.id
                 WHERE rn.ancestor_id = :user_id 
                 AND rn.depth = 1
                 ORDER BY u.created_at DESC
+                {'LIMIT :limit' if mega else ''}
             """)
             
             direct_descendants_result = db.session.execute(
                 direct_descendants_query, 
-                {'user_id': user_id}
+                {'user_id': user_id, 'limit': MEGA_SUMMARY_DIRECT_LIMIT}
             )
             direct_descendants = [
                 {
@@ -415,28 +800,18 @@ class ReferralTreeHelper:
                 for row in direct_descendants_result
             ]
             
-            # Get total network size
-            total_network_query = text("""
-                SELECT COUNT(DISTINCT descendant_id) as total_descendants
-                FROM referral_network 
-                WHERE ancestor_id = :user_id 
-                AND depth > 0
-            """)
-            
-            total_network_result = db.session.execute(
-                total_network_query, 
-                {'user_id': user_id}
-            ).fetchone()
-            
-            total_network_size = total_network_result.total_descendants if total_network_result else 0
+            # Network size comes from the maintained per-level counters
+            level_breakdown = NetworkCounterHelper.get_level_breakdown(user_id)
+            total_network_size = sum(level_breakdown.values())
             
             return {
                 'user_id': user_id,
                 'ancestors_count': len(ancestors),
                 'ancestors': ancestors,
-                'direct_descendants_count': len(direct_descendants),
+                'direct_descendants_count': level_breakdown.get(1, 0) if mega else len(direct_descendants),
                 'direct_descendants': direct_descendants,
                 'total_network_size': total_network_size,
+                'level_breakdown': level_breakdown,
                 'network_depth': ancestors[-1]['level'] if ancestors else 0
             }
             
@@ -449,5 +824,6 @@ class ReferralTreeHelper:
                 'direct_descendants_count': 0, 
                 'direct_descendants': [],
                 'total_network_size': 0,
+                'level_breakdown': {},
                 'network_depth': 0
             }
\ No newline at end of file
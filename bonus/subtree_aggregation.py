@@ -0,0 +1,207 @@
+# bonus/subtree_aggregation.py
+import logging
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, Any, Optional, List
+
+import numpy as np
+from sqlalchemy import text, bindparam
+
+from extensions import db
+from bonus.forest_index import ReferralForestIndex
+from bonus.refferral_tree import MAX_REFERRAL_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+class SubtreeAggregator:
+    """
+    Downline sums for every user at once, computed from the forest index.
+
+    Each metric is loaded as one per-user vector with a single grouped
+    query. Unlimited-depth sums are then one prefix sum over the Euler-tour
+    order: a subtree is the slice order[tin:tout], so its sum is
+    S[tout] - S[tin]. The depth-limited (bonus plan) variant pushes every
+    value up one ancestor per pass with np.bincount, for max_depth passes.
+    Neither variant queries descendants per user.
+
+    Results exclude the user's own value, so they mean "my downline's ...".
+    """
+
+    METRICS = {
+        'active_members': """
+            SELECT id AS user_id, 1 AS value FROM users WHERE is_active = TRUE
+        """,
+        'active_packages': """
+            SELECT user_id, COUNT(*) AS value FROM packages
+            WHERE status = 'active' AND user_id IS NOT NULL GROUP BY user_id
+        """,
+        'investment': """
+            SELECT user_id, SUM(package_amount) AS value FROM packages
+            WHERE status = 'active' AND user_id IS NOT NULL GROUP BY user_id
+        """,
+        'deposits': """
+            SELECT user_id, SUM(amount) AS value FROM payments
+            WHERE status = 'completed' AND payment_type = 'deposit' AND user_id IS NOT NULL GROUP BY user_id
+        """,
+        'bonuses_generated': """
+            SELECT referred_id AS user_id, SUM(bonus_amount) AS value FROM referral_bonuses
+            WHERE referred_id IS NOT NULL GROUP BY referred_id
+        """,
+    }
+
+    UPDATE_SQL = text(
+        """
+        UPDATE users SET
+            network_total_investment = :investment,
+            network_active_members = :active,
+            last_network_calculation = :now
+        WHERE id = :id
+        """
+    ).bindparams(bindparam('investment', type_=db.Numeric(18, 2)))
+
+    def __init__(self, index: Optional[ReferralForestIndex] = None, fetch_size: int = 100000):
+        self.index = index or ReferralForestIndex.from_db(fetch_size=fetch_size)
+        self.fetch_size = fetch_size
+        self.results: Dict[str, np.ndarray] = {}
+
+    # -------------------------
+    # Entry point
+    # -------------------------
+    def run(self, max_depth: Optional[int] = MAX_REFERRAL_DEPTH, write: bool = True,
+            chunk_size: int = 5000) -> Dict[str, Any]:
+        """
+        Aggregate every metric over each user's downline (max_depth=None for
+        the whole subtree). Optionally write investment / active members back
+        to users.
+        """
+        started = time.monotonic()
+        if self.index._pending:
+            self.index.reindex()
+
+        for name, sql in self.METRICS.items():
+            values = self._load_metric(sql)
+            self.results[name] = (
+                self.downline_sums(values) if max_depth is None
+                else self.limited_downline_sums(values, max_depth)
+            )
+        aggregated = time.monotonic()
+
+        report = {
+            'users': int((self.index.parent >= -1).sum()),
+            'max_depth': max_depth,
+            'aggregate_seconds': round(aggregated - started, 3),
+            'users_updated': 0,
+            'write_seconds': 0.0,
+        }
+        if write:
+            report['users_updated'] = self.write_back(chunk_size)
+            report['write_seconds'] = round(time.monotonic() - aggregated, 3)
+
+        logger.info(
+            f"Subtree aggregation (max_depth={max_depth}): {report['users']} users in "
+            f"{report['aggregate_seconds']}s, {report['users_updated']} rows written in {report['write_seconds']}s"
+        )
+        return report
+
+    # -------------------------
+    # Aggregation
+    # -------------------------
+    def downline_sums(self, values: np.ndarray) -> np.ndarray:
+        """Whole-subtree sums minus own value, via one prefix sum over the tour"""
+        index = self.index
+        prefix = np.zeros(index.order.size + 1, dtype=np.float64)
+        np.cumsum(values[index.order], out=prefix[1:])
+
+        sums = np.zeros(values.size, dtype=np.float64)
+        reached = index.depth >= 0
+        sums[reached] = prefix[index.tout[reached]] - prefix[index.tin[reached]] - values[reached]
+        return sums
+
+    def limited_downline_sums(self, values: np.ndarray, max_depth: int = MAX_REFERRAL_DEPTH) -> np.ndarray:
+        """Sums over descendants 1..max_depth levels down, one vectorized pass per level"""
+        parent = self.index.parent.astype(np.int64)
+        n = parent.size
+        sums = np.zeros(n, dtype=np.float64)
+
+        carriers = np.flatnonzero(values != 0)
+        weights = values[carriers]
+        ancestor = parent[carriers]
+        for _ in range(max_depth):
+            live = ancestor >= 0
+            if not live.any():
+                break
+            ancestor, weights = ancestor[live], weights[live]
+            sums += np.bincount(ancestor, weights=weights, minlength=n)[:n]
+            ancestor = parent[ancestor]
+        return sums
+
+    def _load_metric(self, sql: str) -> np.ndarray:
+        values = np.zeros(self.index.parent.size, dtype=np.float64)
+        result = db.session.execute(
+            text(sql), execution_options={'stream_results': True, 'yield_per': self.fetch_size}
+        )
+        for partition in result.partitions(self.fetch_size):
+            chunk = np.array([(row[0], float(row[1] or 0)) for row in partition], dtype=np.float64).reshape(-1, 2)
+            ids = chunk[:, 0].astype(np.int64)
+            inside = ids < values.size
+            values[ids[inside]] = chunk[inside, 1]
+        return values
+
+    # -------------------------
+    # Write back
+    # -------------------------
+    def write_back(self, chunk_size: int = 5000) -> int:
+        """Bulk-update users whose investment / active member figures changed"""
+        investment = np.round(self.results['investment'], 2)
+        active = self.results['active_members'].astype(np.int64)
+
+        # Current values, streamed into arrays so only changed rows are written
+        stored_investment = np.zeros(investment.size, dtype=np.float64)
+        stored_active = np.zeros(active.size, dtype=np.int64)
+        present = np.zeros(investment.size, dtype=bool)
+        result = db.session.execute(
+            text(
+                """
+                SELECT id, COALESCE(network_total_investment, 0), COALESCE(network_active_members, 0)
+                FROM users
+                """
+            ),
+            execution_options={'stream_results': True, 'yield_per': self.fetch_size},
+        )
+        for partition in result.partitions(self.fetch_size):
+            chunk = np.array([(row[0], float(row[1]), row[2]) for row in partition], dtype=np.float64).reshape(-1, 3)
+            ids = chunk[:, 0].astype(np.int64)
+            inside = ids < present.size
+            ids = ids[inside]
+            present[ids] = True
+            stored_investment[ids] = chunk[inside, 1]
+            stored_active[ids] = chunk[inside, 2].astype(np.int64)
+
+        changed = np.flatnonzero(present & ((stored_investment != investment) | (stored_active != active)))
+        now = datetime.now(timezone.utc)
+        for start in range(0, changed.size, chunk_size):
+            ids = changed[start:start + chunk_size]
+            db.session.execute(
+                self.UPDATE_SQL,
+                [
+                    {
+                        'id': int(uid),
+                        'investment': Decimal(str(investment[uid])).quantize(Decimal('0.01')),
+                        'active': int(active[uid]),
+                        'now': now,
+                    }
+                    for uid in ids
+                ],
+            )
+            db.session.commit()
+        return int(changed.size)
+
+    def top(self, metric: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """Users with the largest downline value for a metric (fraud / analytics drill-down)"""
+        values = self.results[metric]
+        limit = min(limit, values.size)
+        best = np.argpartition(-values, limit - 1)[:limit] if limit else np.empty(0, dtype=np.int64)
+        best = best[np.argsort(-values[best])]
+        return [{'user_id': int(uid), metric: float(values[uid])} for uid in best if values[uid] > 0]
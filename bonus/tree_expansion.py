@@ -0,0 +1,101 @@
+# bonus/tree_expansion.py
+import logging
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy import text
+
+from extensions import db
+from bonus.cache_strategy import tree_node_cache
+from bonus.refferral_tree import ReferralTreeHelper, MAX_REFERRAL_DEPTH
+
+logger = logging.getLogger(__name__)
+
+TREE_CHILDREN_PAGE_SIZE = 30
+TREE_CHILDREN_MAX_PAGE_SIZE = 100
+TREE_MAX_NODES_PER_CALL = 20
+
+
+class TreeExpansion:
+    """
+    On-demand expansion of the referral tree for the network visualizer.
+
+    A node expands to one keyset page of its direct children (users.referred_by,
+    the source of truth for both tree backends). Each child carries the
+    maintained counters, so the UI can show child counts and (20-level)
+    subtree sizes without loading the subtree. Pages are cached per node in
+    tree_node_cache.
+    """
+
+    @staticmethod
+    def visible_depths(root_id: int, node_ids: List[int]) -> Dict[int, int]:
+        """Depth below root_id of every node the root may expand (itself or its <= 20-level downline)"""
+        chains = ReferralTreeHelper.get_ancestors_bulk([n for n in node_ids if n != root_id], MAX_REFERRAL_DEPTH)
+        depths = {node_id: chain.index(root_id) + 1 for node_id, chain in chains.items() if root_id in chain}
+        if root_id in node_ids:
+            depths[root_id] = 0
+        return depths
+
+    @staticmethod
+    def children_page(node_id: int, limit: int = TREE_CHILDREN_PAGE_SIZE, after: int = 0) -> Dict[str, Any]:
+        """One page of a node's direct children, ordered by id"""
+        cached = tree_node_cache.get(node_id, (after, limit))
+        if cached is not None:
+            return cached
+
+        rows = db.session.execute(
+            text("""
+                SELECT id, username, is_active,
+                       COALESCE(direct_referrals_count, 0) AS children,
+                       COALESCE(total_network_size, 0) AS size
+                FROM users
+                WHERE referred_by = :node_id AND id > :after
+                ORDER BY id
+                LIMIT :fetch
+            """),
+            {'node_id': node_id, 'after': after, 'fetch': limit + 1},
+        ).fetchall()
+
+        children = [
+            {'id': row.id, 'username': row.username, 'active': bool(row.is_active),
+             'children': row.children, 'size': row.size}
+            for row in rows[:limit]
+        ]
+        page = {
+            'id': node_id,
+            'children': children,
+            'next_after': children[-1]['id'] if len(rows) > limit else None,
+        }
+        tree_node_cache.set(node_id, (after, limit), page)
+        return page
+
+    @staticmethod
+    def expand(root_id: int, node_ids: List[int], limit: int = TREE_CHILDREN_PAGE_SIZE,
+               after: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Expand several nodes of root_id's tree in one call. `after` pages
+        through a single node's children. Nodes outside the root's visible
+        tree are listed under 'forbidden'.
+        """
+        node_ids = list(dict.fromkeys(node_ids))
+        if not node_ids or len(node_ids) > TREE_MAX_NODES_PER_CALL:
+            raise ValueError(f"between 1 and {TREE_MAX_NODES_PER_CALL} nodes per call")
+        if after is not None and len(node_ids) != 1:
+            raise ValueError("after can only be used when expanding a single node")
+        limit = min(max(limit, 1), TREE_CHILDREN_MAX_PAGE_SIZE)
+
+        depths = TreeExpansion.visible_depths(root_id, node_ids)
+        nodes = []
+        for node_id in node_ids:
+            if node_id not in depths:
+                continue
+            page = dict(TreeExpansion.children_page(node_id, limit, after or 0))
+            page['depth'] = depths[node_id]
+            if page['depth'] >= MAX_REFERRAL_DEPTH:
+                page['children'], page['next_after'] = [], None  # below the network's 20-level horizon
+            nodes.append(page)
+
+        return {
+            'root_id': root_id,
+            'nodes': nodes,
+            'forbidden': [node_id for node_id in node_ids if node_id not in depths],
+        }
@@ -0,0 +1,186 @@
+# bonus/tree_queue.py
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import text
+
+from extensions import db
+from models import TreeUpdateJob
+from bonus.job_queue import DurableJobQueue
+
+logger = logging.getLogger(__name__)
+
+
+class TreeUpdateQueue(DurableJobQueue):
+    """
+    Durable queue (see DurableJobQueue) for post-signup referral tree inserts.
+
+    signup() adds a TreeUpdateJob in the same transaction as the user, and
+    workers run ReferralTreeHelper.add_new_user for it. A job whose
+    referrer is not in the tree yet is deferred until it is.
+    find_missing() / replay_missing() catch users that never got a job at
+    all (e.g. signups from before the queue existed) or whose closure chain
+    is truncated.
+    """
+
+    table = 'tree_update_jobs'
+    key_column = 'user_id'
+    job_columns = 'user_id, referrer_id'
+    job_label = 'Tree update for user'
+    worker_name = 'tree-update'
+
+    def __init__(self, workers: int = 2, batch_size: int = 50, poll_interval: float = 2.0,
+                 max_attempts: int = 8, lease_seconds: int = 60):
+        super().__init__(workers, batch_size, poll_interval, max_attempts, lease_seconds)
+
+    # -------------------------
+    # Producer side
+    # -------------------------
+    @staticmethod
+    def enqueue(user_id: int, referrer_id: int) -> TreeUpdateJob:
+        """Add a job to the current transaction; the caller commits"""
+        job = TreeUpdateJob(
+            user_id=user_id,
+            referrer_id=referrer_id,
+            status='pending',
+            attempt_count=0,
+            next_attempt=datetime.now(timezone.utc),
+        )
+        db.session.add(job)
+        return job
+
+    # -------------------------
+    # Consumer side
+    # -------------------------
+    def _handle(self, job: Dict[str, Any]) -> Optional[str]:
+        from bonus.refferral_tree import ReferralTreeHelper
+
+        if not ReferralTreeHelper.add_new_user(job['user_id'], job['referrer_id']):
+            return "add_new_user returned False"
+        self._finish(job, 'done')
+        db.session.commit()
+        return None
+
+    def _blocker(self, job: Dict[str, Any]) -> Tuple[Optional[str], bool]:
+        """
+        Why the job can't run yet (None if it can), and whether it is waiting
+        on the referrer's still-open job. add_new_user copies the
+        referrer's ancestor rows, so running before the referrer's own insert
+        has committed (its job pending, retrying or in another worker) leaves
+        the child with a truncated chain that nothing extends later.
+        """
+        referrer_job = db.session.execute(
+            text("""
+                SELECT status FROM tree_update_jobs
+                WHERE user_id = :referrer_id AND status IN ('pending', 'processing')
+            """),
+            {'referrer_id': job['referrer_id']},
+        ).scalar()
+        if referrer_job:
+            return f"referrer {job['referrer_id']} job still {referrer_job}", True
+
+        # A referrer with a sponsor of its own must already hang off it
+        missing_link = db.session.execute(
+            text("""
+                SELECT 1 FROM users u
+                WHERE u.id = :referrer_id AND u.referred_by IS NOT NULL
+                  AND NOT EXISTS (
+                      SELECT 1 FROM referral_network rn
+                      WHERE rn.ancestor_id = u.referred_by AND rn.descendant_id = u.id AND rn.depth = 1
+                  )
+            """),
+            {'referrer_id': job['referrer_id']},
+        ).scalar()
+        if missing_link:
+            return f"referrer {job['referrer_id']} is not in the tree yet", False
+        return None, False
+
+    # -------------------------
+    # Replay
+    # -------------------------
+    @staticmethod
+    def find_missing(limit: int = 1000) -> List[Dict[str, int]]:
+        """
+        Users with a sponsor and no open job whose closure chain is shorter
+        than their referred_by chain (capped at MAX_REFERRAL_DEPTH): no
+        depth-1 row at all, or a chain truncated because the user was
+        inserted before its referrer was. stored_depth / expected_depth tell
+        the two apart.
+        """
+        from bonus.refferral_tree import MAX_REFERRAL_DEPTH
+
+        rows = db.session.execute(
+            text("""
+                WITH RECURSIVE chain (user_id, ancestor_id, depth) AS (
+                    SELECT id, referred_by, 1 FROM users WHERE referred_by IS NOT NULL
+                    UNION ALL
+                    SELECT c.user_id, u.referred_by, c.depth + 1
+                    FROM chain c
+                    JOIN users u ON u.id = c.ancestor_id
+                    WHERE u.referred_by IS NOT NULL AND c.depth < :max_depth
+                ),
+                expected AS (
+                    SELECT user_id, MAX(depth) AS depth FROM chain GROUP BY user_id
+                ),
+                stored AS (
+                    SELECT descendant_id AS user_id, COUNT(*) AS depth
+                    FROM referral_network
+                    WHERE depth BETWEEN 1 AND :max_depth
+                    GROUP BY descendant_id
+                )
+                SELECT u.id AS user_id, u.referred_by AS referrer_id,
+                       COALESCE(s.depth, 0) AS stored_depth, e.depth AS expected_depth
+                FROM users u
+                JOIN expected e ON e.user_id = u.id
+                LEFT JOIN stored s ON s.user_id = u.id
+                LEFT JOIN tree_update_jobs j
+                    ON j.user_id = u.id AND j.status IN ('pending', 'processing')
+                WHERE COALESCE(s.depth, 0) < e.depth AND j.id IS NULL
+                ORDER BY u.id
+                LIMIT :limit
+            """),
+            {'limit': limit, 'max_depth': MAX_REFERRAL_DEPTH},
+        )
+        return [dict(row._mapping) for row in rows]
+
+    @staticmethod
+    def replay_missing(limit: int = 1000, include_failed: bool = True) -> Dict[str, int]:
+        """
+        Re-queue failed jobs and enqueue jobs for users that never got one or
+        whose chain is truncated. Re-running add_new_user for a truncated
+        user bumps counters its existing ancestors already counted, so run
+        NetworkCounterHelper.verify_counters(fix=True) once those drain.
+        """
+        now = datetime.now(timezone.utc)
+        requeued = TreeUpdateQueue._requeue_failed(now) if include_failed else 0
+
+        missing = TreeUpdateQueue.find_missing(limit)
+        if missing:
+            db.session.execute(
+                text("""
+                    INSERT INTO tree_update_jobs (user_id, referrer_id, status, attempt_count, next_attempt, created_at)
+                    VALUES (:user_id, :referrer_id, 'pending', 0, :now, :now)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        referrer_id = EXCLUDED.referrer_id, status = 'pending', attempt_count = 0,
+                        next_attempt = EXCLUDED.next_attempt, locked_at = NULL
+                """),
+                [
+                    {'user_id': row['user_id'], 'referrer_id': row['referrer_id'], 'now': now}
+                    for row in missing
+                ],
+            )
+        db.session.commit()
+        return {
+            'requeued_failed': requeued,
+            'enqueued_missing': len(missing),
+            'enqueued_truncated': sum(1 for row in missing if row['stored_depth'] > 0),
+        }
+
+
+# Create a singleton instance per worker process
+tree_update_queue = TreeUpdateQueue(
+    workers=int(os.getenv("TREE_QUEUE_WORKERS", "2")),
+    batch_size=int(os.getenv("TREE_QUEUE_BATCH_SIZE", "50")),
+)
@@ -2,48 +2,82 @@ from typing import List, Dict, Any, Optional, Tuple
 from decimal import Decimal
 from datetime import datetime, timedelta, timezone
 from flask import current_app
+from sqlalchemy import text, bindparam
 from models import ReferralBonus, Payment, User, ReferralNetwork
 from extensions import db
 
+
+class BonusValidationContext:
+    """
+    Everything validate_bonus_entry looks up for one batch, prefetched in
+    three queries: the payments, the recipient users, and the closure rows
+    linking recipients to the given descendants. Lookups are then in-memory.
+    """
+
+    def __init__(self, payments: Dict[int, Payment], users: Dict[int, Any], relationships: set):
+        self.payments = payments
+        self.users = users
+        self.relationships = relationships
+
+    @staticmethod
+    def prefetch(bonuses_data: List[Dict[str, Any]]) -> 'BonusValidationContext':
+        payment_ids = {_as_id(b.get('purchase_id')) for b in bonuses_data} - {None}
+        user_ids = {b['ancestor_id'] for b in bonuses_data if isinstance(b.get('ancestor_id'), int)}
+        descendant_ids = {_as_id(b.get('descendant_id')) for b in bonuses_data} - {None}
+
+        payments = {p.id: p for p in Payment.query.filter(Payment.id.in_(payment_ids))} if payment_ids else {}
+        users = {}
+        if user_ids:
+            rows = db.session.execute(
+                text("SELECT id, is_active FROM users WHERE id IN :ids").bindparams(bindparam('ids', expanding=True)),
+                {'ids': list(user_ids)},
+            )
+            users = {row.id: row for row in rows}
+        relationships = set()
+        if user_ids and descendant_ids:
+            rows = db.session.execute(
+                text("""
+                    SELECT ancestor_id, descendant_id, depth FROM referral_network
+                    WHERE descendant_id IN :descendants AND ancestor_id IN :ancestors
+                """).bindparams(bindparam('descendants', expanding=True), bindparam('ancestors', expanding=True)),
+                {'descendants': list(descendant_ids), 'ancestors': list(user_ids)},
+            )
+            relationships = {tuple(row) for row in rows}
+        return BonusValidationContext(payments, users, relationships)
+
+    def validate_purchase(self, payment_id) -> Tuple[bool, str]:
+        return BonusValidationHelper.check_purchase(self.payments.get(_as_id(payment_id)))
+
+    def validate_user_eligibility(self, user_id: int, level: int) -> Tuple[bool, str]:
+        return BonusValidationHelper.check_user(self.users.get(user_id))
+
+    def validate_network_relationship(self, descendant_id, ancestor_id: int, level: int) -> Tuple[bool, str]:
+        if not descendant_id:
+            return True, "Network validation skipped (no descendant_id provided)"
+        return BonusValidationHelper.check_relationship(
+            (ancestor_id, _as_id(descendant_id), level) in self.relationships, level
+        )
+
+
+def _as_id(value) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
 class BonusValidationHelper:
     """Production-grade bonus validation with comprehensive checks"""
 
     @staticmethod
-    def bonus_already_exists(purchase_id: int, ancestor_id: int, level: int, bonus_amount: Decimal) -> Tuple[bool, Optional[str]]:
-        """
-        DEBUG VERSION: Add logging to see what's happening
-        """
-        try:
-            try:
-                db.session.rollback()
-            except:
-                pass
-        
-            current_app.logger.info(f"🔍 Checking for existing bonus: purchase={purchase_id}, ancestor={ancestor_id}, level={level}, amount={bonus_amount}")
-            
-            existing = ReferralBonus.filter(
-                ReferralBonus.payment_id == purchase_id,
-                ReferralBonus.user_id == ancestor_id, 
-                ReferralBonus.level == level,
-                ReferralBonus.bonus_amount == bonus_amount
-            ).first()
-            
-            if existing:
-                current_app.logger.warning(f"⚠️ Found existing bonus: ID={existing.id}, Status={existing.status}")
-                return True, existing.status
-            else:
-                current_app.logger.info("✅ No existing bonus found")
-                return False, None
-                
-        except Exception as e:
-            current_app.logger.error(f"❌ Error checking existing bonus: {str(e)}")
-            return False, None
-   
-    @staticmethod
-    def validate_bonus_entry(bonus_data: Dict[str, Any]) -> Tuple[bool, str, Dict[str, Any]]:
+    def validate_bonus_entry(bonus_data: Dict[str, Any],
+                             context: Optional[BonusValidationContext] = None) -> Tuple[bool, str, Dict[str, Any]]:
         """
-        DEBUG VERSION: Find which method returns None
+        Validate one bonus. With a prefetched `context` (validate_bonus_batch)
+        the purchase / user / network lookups are in-memory; without it each
+        check queries the database.
         """
+        checks = context or BonusValidationHelper
         validation_details = {
             'checks_passed': [],
             'checks_failed': [],
@@ -101,23 +135,13 @@ class BonusValidationHelper:
             validation_details['checks_passed'].append('bonus_amount')
             print("✅ Bonus amount validation passed")
             
-            # 3. Duplicate bonus validation
-            print("🔍 STEP 3: Duplicate check")
-            exists, existing_status = BonusValidationHelper.bonus_already_exists(
-                purchase_id, ancestor_id, level, bonus_amount_decimal
-            )
-            if exists:
-                validation_details['checks_failed'].append({
-                    'check': 'duplicate_bonus', 
-                    'details': f'Bonus already exists with status: {existing_status}'
-                })
-                return False, f"Bonus already exists (status: {existing_status})", validation_details
-            validation_details['checks_passed'].append('duplicate_check')
-            print("✅ Duplicate check passed")
+            # 3. Duplicates are rejected by the unique security_hash /
+            #    unique_payment_user_level indexes when the batch is stored
+            #    (ReferralBonusStore.insert_many), not pre-queried
             
             # 4. Purchase validation
             print("🔍 STEP 4: Purchase validation")
-            purchase_result = BonusValidationHelper.validate_purchase(purchase_id)
+            purchase_result = checks.validate_purchase(purchase_id)
             print(f"Purchase result: {purchase_result}")
             if purchase_result is None:
                 raise Exception("validate_purchase returned None")
@@ -133,7 +157,7 @@ class BonusValidationHelper:
             
             # 5. User eligibility validation
             print("🔍 STEP 5: User eligibility validation")
-            eligibility_result = BonusValidationHelper.validate_user_eligibility(ancestor_id, level)
+            eligibility_result = checks.validate_user_eligibility(ancestor_id, level)
             print(f"User eligibility result: {eligibility_result}")
             if eligibility_result is None:
                 raise Exception("validate_user_eligibility returned None")
@@ -149,7 +173,7 @@ class BonusValidationHelper:
             
             # 6. Network relationship validation
             print("🔍 STEP 6: Network relationship validation")
-            network_result = BonusValidationHelper.validate_network_relationship(
+            network_result = checks.validate_network_relationship(
                 bonus_data.get('descendant_id'), ancestor_id, level
             )
             print(f"Network result: {network_result}")
@@ -200,6 +224,15 @@ class BonusValidationHelper:
         """
         try:
             payment = Payment.query.get(payment_id)  # now passing actual Payment.id
+            return BonusValidationHelper.check_purchase(payment)
+        except Exception as e:
+            current_app.logger.error(f"Purchase validation error for {payment_id}: {str(e)}")
+            return False, f"Purchase validation error: {str(e)}"
+
+    @staticmethod
+    def check_purchase(payment: Optional[Payment]) -> Tuple[bool, str]:
+        """Purchase rules on an already loaded payment"""
+        try:
             if not payment:
                 return False, "Payment not found"
             
@@ -222,7 +255,7 @@ class BonusValidationHelper:
             return True, "Valid purchase for bonus processing"
             
         except Exception as e:
-            current_app.logger.error(f"Purchase validation error for {payment_id}: {str(e)}")
+            current_app.logger.error(f"Purchase validation error for {getattr(payment, 'id', None)}: {str(e)}")
             return False, f"Purchase validation error: {str(e)}"
 
 
@@ -233,16 +266,21 @@ class BonusValidationHelper:
         """
         try:
             user = User.query.get(user_id)
-            if not user:
-                return False, "User not found"
-            
-            if not user.is_active:
-                return False, "User account is inactive"
-            return True, "User eligible"          
+            return BonusValidationHelper.check_user(user)
         except Exception as e:
             current_app.logger.error(f"User eligibility error for {user_id}: {str(e)}")
             return False, f"User eligibility check error: {str(e)}"
     
+    @staticmethod
+    def check_user(user) -> Tuple[bool, str]:
+        """Eligibility rules on an already loaded user (or users row)"""
+        if not user:
+            return False, "User not found"
+        
+        if not user.is_active:
+            return False, "User account is inactive"
+        return True, "User eligible"
+    
     @staticmethod
     def validate_network_relationship(descendant_id: int, ancestor_id: int, level: int) -> Tuple[bool, str]:
         """
@@ -256,19 +294,19 @@ class BonusValidationHelper:
                 descendant_id=descendant_id,
                 depth=level
             ).first()
-            
-            if not relationship:
-                return False, f"No network relationship found for level {level}"
-            
-            if not getattr(relationship, 'is_active', True):
-                return False, "Network relationship is inactive"
-            
-            return True, "Valid network relationship"
+            return BonusValidationHelper.check_relationship(relationship is not None, level)
             
         except Exception as e:
             current_app.logger.error(f"Network validation error: {str(e)}")
             return False, f"Network validation error: {str(e)}"
     
+    @staticmethod
+    def check_relationship(found: bool, level: int) -> Tuple[bool, str]:
+        """Closure rows carry no active flag, so existence at the right depth is the whole rule"""
+        if not found:
+            return False, f"No network relationship found for level {level}"
+        return True, "Valid network relationship"
+    
     @staticmethod
     def validate_business_rules(bonus_data: Dict[str, Any]) -> Tuple[bool, str]:
         """
@@ -302,8 +340,20 @@ class BonusValidationHelper:
     @staticmethod
     def validate_bonus_batch(bonuses_data: List[Dict[str, Any]]) -> Tuple[List[Dict], List[Dict], Dict[str, Any]]:
         """
-        ENHANCED: Batch validation with comprehensive reporting
+        ENHANCED: Batch validation with comprehensive reporting.
+        Payments, recipients and closure rows are prefetched once
+        (BonusValidationContext), so the batch costs three queries
+        instead of several per entry; verdicts match validate_bonus_entry.
         """
+        try:
+            # Savepoint: callers such as PurchasePipeline hold locks and unflushed
+            # fixes in the surrounding transaction, which a full rollback would drop
+            with db.session.begin_nested():
+                context = BonusValidationContext.prefetch(bonuses_data)
+        except Exception as e:
+            current_app.logger.error(f"Bonus batch prefetch failed, validating per entry: {str(e)}")
+            context = None
+        
         batch_validation = {
             'total_bonuses': len(bonuses_data),
             'valid_count': 0,
@@ -326,7 +376,7 @@ class BonusValidationHelper:
                 'errors': []
             }
             
-            is_valid, error_message, validation_details = BonusValidationHelper.validate_bonus_entry(bonus_data)
+            is_valid, error_message, validation_details = BonusValidationHelper.validate_bonus_entry(bonus_data, context)
             
             if is_valid:
                 valid_bonuses.append(bonus_data)
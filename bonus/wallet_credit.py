@@ -0,0 +1,114 @@
+# bonus/wallet_credit.py
+import logging
+from decimal import Decimal
+from typing import Dict, Iterable, Tuple
+
+from sqlalchemy import text, bindparam, insert
+
+from extensions import db
+from models import Transaction
+
+logger = logging.getLogger(__name__)
+
+
+class WalletCreditService:
+    """
+    Credits many users' balances (users.available_balance / actual_balance)
+    at once and records one completed Transaction per credited user.
+
+    Amounts for the same user are coalesced first. Recipient rows are then
+    locked in ascending id order, so concurrent purchases that share
+    ancestors queue behind each other instead of deadlocking. The lock is
+    FOR NO KEY UPDATE: callers usually hold FK KEY SHARE locks on the same
+    rows from inserting referral_bonuses, which FOR UPDATE would wait on. All
+    increments go out as one UPDATE ... FROM (VALUES ...) (an executemany
+    on SQLite), and the transactions as one multi-row insert. Nothing is
+    committed here; the caller owns the transaction.
+    """
+
+    @staticmethod
+    def coalesce(credits: Iterable[Tuple[int, Decimal]]) -> Dict[int, Decimal]:
+        totals: Dict[int, Decimal] = {}
+        for user_id, amount in credits:
+            totals[user_id] = totals.get(user_id, Decimal('0')) + Decimal(str(amount))
+        return {user_id: totals[user_id] for user_id in sorted(totals) if totals[user_id] > 0}
+
+    @staticmethod
+    def credit(credits: Iterable[Tuple[int, Decimal]], reference: str,
+               transaction_type: str = 'referral_bonus') -> Dict[int, Decimal]:
+        """
+        Apply (user_id, amount) credits. Each user's transaction gets the
+        reference f"{reference}_{user_id}". Returns the per-user totals applied.
+        """
+        totals = WalletCreditService.coalesce(credits)
+        if not totals:
+            return {}
+        user_ids = list(totals)  # ascending
+
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(
+                text("SELECT id FROM users WHERE id IN :ids ORDER BY id FOR NO KEY UPDATE")
+                .bindparams(bindparam('ids', expanding=True)),
+                {'ids': user_ids},
+            )
+            WalletCreditService._update_values(totals)
+        else:
+            # SQLite serializes writers; no row locks to order
+            db.session.execute(
+                text("""
+                    UPDATE users SET
+                        available_balance = COALESCE(available_balance, 0) + :amount,
+                        actual_balance = COALESCE(actual_balance, 0) + :amount
+                    WHERE id = :user_id
+                """).bindparams(bindparam('amount', type_=db.Numeric(18, 2))),
+                [{'user_id': user_id, 'amount': amount} for user_id, amount in totals.items()],
+            )
+
+        wallet_ids = WalletCreditService._ensure_wallets(user_ids)
+        db.session.execute(
+            insert(Transaction),
+            [
+                {
+                    'user_id': user_id,
+                    'wallet_id': wallet_ids[user_id],
+                    'type': transaction_type,
+                    'amount': amount,
+                    'status': 'completed',
+                    'reference': f"{reference}_{user_id}",
+                }
+                for user_id, amount in totals.items()
+            ],
+        )
+        logger.info(f"Credited {len(totals)} users, {sum(totals.values())} total ({reference})")
+        return totals
+
+    @staticmethod
+    def _update_values(totals: Dict[int, Decimal]) -> None:
+        values, params = [], {}
+        for i, (user_id, amount) in enumerate(totals.items()):
+            values.append(f"(CAST(:u{i} AS INTEGER), CAST(:a{i} AS NUMERIC(18, 2)))")
+            params[f"u{i}"], params[f"a{i}"] = user_id, str(amount)
+        db.session.execute(
+            text(f"""
+                UPDATE users SET
+                    available_balance = COALESCE(users.available_balance, 0) + c.amount,
+                    actual_balance = COALESCE(users.actual_balance, 0) + c.amount
+                FROM (VALUES {', '.join(values)}) AS c (user_id, amount)
+                WHERE users.id = c.user_id
+            """),
+            params,
+        )
+
+    @staticmethod
+    def _ensure_wallets(user_ids) -> Dict[int, int]:
+        db.session.execute(
+            text("""
+                INSERT INTO wallets (user_id, balance, currency) VALUES (:user_id, 0, 'UGX')
+                ON CONFLICT (user_id) DO NOTHING
+            """),
+            [{'user_id': user_id} for user_id in user_ids],
+        )
+        return dict(db.session.execute(
+            text("SELECT user_id, id FROM wallets WHERE user_id IN :ids").bindparams(bindparam('ids', expanding=True)),
+            {'ids': list(user_ids)},
+        ).fetchall())
@@ -0,0 +1,38 @@
+# build_network_snapshots.py
+# Usage: python build_network_snapshots.py [--date YYYY-MM-DD] [--chunk-size 5000]
+#
+# Nightly job: writes one network_snapshots row per user with a downline.
+# Re-running for the same date overwrites that day's rows.
+
+import argparse
+import json
+from datetime import date
+
+from app import create_app
+from bonus.network_snapshots import NetworkSnapshotBuilder
+
+
+def print_progress(progress):
+    print(
+        f"users <= {progress['last_user_id']}/{progress['max_user_id']} | "
+        f"+{progress['chunk_rows']} rows | {progress['rows_written']} total | "
+        f"{progress['rows_per_sec']:.0f} rows/s",
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build daily network snapshots")
+    parser.add_argument("--date", type=date.fromisoformat, default=None, help="snapshot date (default: today, UTC)")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="ancestor ids per grouped scan")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        builder = NetworkSnapshotBuilder(snapshot_date=args.date, chunk_size=args.chunk_size, progress=print_progress)
+        report = builder.run()
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+# compute_network_aggregates.py
+# Usage: python compute_network_aggregates.py [--full-depth] [--dry-run] [--top 10]
+#
+# Recomputes users.network_total_investment / network_active_members for every
+# user in one pass over the in-memory referral forest. Default is the 20-level
+# bonus-plan downline; --full-depth sums whole subtrees instead.
+
+import argparse
+import json
+
+from app import create_app
+from bonus.refferral_tree import MAX_REFERRAL_DEPTH
+from bonus.subtree_aggregation import SubtreeAggregator
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate downline investment and activity for all users")
+    parser.add_argument("--full-depth", action="store_true", help="sum whole subtrees, not just 20 levels")
+    parser.add_argument("--dry-run", action="store_true", help="compute and report without writing users")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="users per bulk UPDATE")
+    parser.add_argument("--top", type=int, default=0, help="print the N largest downlines per metric")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        aggregator = SubtreeAggregator()
+        report = aggregator.run(
+            max_depth=None if args.full_depth else MAX_REFERRAL_DEPTH,
+            write=not args.dry_run,
+            chunk_size=args.chunk_size,
+        )
+        if args.top:
+            report['top'] = {metric: aggregator.top(metric, args.top) for metric in aggregator.METRICS}
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@ class Config:
     SECRET_KEY = os.getenv("SECRET_KEY")
     if not SECRET_KEY:
         raise ValueError("SECRET_KEY must be set in production")
+    BONUS_HASH_KEY = os.getenv("BONUS_HASH_KEY")  # HMAC key for referral_bonuses.security_hash (defaults to SECRET_KEY)
     
     FLASK_ENV = os.getenv("FLASK_ENV", "production")
     DEBUG = os.getenv("DEBUG", "False").lower() in ("true", "1", "t")
@@ -0,0 +1,46 @@
+# forest_index_report.py
+# Usage: python forest_index_report.py [--fetch-size 100000]
+#
+# Loads the in-memory referral forest index and compares its footprint with
+# the referral_network closure table.
+
+import argparse
+import json
+import time
+
+from sqlalchemy import text
+
+from app import create_app
+from extensions import db
+from bonus.forest_index import ReferralForestIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the referral forest index and report its memory footprint")
+    parser.add_argument("--fetch-size", type=int, default=100000, help="rows per streamed fetch")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        started = time.monotonic()
+        index = ReferralForestIndex.from_db(fetch_size=args.fetch_size)
+        report = index.memory_footprint()
+        report['load_seconds'] = round(time.monotonic() - started, 3)
+
+        closure_rows = db.session.execute(text("SELECT COUNT(*) FROM referral_network")).scalar() or 0
+        report['closure_rows'] = closure_rows
+        report['closure_rows_per_user'] = round(closure_rows / report['users'], 2) if report['users'] else 0.0
+        if db.engine.dialect.name == 'postgresql':
+            closure_bytes = db.session.execute(
+                text("SELECT pg_total_relation_size('referral_network')")
+            ).scalar() or 0
+            report['closure_total_bytes'] = closure_bytes
+            report['closure_mb_per_million_users'] = (
+                round(closure_bytes / report['users'] * 1_000_000 / 2 ** 20, 2) if report['users'] else 0.0
+            )
+
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+# growth_counters.py
+# Usage: python growth_counters.py backfill [--chunk-size 5000]
+#        python growth_counters.py compact [--keep-days 90] [--chunk-size 5000]
+#
+# Maintains referral_level_growth (new downline members per ancestor, level
+# and day). `backfill` rebuilds every bucket from the closure table and
+# users.created_at; `compact` folds old day buckets into month buckets
+# (run it nightly after the snapshot job).
+
+import argparse
+import json
+
+from app import create_app
+from bonus.network_counters import GrowthCounterHelper
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill or compact per-level daily growth counters")
+    parser.add_argument("command", choices=["backfill", "compact"])
+    parser.add_argument("--chunk-size", type=int, default=5000, help="ancestor ids per transaction")
+    parser.add_argument("--keep-days", type=int, default=90, help="days kept at daily resolution (compact)")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.command == "backfill":
+            report = {"day_buckets_written": GrowthCounterHelper.backfill(chunk_size=args.chunk_size)}
+            report["day_buckets_compacted"] = GrowthCounterHelper.compact(args.keep_days, args.chunk_size)
+        else:
+            report = {"day_buckets_compacted": GrowthCounterHelper.compact(args.keep_days, args.chunk_size)}
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
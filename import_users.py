@@ -0,0 +1,44 @@
+# import_users.py
+# Usage: python import_users.py partners.csv [--dry-run] [--chunk-size 1000]
+#
+# Bulk-imports partner users and their sponsor links. Accepts CSV (header:
+# username,phone,email,sponsor,password_hash) or a JSON list of the same keys.
+# `sponsor` is the phone of another row in the file, or the phone / referral
+# code of an existing user. Rows without password_hash must reset their password.
+
+import argparse
+import csv
+import json
+
+from app import create_app
+from bonus.bulk_import import BulkUserImporter
+
+
+def load_records(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".json"):
+            return json.load(f)
+        return list(csv.DictReader(f))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import users with their sponsors")
+    parser.add_argument("path", help="CSV or JSON file of users")
+    parser.add_argument("--dry-run", action="store_true", help="validate and insert, then roll back")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="rows per multi-row INSERT")
+    args = parser.parse_args()
+
+    records = load_records(args.path)
+
+    app = create_app()
+    with app.app_context():
+        report = BulkUserImporter(chunk_size=args.chunk_size).run(records, dry_run=args.dry_run)
+
+    for rejection in report["rejected"]:
+        print(f"row {rejection['row']}: {rejection['phone']} rejected ({rejection['reason']})")
+    report["rejected"] = len(report["rejected"])
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""add referral_level_growth daily/monthly bucket counters
+
+Revision ID: a4d6e8b20c53
+Revises: f3c8d2a61e07
+Create Date: 2026-10-17 19:58:03.552817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d6e8b20c53'
+down_revision = 'f3c8d2a61e07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('referral_level_growth',
+    sa.Column('ancestor_id', sa.Integer(), nullable=False),
+    sa.Column('period', sa.String(length=5), nullable=False),
+    sa.Column('bucket_start', sa.Date(), nullable=False),
+    sa.Column('depth', sa.Integer(), nullable=False),
+    sa.Column('member_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['ancestor_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('ancestor_id', 'period', 'bucket_start', 'depth')
+    )
+    # Filled by `python growth_counters.py backfill`, which is chunked and can run online
+
+
+def downgrade():
+    op.drop_table('referral_level_growth')
@@ -0,0 +1,26 @@
+"""add (referred_by, id) index on users for lazy tree expansion
+
+Revision ID: b2f9e4c7d816
+Revises: a4d6e8b20c53
+Create Date: 2026-10-17 21:14:26.730551
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2f9e4c7d816'
+down_revision = 'a4d6e8b20c53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.create_index('idx_user_referred_by_id', ['referred_by', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_index('idx_user_referred_by_id')
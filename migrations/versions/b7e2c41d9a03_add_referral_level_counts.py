@@ -0,0 +1,51 @@
+"""add referral_level_counts and backfill network counters
+
+Revision ID: b7e2c41d9a03
+Revises: 633bbda79514
+Create Date: 2026-10-17 09:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2c41d9a03'
+down_revision = '633bbda79514'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('referral_level_counts',
+    sa.Column('ancestor_id', sa.Integer(), nullable=False),
+    sa.Column('depth', sa.Integer(), nullable=False),
+    sa.Column('member_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['ancestor_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('ancestor_id', 'depth')
+    )
+
+    # Backfill from the closure table so counters start out exact
+    op.execute("""
+        INSERT INTO referral_level_counts (ancestor_id, depth, member_count)
+        SELECT ancestor_id, depth, COUNT(*)
+        FROM referral_network
+        WHERE depth > 0
+        GROUP BY ancestor_id, depth
+    """)
+    op.execute("""
+        UPDATE users SET
+            total_network_size = COALESCE((
+                SELECT SUM(member_count) FROM referral_level_counts lc WHERE lc.ancestor_id = users.id
+            ), 0),
+            direct_referrals_count = COALESCE((
+                SELECT member_count FROM referral_level_counts lc WHERE lc.ancestor_id = users.id AND lc.depth = 1
+            ), 0),
+            network_depth = COALESCE((
+                SELECT MAX(depth) FROM referral_network rn WHERE rn.descendant_id = users.id
+            ), 0)
+    """)
+
+
+def downgrade():
+    op.drop_table('referral_level_counts')
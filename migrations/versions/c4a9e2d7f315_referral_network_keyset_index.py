@@ -0,0 +1,30 @@
+"""extend referral_network ancestor/depth index with descendant_id for keyset paging
+
+Revision ID: c4a9e2d7f315
+Revises: b7e2c41d9a03
+Create Date: 2026-10-17 11:40:05.532871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a9e2d7f315'
+down_revision = 'b7e2c41d9a03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # (ancestor_id, depth, descendant_id) serves both the old (ancestor_id, depth)
+    # lookups and ORDER BY depth, descendant_id downline pages without a sort
+    with op.batch_alter_table('referral_network', schema=None) as batch_op:
+        batch_op.create_index('idx_network_ancestor_depth_descendant', ['ancestor_id', 'depth', 'descendant_id'], unique=False)
+        batch_op.drop_index('idx_network_ancestor_depth')
+
+
+def downgrade():
+    with op.batch_alter_table('referral_network', schema=None) as batch_op:
+        batch_op.create_index('idx_network_ancestor_depth', ['ancestor_id', 'depth'], unique=False)
+        batch_op.drop_index('idx_network_ancestor_depth_descendant')
@@ -0,0 +1,51 @@
+"""add mega_sponsors and mega_sponsor_downline for high fan-out tree nodes
+
+Revision ID: c7e1a9d4f250
+Revises: b2f9e4c7d816
+Create Date: 2026-10-17 22:37:49.184426
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e1a9d4f250'
+down_revision = 'b2f9e4c7d816'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('mega_sponsors',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('reason', sa.String(length=10), nullable=False),
+    sa.Column('network_size', sa.Integer(), nullable=False),
+    sa.Column('active_sketch', sa.LargeBinary(), nullable=True),
+    sa.Column('active_estimate', sa.Integer(), nullable=True),
+    sa.Column('exact_active_members', sa.Integer(), nullable=True),
+    sa.Column('promoted_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('refreshed_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('recounted_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_table('mega_sponsor_downline',
+    sa.Column('ancestor_id', sa.Integer(), nullable=False),
+    sa.Column('depth', sa.Integer(), nullable=False),
+    sa.Column('descendant_id', sa.Integer(), nullable=False),
+    sa.Column('joined_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('is_active', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['ancestor_id'], ['mega_sponsors.user_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('ancestor_id', 'depth', 'descendant_id')
+    )
+    with op.batch_alter_table('mega_sponsor_downline', schema=None) as batch_op:
+        batch_op.create_index('idx_mega_downline_active', ['ancestor_id', 'is_active', 'depth', 'descendant_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('mega_sponsor_downline', schema=None) as batch_op:
+        batch_op.drop_index('idx_mega_downline_active')
+
+    op.drop_table('mega_sponsor_downline')
+    op.drop_table('mega_sponsors')
@@ -0,0 +1,40 @@
+"""per-package overrides and updated_at on referral_bonus_plan
+
+Revision ID: d5b8f1a3c692
+Revises: c7e1a9d4f250
+Create Date: 2026-10-17 23:58:12.604318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5b8f1a3c692'
+down_revision = 'c7e1a9d4f250'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('referral_bonus_plan', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('package_catalog_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True))
+        batch_op.create_foreign_key('fk_bonus_plan_package_catalog', 'packagecatalog', ['package_catalog_id'], ['id'])
+        batch_op.drop_constraint('referral_bonus_plan_level_key', type_='unique')
+        batch_op.create_index('uq_bonus_plan_default_level', ['level'], unique=True,
+                              postgresql_where=sa.text('package_catalog_id IS NULL'),
+                              sqlite_where=sa.text('package_catalog_id IS NULL'))
+        batch_op.create_index('uq_bonus_plan_package_level', ['package_catalog_id', 'level'], unique=True,
+                              postgresql_where=sa.text('package_catalog_id IS NOT NULL'),
+                              sqlite_where=sa.text('package_catalog_id IS NOT NULL'))
+
+
+def downgrade():
+    with op.batch_alter_table('referral_bonus_plan', schema=None) as batch_op:
+        batch_op.drop_index('uq_bonus_plan_package_level')
+        batch_op.drop_index('uq_bonus_plan_default_level')
+        batch_op.create_unique_constraint('referral_bonus_plan_level_key', ['level'])
+        batch_op.drop_constraint('fk_bonus_plan_package_catalog', type_='foreignkey')
+        batch_op.drop_column('updated_at')
+        batch_op.drop_column('package_catalog_id')
@@ -0,0 +1,44 @@
+"""add tree_update_jobs queue for post-signup referral tree inserts
+
+Revision ID: d81f5b3c9e27
+Revises: c4a9e2d7f315
+Create Date: 2026-10-17 14:22:51.907342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81f5b3c9e27'
+down_revision = 'c4a9e2d7f315'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('tree_update_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('referrer_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempt_count', sa.Integer(), nullable=False),
+    sa.Column('next_attempt', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('locked_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('processed_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['referrer_id'], ['users.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id')
+    )
+    with op.batch_alter_table('tree_update_jobs', schema=None) as batch_op:
+        batch_op.create_index('idx_tree_jobs_status_attempt', ['status', 'next_attempt'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('tree_update_jobs', schema=None) as batch_op:
+        batch_op.drop_index('idx_tree_jobs_status_attempt')
+
+    op.drop_table('tree_update_jobs')
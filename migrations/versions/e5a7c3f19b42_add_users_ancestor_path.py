@@ -0,0 +1,35 @@
+"""add users.ancestor_path for the materialized-path referral tree backend
+
+Revision ID: e5a7c3f19b42
+Revises: d81f5b3c9e27
+Create Date: 2026-10-17 16:05:12.418903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a7c3f19b42'
+down_revision = 'd81f5b3c9e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    is_postgres = op.get_bind().dialect.name == 'postgresql'
+    path_type = postgresql.ARRAY(sa.Integer()) if is_postgres else sa.Text()
+
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('ancestor_path', path_type, nullable=True))
+        if is_postgres:
+            batch_op.create_index('idx_user_ancestor_path', ['ancestor_path'], unique=False, postgresql_using='gin')
+        else:
+            batch_op.create_index('idx_user_ancestor_path', ['ancestor_path'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_index('idx_user_ancestor_path')
+        batch_op.drop_column('ancestor_path')
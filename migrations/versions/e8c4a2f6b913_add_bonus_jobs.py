@@ -0,0 +1,42 @@
+"""add bonus_jobs queue for off-request referral bonus distribution
+
+Revision ID: e8c4a2f6b913
+Revises: d5b8f1a3c692
+Create Date: 2026-10-18 09:41:27.315806
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8c4a2f6b913'
+down_revision = 'd5b8f1a3c692'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('bonus_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('payment_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempt_count', sa.Integer(), nullable=False),
+    sa.Column('next_attempt', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('locked_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('processed_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['payment_id'], ['payments.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('payment_id')
+    )
+    with op.batch_alter_table('bonus_jobs', schema=None) as batch_op:
+        batch_op.create_index('idx_bonus_jobs_status_attempt', ['status', 'next_attempt'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('bonus_jobs', schema=None) as batch_op:
+        batch_op.drop_index('idx_bonus_jobs_status_attempt')
+
+    op.drop_table('bonus_jobs')
@@ -0,0 +1,41 @@
+"""add pg_trgm indexes on users for downline search
+
+Revision ID: f3c8d2a61e07
+Revises: e5a7c3f19b42
+Create Date: 2026-10-17 18:41:37.206115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c8d2a61e07'
+down_revision = 'e5a7c3f19b42'
+branch_labels = None
+depends_on = None
+
+TRGM_INDEXES = [
+    ('idx_user_username_trgm', 'username'),
+    ('idx_user_phone_trgm', 'phone'),
+    ('idx_user_referral_code_trgm', 'referral_code'),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        # SQLite has no trigram indexes; downline search uses an in-process n-gram index there
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, column in TRGM_INDEXES:
+        op.create_index(name, 'users', [column], unique=False,
+                        postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for name, _ in TRGM_INDEXES:
+        op.drop_index(name, table_name='users')
@@ -3,7 +3,8 @@ from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 import enum
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import UniqueConstraint, Index, event, Numeric, text, DateTime, func
+from sqlalchemy import UniqueConstraint, Index, event, Numeric, text, DateTime, func, TypeDecorator
+from sqlalchemy.dialects import postgresql
 from extensions import db
 from werkzeug.security import check_password_hash, generate_password_hash
 from enum import Enum
@@ -35,6 +36,33 @@ def utc_iso(dt: Optional[datetime]) -> Optional[str]:
     dt = ensure_utc(dt)
     return dt.isoformat() if dt else None
 
+
+class AncestorPath(TypeDecorator):
+    """
+    Capped ancestor path, nearest sponsor first ([parent, grandparent, ...]).
+    Postgres stores it as INTEGER[] (GIN-indexed for containment); other
+    databases get a comma-separated string.
+    """
+    impl = db.Text
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.ARRAY(db.Integer))
+        return dialect.type_descriptor(db.Text())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return ','.join(str(int(v)) for v in value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name == 'postgresql':
+            return list(value)
+        return [int(v) for v in value.split(',')] if value else []
+
 class TransactionType(Enum):
     PACKAGE = "package"
     DEPOSIT = "deposit"
@@ -118,6 +146,9 @@ class User(db.Model, BaseMixin):
     network_total_investment = db.Column(db.Numeric(18, 2), default=0)
     network_active_members = db.Column(db.Integer, default=0)
     last_network_calculation = db.Column(db.DateTime, nullable=True)
+
+    # Materialized-path layout benchmarked against the closure table (bench_tree_backends.py), <= 20 ancestors
+    ancestor_path = db.Column(AncestorPath, nullable=True)
     
     # Relationships
     network_ancestors = db.relationship(
@@ -136,7 +167,14 @@ class User(db.Model, BaseMixin):
     __table_args__ = (
     # For User
     Index('idx_user_phone', 'phone'),
-    Index('idx_user_referral_code', 'referral_code')
+    Index('idx_user_referral_code', 'referral_code'),
+    Index('idx_user_referred_by_id', 'referred_by', 'id'),  # direct children, keyset by id
+    Index('idx_user_ancestor_path', 'ancestor_path', postgresql_using='gin'),
+    # Downline search (pg_trgm); SQLite uses the in-process n-gram index instead
+    Index('idx_user_username_trgm', 'username', postgresql_using='gin', postgresql_ops={'username': 'gin_trgm_ops'}),
+    Index('idx_user_phone_trgm', 'phone', postgresql_using='gin', postgresql_ops={'phone': 'gin_trgm_ops'}),
+    Index('idx_user_referral_code_trgm', 'referral_code', postgresql_using='gin',
+          postgresql_ops={'referral_code': 'gin_trgm_ops'})
 
     )
     
@@ -617,19 +655,67 @@ class ReferralNetwork(db.Model, BaseMixin):
     
     # Index for efficient tree traversal
     __table_args__ = (
-        Index('idx_network_ancestor_depth', 'ancestor_id', 'depth'),
+        Index('idx_network_ancestor_depth_descendant', 'ancestor_id', 'depth', 'descendant_id'),  # keyset downline pages
         Index('idx_network_descendant_ancestor', 'descendant_id', 'ancestor_id'),
         UniqueConstraint('ancestor_id', 'descendant_id', name='uq_network_relationship'),
             #-- Indexes for performance
  
     )
 
+class ReferralLevelCount(db.Model):
+    """Maintained downline size per (ancestor, depth) so level breakdowns are O(1) reads"""
+    __tablename__ = 'referral_level_counts'
+
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    depth = db.Column(db.Integer, primary_key=True)  # 1-20
+    member_count = db.Column(db.Integer, nullable=False, default=0)
+
+class ReferralLevelGrowth(db.Model):
+    """New downline members per (ancestor, depth) per day, compacted to months once old"""
+    __tablename__ = 'referral_level_growth'
+
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    period = db.Column(db.String(5), primary_key=True)  # 'day' or 'month'
+    bucket_start = db.Column(db.Date, primary_key=True)  # the day, or the 1st of the month
+    depth = db.Column(db.Integer, primary_key=True)  # 1-20
+    member_count = db.Column(db.Integer, nullable=False, default=0)
+
+class MegaSponsor(db.Model):
+    """High fan-out tree nodes (system referrer, top sponsors) served from counters and sketches"""
+    __tablename__ = 'mega_sponsors'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    reason = db.Column(db.String(10), nullable=False)  # 'system' or 'fanout'
+    network_size = db.Column(db.Integer, nullable=False, default=0)
+    active_sketch = db.Column(db.LargeBinary)  # per-level HyperLogLog registers of active members
+    active_estimate = db.Column(db.Integer)
+    exact_active_members = db.Column(db.Integer)
+    promoted_at = db.Column(DateTime(timezone=True), server_default=func.now())
+    refreshed_at = db.Column(DateTime(timezone=True))
+    recounted_at = db.Column(DateTime(timezone=True))
+
+
+class MegaSponsorDownline(db.Model):
+    """Precomputed downline index of mega sponsors, same keyset order as referral_network"""
+    __tablename__ = 'mega_sponsor_downline'
+
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('mega_sponsors.user_id', ondelete='CASCADE'), primary_key=True)
+    depth = db.Column(db.Integer, primary_key=True)
+    descendant_id = db.Column(db.Integer, primary_key=True)
+    joined_at = db.Column(DateTime(timezone=True))
+    is_active = db.Column(db.Boolean, nullable=False, default=True)  # as of the last refresh
+
+    __table_args__ = (
+        Index('idx_mega_downline_active', 'ancestor_id', 'is_active', 'depth', 'descendant_id'),
+    )
+
 class ReferralBonusPlan(db.Model):
-    """Configurable bonus percentages for each level (1-20)"""
+    """Configurable bonus percentages for each level (1-20), optionally per package"""
     __tablename__ = 'referral_bonus_plan'
     
     id = db.Column(db.Integer, primary_key=True)
-    level = db.Column(db.Integer, nullable=False, unique=True)  # 1 to 20
+    level = db.Column(db.Integer, nullable=False)  # 1 to 20
+    package_catalog_id = db.Column(db.Integer, db.ForeignKey('packagecatalog.id'), nullable=True)  # NULL = default plan
     bonus_percentage = db.Column(db.Numeric(5, 4), nullable=False)  # e.g., 0.10 for 10%
     minimum_qualifying_amount = db.Column(db.Numeric(18, 2), default=0)  # Min package amount to qualify
     is_active = db.Column(db.Boolean, default=True)
@@ -637,10 +723,20 @@ class ReferralBonusPlan(db.Model):
     DateTime(timezone=True),
     server_default=func.now()
 )
+    updated_at = db.Column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now()
+    )
     
     __table_args__ = (
         db.CheckConstraint('level >= 1 AND level <= 20', name='chk_level_range'),
         db.CheckConstraint('bonus_percentage >= 0 AND bonus_percentage <= 1', name='chk_bonus_range'),
+        Index('uq_bonus_plan_default_level', 'level', unique=True,
+              postgresql_where=text('package_catalog_id IS NULL'), sqlite_where=text('package_catalog_id IS NULL')),
+        Index('uq_bonus_plan_package_level', 'package_catalog_id', 'level', unique=True,
+              postgresql_where=text('package_catalog_id IS NOT NULL'),
+              sqlite_where=text('package_catalog_id IS NOT NULL')),
     )
 
 class NetworkSnapshot(db.Model):
@@ -697,6 +793,47 @@ class BonusPayoutQueue(db.Model):
     
     def __repr__(self):
         return f'<Activity {self.id} {self.type} {self.title}>'
+
+
+class TreeUpdateJob(db.Model):
+    """Durable queue of referral tree inserts, written in the signup transaction"""
+    __tablename__ = 'tree_update_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, unique=True)
+    referrer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, processing, done, failed
+    attempt_count = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    locked_at = db.Column(DateTime(timezone=True), nullable=True)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    processed_at = db.Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index('idx_tree_jobs_status_attempt', 'status', 'next_attempt'),
+    )
+
+
+class BonusJob(db.Model):
+    """Durable queue of referral bonus runs, written with the completed payment"""
+    __tablename__ = 'bonus_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    payment_id = db.Column(db.Integer, db.ForeignKey('payments.id'), nullable=False, unique=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, processing, done, failed
+    attempt_count = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt = db.Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    locked_at = db.Column(DateTime(timezone=True), nullable=True)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    processed_at = db.Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index('idx_bonus_jobs_status_attempt', 'status', 'next_attempt'),
+    )
+
+
 class OTPRequest(db.Model):
     __tablename__ = "otp_requests"
 
@@ -0,0 +1,44 @@
+# rebuild_referral_network.py
+# Usage: python rebuild_referral_network.py [--batch-size 50000] [--restart] [--no-swap]
+#
+# Rebuilds the referral_network closure table from users.referred_by into a
+# shadow table and swaps it in. Safe to re-run: an interrupted build resumes
+# from its last committed checkpoint unless --restart is given.
+
+import argparse
+
+from app import create_app
+from bonus.closure_rebuild import ClosureTableRebuilder
+from bonus.network_counters import NetworkCounterHelper
+
+
+def print_progress(progress):
+    print(
+        f"depth {progress['depth']:>2} | users <= {progress['last_user_id']}/{progress['max_user_id']} | "
+        f"+{progress['batch_rows']} rows | {progress['rows_inserted']} total | "
+        f"{progress['rows_per_sec']:.0f} rows/s",
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the referral_network closure table")
+    parser.add_argument("--batch-size", type=int, default=50000, help="user ids per INSERT ... SELECT batch")
+    parser.add_argument("--restart", action="store_true", help="discard any checkpoint and start over")
+    parser.add_argument("--no-swap", action="store_true", help="build the shadow table but do not swap it in")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        rebuilder = ClosureTableRebuilder(batch_size=args.batch_size, progress=print_progress)
+        state = rebuilder.run(restart=args.restart, swap=not args.no_swap)
+        print(f"Closure rebuild {state['status']}: {state['rows_inserted']} rows")
+
+        if state['status'] == 'swapped':
+            # Downline counters are derived from the closure, so resync them
+            report = NetworkCounterHelper.verify_counters(fix=True)
+            print(f"Resynced network counters for {report['users_drifted']} users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+# refresh_mega_sponsors.py
+# Usage: python refresh_mega_sponsors.py [--threshold 50000] [--chunk-size 50000]
+#        python refresh_mega_sponsors.py --recount USER_ID
+#
+# Promotes the system referrer and every sponsor whose 20-level network
+# reaches the threshold to mega sponsor, demotes the rest, and resyncs each
+# mega sponsor's precomputed downline index and active-member sketches
+# (run it nightly). --recount computes one sponsor's exact active count.
+
+import argparse
+import json
+
+from app import create_app
+from bonus.mega_sponsors import MegaSponsorIndex, MEGA_SPONSOR_THRESHOLD
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh mega sponsor downline indexes and sketches")
+    parser.add_argument("--threshold", type=int, default=MEGA_SPONSOR_THRESHOLD,
+                        help="network size at which a sponsor becomes a mega sponsor")
+    parser.add_argument("--chunk-size", type=int, default=50000, help="descendant ids per transaction")
+    parser.add_argument("--recount", type=int, metavar="USER_ID", help="exact active recount for one sponsor")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.recount is not None:
+            report = MegaSponsorIndex.recount(args.recount)
+        else:
+            report = MegaSponsorIndex.refresh(args.threshold, args.chunk_size)
+
+    print(json.dumps(report, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+# replay_bonus_jobs.py
+# Usage: python replay_bonus_jobs.py [--check] [--limit 1000] [--no-failed] [--since 2026-10-01]
+#
+# Finds completed package purchases whose referral bonuses never ran (failed
+# jobs, or no job at all), re-queues them and drains the queue in this process.
+
+import argparse
+import json
+from datetime import datetime
+
+from app import create_app
+from bonus.bonus_queue import bonus_job_queue
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay missed referral bonus jobs")
+    parser.add_argument("--check", action="store_true", help="only report queue stats and missing purchases")
+    parser.add_argument("--limit", type=int, default=1000, help="max missing purchases to enqueue per run")
+    parser.add_argument("--no-failed", action="store_true", help="leave permanently failed jobs alone")
+    parser.add_argument("--since", type=datetime.fromisoformat,
+                        help="only consider purchases created on or after this date (ISO format)")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.check:
+            stats = bonus_job_queue.stats()
+            stats['missing'] = len(bonus_job_queue.find_missing(args.limit, args.since))
+            print(json.dumps(stats, indent=2))
+            return
+
+        result = bonus_job_queue.replay_missing(limit=args.limit, include_failed=not args.no_failed, since=args.since)
+        result['drained'] = bonus_job_queue.drain()
+        result.update(bonus_job_queue.stats())
+        print(json.dumps(result, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# replay_tree_updates.py
+# Usage: python replay_tree_updates.py [--check] [--limit 1000] [--no-failed]
+#
+# Finds users whose referral tree insert never landed or is truncated (failed
+# jobs, no job at all, or inserted before their referrer), re-queues them and
+# drains the queue in this process, then fixes counters a repair re-bumped.
+
+import argparse
+import json
+
+from app import create_app
+from bonus.tree_queue import tree_update_queue
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay missed referral tree updates")
+    parser.add_argument("--check", action="store_true", help="only report queue stats and missing users")
+    parser.add_argument("--limit", type=int, default=1000, help="max missing users to enqueue per run")
+    parser.add_argument("--no-failed", action="store_true", help="leave permanently failed jobs alone")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.check:
+            stats = tree_update_queue.stats()
+            stats['missing'] = len(tree_update_queue.find_missing(args.limit))
+            print(json.dumps(stats, indent=2))
+            return
+
+        result = tree_update_queue.replay_missing(limit=args.limit, include_failed=not args.no_failed)
+        result['drained'] = tree_update_queue.drain()
+        if result['enqueued_truncated']:
+            # Repairing a truncated chain re-bumps ancestors that already counted the user
+            from bonus.network_counters import NetworkCounterHelper
+            counters = NetworkCounterHelper.verify_counters(fix=True)
+            result['counters_fixed'] = counters['users_drifted']
+        result.update(tree_update_queue.stats())
+        print(json.dumps(result, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+# scan_bonus_integrity.py
+# Usage: python scan_bonus_integrity.py [--since-id 0] [--chunk-size 5000] [--samples 50]
+#
+# Re-signs every referral_bonuses row with the deterministic security hash
+# and reports rows whose stored hash doesn't match (edited payment, user,
+# level or amount). Read-only.
+
+import argparse
+import json
+
+from app import create_app
+from bonus.bonus_integrity import BonusIntegrityScanner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline tamper scan of referral bonus security hashes")
+    parser.add_argument("--since-id", type=int, default=0, help="only scan bonus ids above this")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="rows per read")
+    parser.add_argument("--samples", type=int, default=50, help="mismatched rows listed in the report")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        report = BonusIntegrityScanner(args.chunk_size, args.samples).run(since_id=args.since_id)
+        print(json.dumps(report, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# tests/test_bonus_validation.py
+"""
+Differential tests: validate_bonus_batch (prefetched BonusValidationContext)
+must give every entry the same verdict as validate_bonus_entry with its
+per-entry queries.
+"""
+import random
+from decimal import Decimal
+
+import pytest
+
+from extensions import db
+from models import User, Payment
+from bonus.refferral_tree import ReferralTreeHelper
+from bonus.validation import BonusValidationHelper, BonusValidationContext
+
+
+def build_network(rng, users=200, payments=30):
+    user_ids = []
+    for i in range(users):
+        referrer = rng.choice(user_ids[-30:]) if user_ids else None
+        user = User(
+            username=f"u{i}", phone=f"07{i:08d}", password_hash="x", referred_by=referrer,
+            referral_code=f"R{i:06d}", is_active=rng.random() < 0.8, is_verified=True,
+        )
+        db.session.add(user)
+        db.session.flush()
+        user_ids.append(user.id)
+        if referrer:
+            ReferralTreeHelper.add_new_user(user.id, referrer)
+        else:
+            ReferralTreeHelper.initialize_standalone_user(user.id)
+
+    payment_ids = []
+    for j in range(payments):
+        payment = Payment(
+            user_id=rng.choice(user_ids), reference=f"r{j}",
+            status=rng.choice(["completed"] * 3 + ["pending", "failed"]),
+            amount=Decimal(rng.choice([5000, 10000, 50000, 2000000])),
+            currency=rng.choice(["UGX"] * 4 + ["USD"]),
+        )
+        db.session.add(payment)
+        db.session.flush()
+        payment_ids.append(payment.id)
+    db.session.commit()
+    return user_ids, payment_ids
+
+
+def random_batch(rng, user_ids, payment_ids):
+    """Mostly plausible entries, plus the malformed shapes the validator must reject"""
+    batch = []
+    for _ in range(rng.randint(1, 20)):
+        entry = {
+            "purchase_id": rng.choice(payment_ids + [999999, None, str(payment_ids[0])]),
+            "ancestor_id": rng.choice(user_ids + [999999, 0, -1, "x"]),
+            "level": rng.choice(list(range(1, 21)) + [0, 21, "3"]),
+            "bonus_amount": rng.choice([500, 600000, 150000, 0, -5, "a", Decimal("20000.5"), 20000.0]),
+        }
+        if rng.random() < 0.6:
+            entry["descendant_id"] = rng.choice(user_ids + [None, 0, 999999])
+        if rng.random() < 0.05:
+            entry.pop(rng.choice(list(entry)))
+        batch.append(entry)
+    return batch
+
+
+@pytest.mark.parametrize("seed", [1, 7, 22])
+def test_batch_verdicts_match_per_entry(app, seed):
+    rng = random.Random(seed)
+    user_ids, payment_ids = build_network(rng)
+
+    for _ in range(60):
+        batch = random_batch(rng, user_ids, payment_ids)
+        expected = [BonusValidationHelper.validate_bonus_entry(dict(entry))[:2] for entry in batch]
+
+        context = BonusValidationContext.prefetch(batch)
+        assert [BonusValidationHelper.validate_bonus_entry(dict(entry), context)[:2] for entry in batch] == expected
+
+        valid, invalid, report = BonusValidationHelper.validate_bonus_batch([dict(entry) for entry in batch])
+        assert [result["passed"] for result in report["detailed_results"]] == [ok for ok, _ in expected]
+        assert [entry["validation_error"] for entry in invalid] == [msg for ok, msg in expected if not ok]
+        assert len(valid) == sum(1 for ok, _ in expected if ok)
+
+
+def test_failed_prefetch_keeps_caller_transaction(app, monkeypatch):
+    rng = random.Random(3)
+    user_ids, payment_ids = build_network(rng, users=20, payments=3)
+    batch = random_batch(rng, user_ids, payment_ids)
+    expected = [BonusValidationHelper.validate_bonus_entry(dict(entry))[:2] for entry in batch]
+
+    pending = Payment(user_id=user_ids[0], reference="uncommitted", status="pending", amount=Decimal("5000"))
+    db.session.add(pending)
+    db.session.flush()
+
+    def failing_prefetch(bonuses_data):
+        db.session.execute(db.text("SELECT no_such_column FROM payments"))
+
+    monkeypatch.setattr(BonusValidationContext, "prefetch", staticmethod(failing_prefetch))
+    _, _, report = BonusValidationHelper.validate_bonus_batch([dict(entry) for entry in batch])
+
+    assert [result["passed"] for result in report["detailed_results"]] == [ok for ok, _ in expected]
+    assert db.session.query(Payment).filter_by(reference="uncommitted").count() == 1
@@ -0,0 +1,27 @@
+# verify_network_counters.py
+# Usage: python verify_network_counters.py [--fix] [--chunk-size 5000]
+#
+# Recomputes users.total_network_size / direct_referrals_count / network_depth
+# and referral_level_counts from referral_network and reports any drift.
+
+import argparse
+import json
+
+from app import create_app
+from bonus.network_counters import NetworkCounterHelper
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify maintained downline counters")
+    parser.add_argument("--fix", action="store_true", help="rewrite drifting counters")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="user ids per verification chunk")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        report = NetworkCounterHelper.verify_counters(fix=args.fix, chunk_size=args.chunk_size)
+        print(json.dumps(report, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# verify_referral_network.py
+# Usage: python verify_referral_network.py [--repair] [--chunk-size 2000] [--pause 0.05] [--start-id 1]
+#
+# Checks referral_network against users.referred_by in id-ordered chunks
+# and reports missing / extra closure rows. With --repair each chunk's
+# minimal fix is applied in its own short transaction and the downline
+# counters are resynced afterwards. Safe to run during low traffic.
+
+import argparse
+import json
+
+from app import create_app
+from bonus.closure_verifier import ClosureVerifier
+from bonus.network_counters import NetworkCounterHelper
+
+
+def print_progress(progress):
+    print(
+        f"ids <= {progress['last_id']}/{progress['max_id']} | "
+        f"{progress['users_broken']} broken / {progress['users_checked']} checked | "
+        f"{progress['ids_per_sec']:.0f} ids/s",
+        flush=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify (and optionally repair) the referral_network closure table")
+    parser.add_argument("--repair", action="store_true", help="apply the minimal insert/delete batches")
+    parser.add_argument("--chunk-size", type=int, default=2000, help="descendant ids per chunk")
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between chunks")
+    parser.add_argument("--start-id", type=int, default=1, help="resume from this descendant id")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        verifier = ClosureVerifier(chunk_size=args.chunk_size, pause=args.pause, progress=print_progress)
+        report = verifier.run(repair=args.repair, start_id=args.start_id)
+
+        if args.repair and (report['rows_inserted'] or report['rows_deleted']):
+            # Downline counters are derived from the closure, so resync them
+            counters = NetworkCounterHelper.verify_counters(fix=True)
+            report['counters_resynced'] = counters['users_drifted']
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()